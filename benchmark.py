@@ -0,0 +1,327 @@
+"""
+Training throughput benchmark on synthetic data, CPU only
+
+    $ python benchmark.py --bench_output=benchmark.json
+
+Every configuration of the matrix runs in its own process (so peak RSS is
+per configuration) for `bench_warmup` untimed and `bench_steps` timed
+calls of DCGAN.train_step. Batches are random uint8 images normalized on
+the fly, so the input time is the cost of a cached dataset. The results
+are written as JSON, together with the commit they were measured on.
+
+With several `bench_towers`, the towers run on as many CPU devices and
+each result reports its scaling efficiency: images/sec divided by
+towers times the images/sec of the same configuration with one tower.
+
+After the timed steps, `bench_alloc_steps` more steps run under
+tracemalloc and the median of their peak host allocation is reported,
+to compare the feed and queue `bench_input_modes`.
+
+`bench_loss_fetches` selects how each step gets its losses: `none`
+(training steps between log lines), `fetch` (from the update runs, as
+on a `--log_interval` step) or `eval` (separate runs re-evaluating them
+after the updates, as DCGAN.train did before).
+"""
+from __future__ import division
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import itertools
+import subprocess
+try:
+  import tracemalloc
+except ImportError:
+  # Python 2: no allocation measurement
+  tracemalloc = None
+import numpy as np
+import tensorflow as tf
+from six.moves import xrange
+
+from main import FLAGS
+from model import DCGAN
+from ops import SummaryWriter
+from input_pipeline import normalize_batch, FeedBuffers
+from profiler import StepProfiler
+from utils import one_hot
+
+flags = tf.app.flags
+flags.DEFINE_integer("bench_steps", 20, "Number of timed training steps per configuration [20]")
+flags.DEFINE_integer("bench_warmup", 3, "Number of untimed training steps before timing [3]")
+flags.DEFINE_string("bench_modes", "dcgan,wgan,wgan_fused,mnist", "Comma separated modes: dcgan, wgan, wgan_fused, mnist [dcgan,wgan,wgan_fused,mnist]")
+flags.DEFINE_string("bench_critic_nums", "1,5", "Comma separated CRITIC_NUM values of the wgan modes [1,5]")
+flags.DEFINE_string("bench_batch_sizes", "32,64", "Comma separated batch sizes [32,64]")
+flags.DEFINE_string("bench_heights", "64,128", "Comma separated output resolutions, mnist always uses 28 [64,128]")
+flags.DEFINE_string("bench_precisions", "float32", "Comma separated precisions, float32 and/or mixed (float16 compute) [float32]")
+flags.DEFINE_string("bench_towers", "1", "Comma separated numbers of CPU towers, e.g. 1,2,4 [1]")
+flags.DEFINE_string("bench_input_modes", "feed", "Comma separated input modes, feed and/or queue [feed]")
+flags.DEFINE_string("bench_loss_fetches", "none", "Comma separated ways of getting the losses every step: none, fetch (from the update runs) and/or eval (re-evaluated in separate runs) [none]")
+flags.DEFINE_integer("bench_alloc_steps", 5, "Number of steps traced by tracemalloc after the timed ones [5]")
+flags.DEFINE_string("bench_output", "benchmark.json", "Path of the JSON results [benchmark.json]")
+flags.DEFINE_boolean("bench_child", False, "Internal: run a single configuration and print its result")
+flags.DEFINE_boolean("bench_conditional", False, "Internal: benchmark the conditional mnist model")
+
+def int_list(value):
+  return [int(v) for v in value.split(',') if v]
+
+def configurations():
+  configs = []
+  for mode in FLAGS.bench_modes.split(','):
+    for batch_size in int_list(FLAGS.bench_batch_sizes):
+      if mode == 'mnist':
+        configs.append({'mode': mode, 'W_GAN': False, 'CRITIC_NUM': 1,
+                        'batch_size': batch_size, 'output_height': 28})
+        continue
+      for height in int_list(FLAGS.bench_heights):
+        if mode == 'dcgan':
+          configs.append({'mode': mode, 'W_GAN': False, 'CRITIC_NUM': 1,
+                          'batch_size': batch_size, 'output_height': height})
+        elif mode in ('wgan', 'wgan_fused'):
+          for critic_num in int_list(FLAGS.bench_critic_nums):
+            configs.append({'mode': mode, 'W_GAN': True, 'CRITIC_NUM': critic_num,
+                            'batch_size': batch_size, 'output_height': height})
+        else:
+          raise ValueError("unknown benchmark mode %s" % mode)
+
+  tower_configs = []
+  for config in configs:
+    for precision, num_towers, input_mode, loss_fetch in itertools.product(
+        FLAGS.bench_precisions.split(','), int_list(FLAGS.bench_towers),
+        FLAGS.bench_input_modes.split(','), FLAGS.bench_loss_fetches.split(',')):
+      # the fused critic is single-tower and feeds its batches
+      if config['mode'] == 'wgan_fused' and (num_towers > 1 or input_mode != 'feed'):
+        continue
+      if loss_fetch not in ('none', 'fetch', 'eval'):
+        raise ValueError("unknown loss fetch %s" % loss_fetch)
+      tower_configs.append(dict(config, num_towers=num_towers,
+                                precision=precision, input_mode=input_mode,
+                                loss_fetch=loss_fetch))
+  return tower_configs
+
+def add_scaling_efficiency(results):
+  keys = ('mode', 'CRITIC_NUM', 'batch_size', 'output_height', 'precision',
+          'input_mode', 'loss_fetch')
+  baselines = dict((tuple(r[k] for k in keys), r['images_per_sec'])
+                   for r in results if r['num_towers'] == 1)
+  for result in results:
+    baseline = baselines.get(tuple(result[k] for k in keys))
+    if baseline:
+      result['scaling_efficiency'] = \
+          result['images_per_sec'] / (result['num_towers'] * baseline)
+
+def run_configuration(config):
+  """Runs `config` in a child process and returns its result dict."""
+  args = [sys.executable, os.path.abspath(__file__), '--bench_child',
+          '--bench_steps=%d' % FLAGS.bench_steps,
+          '--bench_warmup=%d' % FLAGS.bench_warmup,
+          '--batch_size=%d' % config['batch_size'],
+          '--output_height=%d' % config['output_height'],
+          '--CRITIC_NUM=%d' % config['CRITIC_NUM'],
+          '--bench_alloc_steps=%d' % FLAGS.bench_alloc_steps,
+          '--num_towers=%d' % config['num_towers'],
+          '--input_mode=%s' % config['input_mode'],
+          '--bench_loss_fetches=%s' % config['loss_fetch'],
+          '--mixed_precision' if config['precision'] == 'mixed' else '--nomixed_precision',
+          '--tower_device=cpu',
+          '--W_GAN' if config['W_GAN'] else '--noW_GAN',
+          '--fused_critic' if config['mode'] == 'wgan_fused' else '--nofused_critic',
+          '--bench_conditional' if config['mode'] == 'mnist' else '--nobench_conditional']
+  env = dict(os.environ, CUDA_VISIBLE_DEVICES='')
+  output = subprocess.check_output(args, env=env)
+  result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+  result.update(config)
+  return result
+
+def queue_batches(dcgan, config, images, labels):
+  """Endlessly yields the pool's batches in preallocated host buffers."""
+  num_buffers = max(config.prefetch_batches, 1) + 2
+  image_buffers = FeedBuffers(
+    [config.batch_size] + list(images.shape[1:]), num_buffers)
+  label_buffers = FeedBuffers([config.batch_size, 10], num_buffers)
+  for step in itertools.count():
+    offset = (step % 4) * config.batch_size
+    batch = (normalize_batch(images[offset:offset+config.batch_size],
+                             out=image_buffers.next()),)
+    if dcgan.y_dim:
+      batch_labels = label_buffers.next()
+      batch_labels.fill(0.)
+      batch_labels[np.arange(config.batch_size),
+                   labels[offset:offset+config.batch_size]] = 1.
+      batch += (batch_labels,)
+    yield batch
+
+def eval_losses(sess, dcgan, batch_images, batch_labels, batch_z):
+  """Re-evaluates the losses in separate runs, as DCGAN.train did before
+  they were fetched from the update runs."""
+  images_feed, z_feed = {}, {}
+  if not dcgan.input_queue:
+    images_feed[dcgan.inputs] = batch_images[-dcgan.batch_size:]
+    z_feed[dcgan.z] = batch_z
+    if dcgan.y_dim:
+      images_feed[dcgan.y] = batch_labels[-dcgan.batch_size:]
+      z_feed[dcgan.y] = batch_labels[-dcgan.batch_size:]
+  if dcgan.FLAGS.W_GAN:
+    feed_dict = dict(images_feed)
+    feed_dict.update(z_feed)
+    sess.run(dcgan.d_loss, feed_dict=feed_dict)
+  else:
+    sess.run(dcgan.d_loss_fake, feed_dict=z_feed)
+    sess.run(dcgan.d_loss_real, feed_dict=images_feed)
+  sess.run(dcgan.g_loss, feed_dict=z_feed)
+
+def benchmark_step_loop(sess, dcgan, config, num_warmup, num_steps,
+                        num_alloc_steps=0, loss_fetch='none'):
+  rng = np.random.RandomState(0)
+  step_size = config.batch_size * dcgan.batches_per_step
+  image_shape = [dcgan.output_height, dcgan.output_width, dcgan.c_dim]
+  # a few distinct batches, so the same buffer is not fed every step
+  images = rng.randint(0, 256, size=[4 * step_size] + image_shape).astype(np.uint8)
+  labels = rng.randint(0, 10, size=4 * step_size)
+
+  feeder = None
+  if dcgan.input_queue:
+    sess.run(dcgan.input_buffers_init)
+    feeder = dcgan.start_input_queue(queue_batches(dcgan, config, images, labels))
+
+  def step_fn(step):
+    dcgan.profiler.start_step(step + 1)
+    batch_images = batch_labels = batch_z = None
+    if not dcgan.input_queue:
+      with dcgan.profiler.phase('input'):
+        offset = (step % 4) * step_size
+        batch_images = normalize_batch(images[offset:offset+step_size])
+        batch_labels = one_hot(labels[offset:offset+step_size], 10) \
+            if dcgan.y_dim else None
+        batch_z = np.random.uniform(-1, 1, [config.batch_size, dcgan.z_dim]) \
+            .astype(np.float32)
+
+    dcgan.train_step(batch_images, batch_labels, batch_z, step + 1,
+                     log=loss_fetch == 'fetch')
+    if loss_fetch == 'eval':
+      with dcgan.profiler.phase('losses'):
+        eval_losses(sess, dcgan, batch_images, batch_labels, batch_z)
+    dcgan.profiler.end_step()
+
+  start_time = None
+  for step in xrange(num_warmup + num_steps):
+    if step == num_warmup:
+      dcgan.profiler = StepProfiler(window=num_steps)
+      start_time = time.time()
+    step_fn(step)
+  elapsed = time.time() - start_time
+
+  # peak bytes allocated on the host (by Python and NumPy) during a step
+  alloc_peaks = []
+  if tracemalloc is None:
+    num_alloc_steps = 0
+  for step in xrange(num_warmup + num_steps,
+                     num_warmup + num_steps + num_alloc_steps):
+    tracemalloc.start()
+    step_fn(step)
+    alloc_peaks.append(tracemalloc.get_traced_memory()[1])
+    tracemalloc.stop()
+
+  if feeder is not None:
+    feeder.close()
+
+  result = {
+    'steps': num_steps,
+    'seconds': elapsed,
+    'steps_per_sec': num_steps / elapsed,
+    'images_per_sec': num_steps * step_size / elapsed,
+  }
+  totals = dcgan.profiler.totals()
+  for phase in ('input', 'feed', 'd_update', 'g_update', 'summary', 'losses'):
+    result['%s_sec' % phase] = totals.get(phase, 0.)
+    result['%s_frac' % phase] = totals.get(phase, 0.) / elapsed
+  result['step_ms'] = dict((p, 1000 * seconds) for p, seconds in
+                           dcgan.profiler.percentiles()['step'].items())
+  if alloc_peaks:
+    result['host_alloc_peak_kb'] = float(np.median(alloc_peaks)) / 1024.
+  return result
+
+def run_child():
+  conditional = FLAGS.bench_conditional
+  height = FLAGS.output_height
+  log_dir = tempfile.mkdtemp(prefix='dcgan_bench_')
+  try:
+    run_config = tf.ConfigProto(allow_soft_placement=True)
+    run_config.device_count['CPU'] = FLAGS.num_towers
+    with tf.Session(config=run_config) as sess:
+      dcgan = DCGAN(
+          sess,
+          input_width=height,
+          input_height=height,
+          output_width=height,
+          output_height=height,
+          batch_size=FLAGS.batch_size,
+          sample_num=FLAGS.batch_size,
+          y_dim=10 if conditional else None,
+          c_dim=1 if conditional else 3,
+          dataset_name='synthetic',
+          crop=True,
+          checkpoint_dir=log_dir,
+          FLAGS=FLAGS)
+      dcgan.build_train_ops(FLAGS)
+      tf.global_variables_initializer().run()
+      dcgan.writer = SummaryWriter(log_dir, sess.graph)
+
+      result = benchmark_step_loop(sess, dcgan, FLAGS,
+                                   FLAGS.bench_warmup, FLAGS.bench_steps,
+                                   FLAGS.bench_alloc_steps,
+                                   FLAGS.bench_loss_fetches)
+      dcgan.writer.close()
+  finally:
+    shutil.rmtree(log_dir, ignore_errors=True)
+
+  # ru_maxrss is in kilobytes on Linux
+  result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+  print(json.dumps(result))
+
+def git_commit():
+  try:
+    return subprocess.check_output(
+      ['git', 'rev-parse', 'HEAD'],
+      cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf-8').strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def main(_):
+  if FLAGS.bench_child:
+    run_child()
+    return
+
+  results = []
+  for config in configurations():
+    result = run_configuration(config)
+    print(" [*] %-10s k=%d batch=%-3d %3dpx towers=%d %s %s losses=%s: %6.2f steps/sec "
+          "%8.1f images/sec (input %.0f%%, D %.0f%%, G %.0f%%, summary %.0f%%, "
+          "losses %.0f%%), peak RSS %.0fMB, step host alloc %.0fKB" % (
+            result['mode'], result['CRITIC_NUM'], result['batch_size'],
+            result['output_height'], result['num_towers'], result['precision'],
+            result['input_mode'], result['loss_fetch'], result['steps_per_sec'],
+            result['images_per_sec'], 100 * result['input_frac'],
+            100 * result['d_update_frac'], 100 * result['g_update_frac'],
+            100 * result['summary_frac'], 100 * result['losses_frac'],
+            result['peak_rss_mb'],
+            result.get('host_alloc_peak_kb', 0.)))
+    results.append(result)
+  add_scaling_efficiency(results)
+  for result in results:
+    if result['num_towers'] > 1 and 'scaling_efficiency' in result:
+      print(" [*] %-10s k=%d batch=%-3d %3dpx towers=%d: scaling efficiency %.2f" % (
+        result['mode'], result['CRITIC_NUM'], result['batch_size'],
+        result['output_height'], result['num_towers'],
+        result['scaling_efficiency']))
+
+  with open(FLAGS.bench_output, 'w') as f:
+    json.dump({'commit': git_commit(), 'steps': FLAGS.bench_steps,
+               'warmup': FLAGS.bench_warmup, 'results': results},
+              f, indent=2, sort_keys=True)
+  print(" [*] Wrote %s" % FLAGS.bench_output)
+
+if __name__ == '__main__':
+  tf.app.run()
@@ -0,0 +1,165 @@
+"""
+Non-blocking checkpoints with a retention policy for DCGAN.train
+"""
+from __future__ import division
+import os
+import json
+import time
+import threading
+from glob import glob
+import tensorflow as tf
+
+class AsyncCheckpointer(object):
+  """Saves checkpoints without pausing training for the disk write.
+
+  `save` copies every variable of `var_list` into an untracked shadow
+  variable in one session run, then a background thread writes the
+  shadows under the original variable names, so the files restore with a
+  plain `tf.train.Saver(var_list)`. A new snapshot waits for the previous
+  write to finish.
+
+  Retention keeps the last `max_to_keep` (at least 1) checkpoints plus the `keep_best`
+  ones with the lowest metric passed to `save`. The metrics are recorded
+  next to the checkpoint state in `checkpoint_metrics.json`, so the
+  checkpoints of an earlier run keep theirs when training resumes.
+
+  With `generator_dir`, the `generator/` variables alone are also written
+  there after every save (only the latest is kept), which is what
+  `inference.GeneratorEngine` restores.
+  """
+  def __init__(self, sess, var_list, checkpoint_dir, model_name,
+               max_to_keep=5, keep_best=0, generator_dir=None,
+               save_steps=500, save_secs=0):
+    if max_to_keep < 1:
+      # checkpoints[-0:] would keep them all, and training resumes from
+      # the latest one, which must not be deleted
+      raise ValueError("max_to_keep must be at least 1, got %d" % max_to_keep)
+    self.sess = sess
+    self.checkpoint_dir = checkpoint_dir
+    self.model_name = model_name
+    self.max_to_keep = max_to_keep
+    self.keep_best = keep_best
+    self.generator_dir = generator_dir
+    self.save_steps = save_steps
+    self.save_secs = save_secs
+
+    shadows = {}
+    generator_shadows = {}
+    snapshot_ops = []
+    with tf.name_scope('checkpoint'):
+      for var in var_list:
+        name = var.op.name
+        shadow = tf.Variable(
+          tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype),
+          trainable=False, collections=[],
+          name=name.replace('/', '_'))
+        snapshot_ops.append(tf.assign(shadow, var))
+        shadows[name] = shadow
+        if name.startswith('generator/'):
+          generator_shadows[name] = shadow
+      self.snapshot_op = tf.group(*snapshot_ops)
+    self.shadow_init_op = tf.variables_initializer(list(shadows.values()))
+
+    # Retention is managed here, so the savers keep every file they write.
+    self.saver = tf.train.Saver(shadows, max_to_keep=None)
+    self.generator_saver = None
+    if generator_dir:
+      self.generator_saver = tf.train.Saver(generator_shadows, max_to_keep=1)
+
+    self.initialized = False
+    self.thread = None
+    self.error = None
+    self.checkpoints = []
+    self.last_step = None
+    self.last_time = None
+
+  def restore_state(self, step):
+    """Picks up the checkpoints of an earlier run and starts the triggers."""
+    self.last_step = step
+    self.last_time = time.time()
+    state = tf.train.get_checkpoint_state(self.checkpoint_dir)
+    if state:
+      metrics = {}
+      if os.path.exists(self.metrics_path):
+        with open(self.metrics_path) as metrics_f:
+          metrics = json.load(metrics_f)
+      self.checkpoints = [(path, metrics.get(os.path.basename(path)))
+                          for path in state.all_model_checkpoint_paths]
+
+  @property
+  def metrics_path(self):
+    return os.path.join(self.checkpoint_dir, 'checkpoint_metrics.json')
+
+  def should_save(self, step):
+    if self.save_steps > 0 and step - self.last_step >= self.save_steps:
+      return True
+    if self.save_secs > 0 and time.time() - self.last_time >= self.save_secs:
+      return True
+    return False
+
+  def save(self, step, metric=None):
+    """Snapshots the variables and writes them in the background."""
+    self.wait()
+    if not self.initialized:
+      self.sess.run(self.shadow_init_op)
+      self.initialized = True
+    self.sess.run(self.snapshot_op)
+    self.last_step = step
+    self.last_time = time.time()
+
+    self.thread = threading.Thread(target=self._write, args=(step, metric))
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _write(self, step, metric):
+    try:
+      if not os.path.exists(self.checkpoint_dir):
+        os.makedirs(self.checkpoint_dir)
+      path = self.saver.save(
+        self.sess, os.path.join(self.checkpoint_dir, self.model_name),
+        global_step=step, write_meta_graph=False, write_state=False)
+      self.checkpoints.append((path, metric))
+      self._apply_retention()
+
+      if self.generator_saver is not None:
+        if not os.path.exists(self.generator_dir):
+          os.makedirs(self.generator_dir)
+        self.generator_saver.save(
+          self.sess, os.path.join(self.generator_dir, self.model_name),
+          global_step=step, write_meta_graph=False)
+    except Exception as e:
+      self.error = e
+
+  def _apply_retention(self):
+    keep = set(path for path, _ in self.checkpoints[-self.max_to_keep:])
+    if self.keep_best > 0:
+      scored = [(metric, path) for path, metric in self.checkpoints
+                if metric is not None]
+      keep.update(path for _, path in sorted(scored)[:self.keep_best])
+
+    for path, _ in self.checkpoints:
+      if path not in keep:
+        for filename in glob(path + '.*'):
+          os.remove(filename)
+    self.checkpoints = [(path, metric) for path, metric in self.checkpoints
+                        if path in keep]
+    tf.train.update_checkpoint_state(
+      self.checkpoint_dir, self.checkpoints[-1][0],
+      all_model_checkpoint_paths=[path for path, _ in self.checkpoints])
+    with open(self.metrics_path + '.tmp', 'w') as metrics_f:
+      json.dump(dict((os.path.basename(path), metric)
+                     for path, metric in self.checkpoints
+                     if metric is not None), metrics_f, indent=2, sort_keys=True)
+    os.rename(self.metrics_path + '.tmp', self.metrics_path)
+
+  def wait(self):
+    """Blocks until the last write is done, re-raising its error."""
+    if self.thread is not None:
+      self.thread.join()
+      self.thread = None
+    if self.error is not None:
+      error, self.error = self.error, None
+      raise error
+
+  def close(self):
+    self.wait()
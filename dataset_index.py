@@ -0,0 +1,203 @@
+"""
+Persistent index of the image files of a dataset directory
+
+The manifest (`./data/<dataset>.index`) records the path, size, mtime and
+decoded shape of every file matching the input pattern. It is built once
+by listing the directories and decoding the files in parallel; updates
+only list the directories whose mtime changed and only decode the files
+that are new or changed, so a new epoch does not glob millions of files.
+Files that fail to decode are kept in the manifest as invalid, and
+`files` leaves them out, with those of the wrong channel count or too
+small to crop.
+"""
+from __future__ import division
+import os
+import json
+import stat
+import time
+import fnmatch
+from collections import Counter
+from multiprocessing.pool import ThreadPool
+from PIL import Image
+
+def image_shape(path):
+  """Returns the shape `utils.imread` decodes `path` to, None if it cannot."""
+  try:
+    image = Image.open(path)
+    image.load()
+  except Exception:
+    return None
+  width, height = image.size
+  if image.mode in ('1', 'L', 'I', 'I;16', 'F'):
+    return (height, width)
+  if image.mode == 'P':
+    return (height, width, 4 if 'transparency' in image.info else 3)
+  return (height, width, len(image.getbands()))
+
+def _match(name, component):
+  # like glob, a wildcard does not match a leading dot
+  if name.startswith('.') and not component.startswith('.'):
+    return False
+  return fnmatch.fnmatchcase(name, component)
+
+def _list(args):
+  """Lists the subdirectories of `path` matching `component`, or its
+  matching files as (path, size, mtime) with `files` set."""
+  path, component, files = args
+  try:
+    entries = os.listdir(path)
+  except OSError:
+    return []
+  results = []
+  for name in sorted(entries):
+    if not _match(name, component):
+      continue
+    entry_path = os.path.join(path, name)
+    if files:
+      try:
+        entry_stat = os.stat(entry_path)
+      except OSError:
+        continue
+      if stat.S_ISREG(entry_stat.st_mode):
+        results.append((entry_path, entry_stat.st_size, entry_stat.st_mtime))
+    elif os.path.isdir(entry_path):
+      results.append(entry_path)
+  return results
+
+def _mtime(path):
+  try:
+    return os.stat(path).st_mtime
+  except OSError:
+    return None
+
+class DatasetIndex(object):
+  """The files of `root` matching the glob `pattern`, with their shapes.
+
+  `update` brings the manifest at `index_path` up to date; a single
+  process should do so, while others `load` or `wait` for it. Listing,
+  stat calls and image decoding run on `num_workers` threads. A file
+  changed in place without adding or removing a file of its directory
+  leaves the directory mtime alone; `update(full=True)` rescans and
+  re-decodes everything.
+  """
+  def __init__(self, root, pattern, index_path, num_workers=8):
+    self.root = root
+    self.pattern = pattern
+    self.index_path = index_path
+    self.num_workers = max(num_workers, 1)
+    # path: (size, mtime, shape or None if invalid)
+    self.entries = {}
+    # mtime of every directory holding files
+    self.dirs = {}
+    self.load()
+
+  def load(self):
+    self.entries = {}
+    self.dirs = {}
+    if not os.path.exists(self.index_path):
+      return
+    with open(self.index_path) as index_f:
+      header = json.loads(index_f.readline())
+      if header.get('root') != self.root or header.get('pattern') != self.pattern:
+        return
+      self.dirs = header['dirs']
+      for line in index_f:
+        path, size, mtime, shape = line.rstrip('\n').split('\t')
+        shape = tuple(int(v) for v in shape.split(',')) if shape != '-' else None
+        self.entries[path] = (int(size), float(mtime), shape)
+
+  def save(self):
+    # unique per process, so concurrent writers never share a temporary file
+    tmp_path = '%s.tmp%d' % (self.index_path, os.getpid())
+    with open(tmp_path, 'w') as index_f:
+      index_f.write(json.dumps({'root': self.root, 'pattern': self.pattern,
+                                'dirs': self.dirs}) + '\n')
+      for path in sorted(self.entries):
+        size, mtime, shape = self.entries[path]
+        index_f.write('%s\t%d\t%r\t%s\n' % (
+          path, size, mtime, ','.join(str(v) for v in shape) if shape else '-'))
+    os.rename(tmp_path, self.index_path)
+
+  def wait(self, poll_secs=1):
+    """Waits for another process to write the manifest, then loads it."""
+    while not os.path.exists(self.index_path):
+      print(" [*] Waiting for the dataset index %s..." % self.index_path)
+      time.sleep(poll_secs)
+    self.load()
+
+  def update(self, full=False):
+    """Picks up the files added, changed or removed since the last update."""
+    components = self.pattern.split('/')
+    pool = ThreadPool(self.num_workers)
+    try:
+      dirs = [self.root]
+      for component in components[:-1]:
+        dirs = sorted(path for paths in pool.map(
+          _list, [(path, component, False) for path in dirs]) for path in paths)
+      mtimes = dict(zip(dirs, pool.map(_mtime, dirs)))
+      changed = [path for path in dirs
+                 if full or mtimes[path] is None or self.dirs.get(path) != mtimes[path]]
+      listings = pool.map(_list, [(path, components[-1], True) for path in changed])
+    finally:
+      pool.close()
+      pool.join()
+
+    changed_set = set(changed)
+    entries = dict((path, entry) for path, entry in self.entries.items()
+                   if os.path.dirname(path) in mtimes and
+                   os.path.dirname(path) not in changed_set)
+    to_decode = []
+    for listing in listings:
+      for path, size, mtime in listing:
+        old = self.entries.get(path)
+        if not full and old is not None and old[:2] == (size, mtime):
+          entries[path] = old
+        else:
+          entries[path] = (size, mtime, None)
+          to_decode.append(path)
+
+    if to_decode:
+      # threads, not forked processes: this runs once TF is up, and PIL
+      # releases the GIL while decoding
+      pool = ThreadPool(self.num_workers)
+      try:
+        shapes = pool.map(image_shape, to_decode, chunksize=64)
+      finally:
+        pool.close()
+        pool.join()
+      for path, shape in zip(to_decode, shapes):
+        size, mtime, _ = entries[path]
+        entries[path] = (size, mtime, shape)
+      print(" [*] Indexed %d new or changed files of %s, %d invalid" % (
+        len(to_decode), self.root, sum(shape is None for shape in shapes)))
+
+    modified = to_decode or len(entries) != len(self.entries) or \
+        any(self.dirs.get(path) != mtime for path, mtime in mtimes.items())
+    self.entries = entries
+    self.dirs = mtimes
+    if modified:
+      self.save()
+
+  def __len__(self):
+    return len(self.entries)
+
+  def channels(self):
+    """Returns the most common channel count of the valid images."""
+    counts = Counter(shape[2] if len(shape) == 3 else 1
+                     for _, _, shape in self.entries.values() if shape)
+    if not counts:
+      raise ValueError("no valid images match %s" % os.path.join(
+        self.root, self.pattern))
+    return counts.most_common(1)[0][0]
+
+  def files(self, channels=None, min_height=0, min_width=0):
+    """Returns the sorted paths of the valid images, of `channels` channels
+    if given and at least `min_height` x `min_width`."""
+    files = []
+    for path, (_, _, shape) in self.entries.items():
+      if shape is None or shape[0] < min_height or shape[1] < min_width:
+        continue
+      if channels is not None and (shape[2] if len(shape) == 3 else 1) != channels:
+        continue
+      files.append(path)
+    return sorted(files)
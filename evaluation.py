@@ -0,0 +1,298 @@
+"""
+Streaming FID and Inception score of the generator during training
+
+Features of the generated and the real images are reduced to running
+means and covariances as they are extracted, so memory does not grow with
+the number of samples. The feature network is a frozen GraphDef given
+with `--eval_graph` (e.g. the Inception graph `classify_image_graph_def.pb`),
+run on the CPU. Without one, a fixed random conv net is used, whose FIDs
+are only comparable with each other and which has no Inception score.
+"""
+from __future__ import division
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+import scipy.linalg
+import tensorflow as tf
+from six.moves import xrange
+
+from utils import one_hot
+
+class RunningStats(object):
+  """Mean and covariance of feature batches, merged one batch at a time."""
+  def __init__(self, dim=None):
+    self.n = 0
+    self.mean = None if dim is None else np.zeros(dim)
+    self.m2 = None if dim is None else np.zeros([dim, dim])
+
+  def update(self, features):
+    features = np.asarray(features, dtype=np.float64)
+    if self.mean is None:
+      self.mean = np.zeros(features.shape[1])
+      self.m2 = np.zeros([features.shape[1]] * 2)
+    n_batch = len(features)
+    mean_batch = features.mean(axis=0)
+    centered = features - mean_batch
+    delta = mean_batch - self.mean
+    n = self.n + n_batch
+    self.mean += delta * (n_batch / n)
+    self.m2 += np.dot(centered.T, centered) + \
+        np.outer(delta, delta) * (self.n * n_batch / n)
+    self.n = n
+
+  @property
+  def cov(self):
+    return self.m2 / (self.n - 1)
+
+  def save(self, path, header):
+    with open(path, 'wb') as stats_f:
+      np.savez(stats_f, n=self.n, mean=self.mean, m2=self.m2,
+               header=np.array(json.dumps(header, sort_keys=True)))
+
+  @classmethod
+  def load(cls, path, header):
+    """Returns the stats saved at `path`, or None if missing or stale."""
+    if not os.path.exists(path):
+      return None
+    data = np.load(path)
+    if json.loads(str(data['header'])) != json.loads(json.dumps(header)):
+      return None
+    stats = cls()
+    stats.n, stats.mean, stats.m2 = int(data['n']), data['mean'], data['m2']
+    return stats
+
+class RunningInceptionScore(object):
+  """exp(E[KL(p(y|x) || p(y))]) accumulated over batches of p(y|x)."""
+  def __init__(self):
+    self.n = 0
+    self.sum_probs = 0.
+    self.sum_neg_entropy = 0.
+
+  def update(self, probs):
+    probs = np.asarray(probs, dtype=np.float64)
+    self.n += len(probs)
+    self.sum_probs = self.sum_probs + probs.sum(axis=0)
+    self.sum_neg_entropy += np.sum(probs * np.log(probs + 1e-12))
+
+  def score(self):
+    marginal = self.sum_probs / self.n
+    return float(np.exp(self.sum_neg_entropy / self.n -
+                        np.sum(marginal * np.log(marginal + 1e-12))))
+
+def frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
+  """Frechet distance between the Gaussians (mu1, sigma1) and (mu2, sigma2)."""
+  diff = mu1 - mu2
+  covmean, _ = scipy.linalg.sqrtm(sigma1.dot(sigma2), disp=False)
+  if not np.isfinite(covmean).all():
+    # singular product, see Heusel et al.'s reference implementation
+    offset = np.eye(sigma1.shape[0]) * eps
+    covmean = scipy.linalg.sqrtm((sigma1 + offset).dot(sigma2 + offset))
+  if np.iscomplexobj(covmean):
+    covmean = covmean.real
+  return float(diff.dot(diff) + np.trace(sigma1) + np.trace(sigma2)
+               - 2 * np.trace(covmean))
+
+def random_conv_features(images, seed=0):
+  """Global-average-pooled features of a fixed, randomly initialized conv net."""
+  rng = np.random.RandomState(seed)
+  h = tf.image.resize_bilinear(images, [64, 64]) / 127.5 - 1.
+  for channels in (64, 128, 256, 512):
+    fan_in = 9 * int(h.get_shape()[-1])
+    w = rng.normal(0., np.sqrt(2. / fan_in),
+                   [3, 3, int(h.get_shape()[-1]), channels]).astype(np.float32)
+    h = tf.nn.relu(tf.nn.conv2d(h, tf.constant(w), [1, 2, 2, 1], 'SAME'))
+  return tf.reduce_mean(h, [1, 2])
+
+def batch_logits(logits, features):
+  """Recomputes the dense layer producing `logits` on a batch of `features`.
+
+  The Inception graph reshapes pool_3 to a fixed [1, 2048] before its
+  softmax layer, so its logits cannot take a batch. When `logits` is a
+  MatMul (plus bias) of features of the same size, the layer is applied
+  to `features` with the graph's own weights; otherwise `logits` is used
+  as it is.
+  """
+  op = logits.op
+  bias = None
+  if op.type in ('Add', 'BiasAdd') and op.inputs[0].op.type == 'MatMul':
+    op, bias = op.inputs[0].op, op.inputs[1]
+  if op.type != 'MatMul' or op.get_attr('transpose_a') or op.get_attr('transpose_b'):
+    return logits
+  weights = op.inputs[1]
+  features = tf.reshape(features, [-1, int(weights.get_shape()[0])])
+  logits = tf.matmul(features, weights)
+  return logits + bias if bias is not None else logits
+
+class FeatureExtractor(object):
+  """Runs a feature network in its own CPU graph and session.
+
+  Images are fed as [N, H, W, C] pixels in [0, 255]; grayscale images are
+  tiled to RGB and every image is resized to `input_size`. The frozen graph
+  at `graph_path` gets them through `input_tensor` (which must accept a
+  batch) and returns `feature_tensor` and, if set, the softmax of
+  `logits_tensor`, recomputed on the batch of features by `batch_logits`.
+  """
+  def __init__(self, graph_path=None, input_tensor='ExpandDims:0',
+               feature_tensor='pool_3:0', logits_tensor='softmax/logits:0',
+               input_size=299, batch_size=100, num_threads=2):
+    self.batch_size = batch_size
+    self.graph = tf.Graph()
+    with self.graph.as_default(), tf.device('/cpu:0'):
+      self.images = tf.placeholder(tf.float32, [None, None, None, 3], name='images')
+      if graph_path:
+        graph_def = tf.GraphDef()
+        with open(graph_path, 'rb') as graph_f:
+          data = graph_f.read()
+        graph_def.ParseFromString(data)
+        self.name = '%s_%s' % (os.path.basename(graph_path),
+                               hashlib.sha1(data).hexdigest()[:12])
+
+        resized = tf.image.resize_bilinear(self.images, [input_size, input_size])
+        return_tensors = [feature_tensor] + ([logits_tensor] if logits_tensor else [])
+        outputs = tf.import_graph_def(graph_def, input_map={input_tensor: resized},
+                                      return_elements=return_tensors, name='net')
+        self.features = tf.reshape(outputs[0], [tf.shape(self.images)[0], -1])
+        self.probs = None
+        if logits_tensor:
+          self.probs = tf.nn.softmax(batch_logits(outputs[1], self.features))
+      else:
+        self.name = 'random_conv_seed0'
+        self.features = random_conv_features(self.images)
+        self.probs = None
+
+    config = tf.ConfigProto(device_count={'GPU': 0},
+                            intra_op_parallelism_threads=num_threads,
+                            inter_op_parallelism_threads=num_threads)
+    self.sess = tf.Session(graph=self.graph, config=config)
+
+  def extract(self, images):
+    """Returns the features and the class probabilities (or None) of `images`."""
+    images = np.asarray(images, dtype=np.float32)
+    if images.shape[-1] == 1:
+      images = np.tile(images, [1, 1, 1, 3])
+    fetches = [self.features] + ([self.probs] if self.probs is not None else [])
+    results = [self.sess.run(fetches, feed_dict={
+                 self.images: images[start:start+self.batch_size]})
+               for start in xrange(0, len(images), self.batch_size)]
+    features = np.concatenate([result[0] for result in results])
+    probs = None
+    if self.probs is not None:
+      probs = np.concatenate([result[1] for result in results])
+    return features, probs
+
+  def close(self):
+    self.sess.close()
+
+def reference_path(cache_dir, dataset_name, header):
+  """Path of the cached real-image statistics described by `header`."""
+  digest = hashlib.sha1(json.dumps(header, sort_keys=True).encode('utf-8'))
+  return os.path.join(cache_dir, '%s.fid_%s.npz' % (
+    dataset_name, digest.hexdigest()[:16]))
+
+class Evaluator(object):
+  """Computes the FID (and Inception score) of a generator.
+
+  `generate(z, y)` returns images that `to_pixels` maps to [0, 255];
+  `real_batches()` yields batches of real images in the same range as the
+  generated ones. The real statistics are computed on the first
+  evaluation and cached at `reference_path`. Every evaluation uses the
+  same `num_samples` latents, so results of different steps compare
+  without sampling noise in z.
+
+  `start` calls `snapshot()`, if given, to freeze the weights `generate`
+  samples from, then evaluates in a background thread and returns at once;
+  while an evaluation runs, further starts are skipped.
+  `callback(step, results)` receives each result, and `results` holds the
+  latest one.
+  """
+  def __init__(self, extractor, generate, real_batches, reference_path,
+               reference_header, num_samples=10000, z_dim=100, y_dim=None,
+               batch_size=100, to_pixels=None, callback=None, seed=0,
+               snapshot=None):
+    self.extractor = extractor
+    self.generate = generate
+    self.real_batches = real_batches
+    self.reference_path = reference_path
+    self.reference_header = reference_header
+    self.num_samples = num_samples
+    self.z_dim = z_dim
+    self.y_dim = y_dim
+    self.batch_size = batch_size
+    self.to_pixels = to_pixels or (lambda images: images)
+    self.callback = callback
+    self.seed = seed
+    self.snapshot = snapshot
+
+    self.reference = None
+    self.results = {}
+    self.thread = None
+    self.error = None
+
+  def reference_stats(self):
+    stats = RunningStats.load(self.reference_path, self.reference_header)
+    if stats is not None:
+      return stats
+    print(" [*] Computing the reference statistics %s" % self.reference_path)
+    stats = RunningStats()
+    for batch in self.real_batches():
+      stats.update(self.extractor.extract(self.to_pixels(batch))[0])
+    stats.save(self.reference_path, self.reference_header)
+    return stats
+
+  def evaluate(self):
+    if self.reference is None:
+      self.reference = self.reference_stats()
+
+    rng = np.random.RandomState(self.seed)
+    stats = RunningStats()
+    score = RunningInceptionScore() if self.extractor.probs is not None else None
+    for start in xrange(0, self.num_samples, self.batch_size):
+      num = min(self.batch_size, self.num_samples - start)
+      z = rng.uniform(-1, 1, [num, self.z_dim]).astype(np.float32)
+      y = one_hot(rng.randint(0, self.y_dim, num), self.y_dim) if self.y_dim else None
+      features, probs = self.extractor.extract(self.to_pixels(self.generate(z, y)))
+      stats.update(features)
+      if score is not None:
+        score.update(probs)
+
+    results = {'fid': frechet_distance(stats.mean, stats.cov,
+                                       self.reference.mean, self.reference.cov)}
+    if score is not None:
+      results['inception_score'] = score.score()
+    return results
+
+  def _run(self, step):
+    try:
+      results = self.evaluate()
+      self.results = results
+      if self.callback is not None:
+        self.callback(step, results)
+    except Exception as e:
+      self.error = e
+
+  def start(self, step):
+    """Evaluates in the background; returns False if one is still running."""
+    if self.thread is not None and self.thread.is_alive():
+      return False
+    self.wait()
+    if self.snapshot is not None:
+      self.snapshot()
+    self.thread = threading.Thread(target=self._run, args=(step,))
+    self.thread.daemon = True
+    self.thread.start()
+    return True
+
+  def wait(self):
+    """Blocks until the running evaluation is done, re-raising its error."""
+    if self.thread is not None:
+      self.thread.join()
+      self.thread = None
+    if self.error is not None:
+      error, self.error = self.error, None
+      raise error
+
+  def close(self):
+    self.wait()
+    self.extractor.close()
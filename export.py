@@ -0,0 +1,255 @@
+"""
+Export a trained generator with batch norm folded into its weights, either
+as a frozen graph or as a NumPy weight archive
+
+    $ python export.py --dataset celebA --output_height=64 --export_path=generator.pb
+    $ python export.py --dataset celebA --export_format=npz --export_path=generator.npz
+"""
+from __future__ import division
+import os
+import json
+import time
+import numpy as np
+import tensorflow as tf
+from six.moves import xrange
+
+from ops import concat, conv_cond_concat
+from inference import GeneratorEngine
+from numpy_generator import NumpyGenerator
+
+def fold_batch_norm(w, b, gamma, beta, mean, variance, epsilon):
+  """Folds an inference-mode batch norm into the preceding layer.
+
+  `w` is either a linear [in, out] matrix or a deconv [k, k, out, in]
+  filter. The batch norm may cover fewer channels than the layer outputs
+  (the projection of `z` is reshaped to a feature map before it), in which
+  case output j belongs to channel j % channels.
+  """
+  scale = gamma / np.sqrt(variance + epsilon)
+  shift = beta - mean * scale
+  if w.ndim == 2:
+    repeats = w.shape[1] // len(scale)
+    scale, shift = np.tile(scale, repeats), np.tile(shift, repeats)
+    return w * scale[None, :], b * scale + shift
+  else:
+    return w * scale[None, None, :, None], b * scale + shift
+
+def generator_layers(sess, model):
+  """Returns the generator of `model` as a list of layers with folded weights.
+
+  Each layer is a dict with `name`, `type` ('linear' or 'deconv'), `w`, `b`,
+  `activation`, `concat_y` (whether y is concatenated to the layer input)
+  and, for deconv layers, `output_shape`. `reshape` is set on a linear
+  layer whose output becomes a feature map.
+  """
+  variables = dict((var.op.name, var) for var in
+    tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope='generator'))
+  values = sess.run(variables)
+  def value(name):
+    return values['generator/' + name]
+
+  s_h, s_w = model.output_height, model.output_width
+  if not model.y_dim:
+    heights, widths = model.stage_heights, model.stage_widths
+    specs = [('g_h0_lin', 'linear', 'g_bn0',
+              [heights[0], widths[0], model.g_channels(0)], 'relu')]
+    for idx in xrange(1, model.num_stages):
+      specs.append(('g_h%d' % idx, 'deconv', 'g_bn%d' % idx,
+                    [heights[idx], widths[idx], model.g_channels(idx)], 'relu'))
+    specs.append(('g_h%d' % model.num_stages, 'deconv', None,
+                  [s_h, s_w, model.c_dim], 'tanh'))
+  else:
+    s_h2, s_h4 = int(s_h/2), int(s_h/4)
+    s_w2, s_w4 = int(s_w/2), int(s_w/4)
+    specs = [
+      ('g_h0_lin', 'linear', 'g_bn0', None, 'relu'),
+      ('g_h1_lin', 'linear', 'g_bn1', [s_h4, s_w4, model.gf_dim*2], 'relu'),
+      ('g_h2', 'deconv', 'g_bn2', [s_h2, s_w2, model.gf_dim*2], 'relu'),
+      ('g_h3', 'deconv', None, [s_h, s_w, model.c_dim], 'sigmoid'),
+    ]
+
+  layers = []
+  for name, layer_type, bn_name, shape, activation in specs:
+    if layer_type == 'linear':
+      w, b = value(name + '/Matrix'), value(name + '/bias')
+    else:
+      w, b = value(name + '/w'), value(name + '/biases')
+    if bn_name is not None:
+      bn = getattr(model, bn_name)
+      w, b = fold_batch_norm(w, b,
+                             value(bn_name + '/gamma'), value(bn_name + '/beta'),
+                             value(bn_name + '/moving_mean'),
+                             value(bn_name + '/moving_variance'),
+                             bn.epsilon)
+    layer = {
+      'name': name,
+      'type': layer_type,
+      'w': w.astype(np.float32),
+      'b': b.astype(np.float32),
+      'activation': activation,
+      'concat_y': bool(model.y_dim),
+    }
+    if layer_type == 'deconv':
+      layer['output_shape'] = shape
+    elif shape is not None:
+      layer['reshape'] = shape
+    layers.append(layer)
+  return layers
+
+def build_frozen_generator(layers, z_dim, y_dim=None):
+  """Builds a graph computing the generator from constant `layers`.
+
+  The graph reads `z:0` (and `y:0`) and writes `generated:0`.
+  """
+  graph = tf.Graph()
+  with graph.as_default():
+    z = tf.placeholder(tf.float32, [None, z_dim], name='z')
+    if y_dim:
+      y = tf.placeholder(tf.float32, [None, y_dim], name='y')
+      yb = tf.reshape(y, [-1, 1, 1, y_dim])
+
+    h = z
+    for layer in layers:
+      with tf.name_scope(layer['name']):
+        if layer['concat_y']:
+          if h.get_shape().ndims == 2:
+            h = concat([h, y], 1)
+          else:
+            h = conv_cond_concat(h, yb)
+
+        w = tf.constant(layer['w'], name='w')
+        b = tf.constant(layer['b'], name='b')
+        if layer['type'] == 'linear':
+          h = tf.nn.bias_add(tf.matmul(h, w), b)
+        else:
+          output_shape = list(layer['output_shape'])
+          h = tf.nn.conv2d_transpose(
+            h, w, tf.stack([tf.shape(h)[0]] + output_shape),
+            strides=[1, 2, 2, 1])
+          h = tf.nn.bias_add(h, b)
+          h.set_shape([None] + output_shape)
+        if 'reshape' in layer:
+          h = tf.reshape(h, [-1] + list(layer['reshape']))
+        h = getattr(tf.nn, layer['activation'])(h)
+    tf.identity(h, name='generated')
+  return graph
+
+class FrozenGenerator(object):
+  """Runs a generator graph written by `export_frozen_generator`."""
+  def __init__(self, path, session_config=None):
+    graph_def = tf.GraphDef()
+    with open(path, 'rb') as graph_f:
+      graph_def.ParseFromString(graph_f.read())
+
+    self.graph = tf.Graph()
+    with self.graph.as_default():
+      tf.import_graph_def(graph_def, name='')
+    self.sess = tf.Session(graph=self.graph, config=session_config)
+
+    self.z = self.graph.get_tensor_by_name('z:0')
+    self.generated = self.graph.get_tensor_by_name('generated:0')
+    try:
+      self.y = self.graph.get_tensor_by_name('y:0')
+    except KeyError:
+      self.y = None
+
+  def generate(self, z, y=None):
+    feed_dict = {self.z: z}
+    if self.y is not None:
+      feed_dict[self.y] = y
+    return self.sess.run(self.generated, feed_dict=feed_dict)
+
+  def close(self):
+    self.sess.close()
+
+def export_frozen_generator(engine, export_path):
+  layers = generator_layers(engine.sess, engine.model)
+  graph = build_frozen_generator(layers, engine.z_dim, engine.y_dim)
+  export_dir, export_name = os.path.split(os.path.abspath(export_path))
+  tf.train.write_graph(graph.as_graph_def(), export_dir, export_name, as_text=False)
+  print(" [*] Wrote frozen generator to %s" % export_path)
+  return layers
+
+def export_npz(layers, export_path, z_dim, y_dim=None):
+  """Writes `layers` to an .npz read by `numpy_generator.NumpyGenerator`.
+
+  Arrays are stored as `<layer index>/w` and `<layer index>/b`, next to a
+  JSON `manifest` describing the layers.
+  """
+  manifest = {'z_dim': z_dim, 'y_dim': y_dim, 'layers': []}
+  arrays = {}
+  for idx, layer in enumerate(layers):
+    manifest['layers'].append(dict(
+      (key, value) for key, value in layer.items() if key not in ('w', 'b')))
+    arrays['%d/w' % idx] = layer['w']
+    arrays['%d/b' % idx] = layer['b']
+  with open(export_path, 'wb') as export_f:
+    np.savez(export_f, manifest=np.array(json.dumps(manifest)), **arrays)
+  print(" [*] Wrote generator weights to %s" % export_path)
+
+def latency(generate, z, y=None, repeat=20):
+  generate(z, y)
+  start_time = time.time()
+  for _ in xrange(repeat):
+    generate(z, y)
+  return (time.time() - start_time) / repeat / len(z)
+
+def check_parity(engine, frozen, num_samples=64, atol=1e-4):
+  """Compares an exported generator against `DCGAN.sampler` on the same inputs.
+
+  `frozen` is a `FrozenGenerator` or a `NumpyGenerator`.
+  """
+  rng = np.random.RandomState(0)
+  z = rng.uniform(-1, 1, [num_samples, engine.z_dim]).astype(np.float32)
+  y = None
+  if engine.y_dim:
+    y = np.eye(engine.y_dim, dtype=np.float32)[rng.randint(engine.y_dim, size=num_samples)]
+
+  expected = engine.generate(z, y)
+  actual = frozen.generate(z, y)
+  max_error = np.abs(expected - actual).max()
+  print(" [*] Export vs sampler max abs error: %.2e" % max_error)
+  if max_error > atol:
+    raise ValueError("exported generator differs from the sampler by %.2e" % max_error)
+
+  for batch_size in [1, num_samples]:
+    print(" [*] Batch %4d latency per image: sampler %.3f ms, export %.3f ms" % (
+      batch_size,
+      1000 * latency(engine.generate, z[:batch_size], None if y is None else y[:batch_size]),
+      1000 * latency(frozen.generate, z[:batch_size], None if y is None else y[:batch_size])))
+  return max_error
+
+FLAGS = tf.app.flags.FLAGS
+
+def main(_):
+  y_dim = 10 if FLAGS.dataset == 'mnist' else None
+  c_dim = 1 if FLAGS.dataset == 'mnist' else FLAGS.c_dim
+  engine = GeneratorEngine(FLAGS.checkpoint_dir, FLAGS.dataset,
+                           batch_size=FLAGS.batch_size,
+                           output_height=FLAGS.output_height,
+                           output_width=FLAGS.output_width,
+                           y_dim=y_dim, c_dim=c_dim,
+                           sample_ema=FLAGS.sample_ema,
+                           dynamic_depth=FLAGS.dynamic_depth)
+  if FLAGS.export_format == 'npz':
+    layers = generator_layers(engine.sess, engine.model)
+    export_npz(layers, FLAGS.export_path, engine.z_dim, engine.y_dim)
+    exported = NumpyGenerator(FLAGS.export_path)
+  else:
+    export_frozen_generator(engine, FLAGS.export_path)
+    exported = FrozenGenerator(FLAGS.export_path)
+  check_parity(engine, exported)
+
+if __name__ == '__main__':
+  flags = tf.app.flags
+  flags.DEFINE_string("dataset", "celebA", "The name of the dataset the checkpoint was trained on [celebA]")
+  flags.DEFINE_string("checkpoint_dir", "checkpoint", "Directory name the checkpoints were saved to [checkpoint]")
+  flags.DEFINE_integer("batch_size", 64, "The batch size the checkpoint was trained with [64]")
+  flags.DEFINE_integer("output_height", 64, "The size of the output images [64]")
+  flags.DEFINE_integer("output_width", None, "The size of the output images. If None, same value as output_height [None]")
+  flags.DEFINE_integer("c_dim", 3, "Dimension of image color [3]")
+  flags.DEFINE_boolean("sample_ema", False, "True to use the moving averages of the generator weights saved with generator_ema [False]")
+  flags.DEFINE_boolean("dynamic_depth", False, "True if the checkpoint was trained with dynamic_depth or progressive [False]")
+  flags.DEFINE_string("export_format", "pb", "pb for a frozen graph, npz for a NumPy weight archive [pb]")
+  flags.DEFINE_string("export_path", "generator.pb", "Path of the exported generator [generator.pb]")
+  tf.app.run()
@@ -0,0 +1,164 @@
+"""
+Offline batch generation from a trained generator into sharded uint8 arrays
+
+    $ python generate.py --dataset celebA --num_samples=1000000 --mode=slerp --output_dir=generated
+
+Shard k holds the images of samples [k * shard_size, (k + 1) * shard_size)
+as a uint8 `shard_<k>.npy` (plus `shard_<k>_labels.npy` for mnist). Its
+latents come from a RandomState seeded with (seed, k), so a shard is the
+same whichever run writes it. `index.json` lists the finished shards and
+a rerun skips them.
+"""
+from __future__ import division
+import os
+import json
+import time
+import numpy as np
+import tensorflow as tf
+from six.moves import xrange
+
+from inference import GeneratorEngine
+from utils import one_hot
+
+def lerp(a, b, t):
+  return (1. - t) * a + t * b
+
+def slerp(a, b, t):
+  """Spherical interpolation between rows of `a` and `b` at fractions `t`.
+
+  a, b: [pairs, 1, z_dim] and t: [1, steps, 1]. Falls back to `lerp` for
+  (anti)parallel anchors.
+  """
+  a_unit = a / np.linalg.norm(a, axis=-1, keepdims=True)
+  b_unit = b / np.linalg.norm(b, axis=-1, keepdims=True)
+  omega = np.arccos(np.clip(np.sum(a_unit * b_unit, axis=-1, keepdims=True), -1., 1.))
+  sin_omega = np.sin(omega)
+  safe = np.abs(sin_omega) > 1e-6
+  sin_omega = np.where(safe, sin_omega, 1.)
+  interpolated = (np.sin((1. - t) * omega) * a + np.sin(t * omega) * b) / sin_omega
+  return np.where(safe, interpolated, lerp(a, b, t))
+
+def shard_latents(rng, num, z_dim, y_dim=None, mode='random',
+                  interp_steps=8, label=-1):
+  """Returns (z, labels) for one shard; labels is None without y_dim.
+
+  In lerp/slerp mode, consecutive runs of `interp_steps` samples move
+  between two random anchors, and share one class label.
+  """
+  if mode == 'random':
+    z = rng.uniform(-1, 1, [num, z_dim])
+    group = 1
+  else:
+    pairs = int(np.ceil(num / interp_steps))
+    a = rng.uniform(-1, 1, [pairs, 1, z_dim])
+    b = rng.uniform(-1, 1, [pairs, 1, z_dim])
+    t = np.linspace(0., 1., interp_steps)[None, :, None]
+    z = (slerp if mode == 'slerp' else lerp)(a, b, t).reshape(-1, z_dim)[:num]
+    group = interp_steps
+
+  labels = None
+  if y_dim:
+    if label >= 0:
+      labels = np.full([num], label, dtype=np.int8)
+    else:
+      groups = rng.randint(y_dim, size=int(np.ceil(num / group)))
+      labels = np.repeat(groups, group)[:num].astype(np.int8)
+  return z.astype(np.float32), labels
+
+def to_uint8(images, y_dim=None):
+  # the conditional generator ends in a sigmoid, the others in a tanh
+  if y_dim:
+    images = images * 255.
+  else:
+    images = (images + 1.) * 127.5
+  return np.round(images).clip(0, 255).astype(np.uint8)
+
+def write_json(path, value):
+  with open(path + '.tmp', 'w') as json_f:
+    json.dump(value, json_f, indent=2, sort_keys=True)
+  os.rename(path + '.tmp', path)
+
+def generate_shards(engine, output_dir, num_samples, shard_size=10000, seed=0,
+                    mode='random', interp_steps=8, label=-1):
+  if not os.path.exists(output_dir):
+    os.makedirs(output_dir)
+  index_path = os.path.join(output_dir, 'index.json')
+  settings = {'num_samples': num_samples, 'shard_size': shard_size, 'seed': seed,
+              'mode': mode, 'interp_steps': interp_steps, 'label': label}
+  if os.path.exists(index_path):
+    with open(index_path) as index_f:
+      index = json.load(index_f)
+    if index['settings'] != settings:
+      raise ValueError("%s was generated with different settings: %s"
+                       % (output_dir, index['settings']))
+  else:
+    index = {'settings': settings, 'shards': {}}
+
+  num_shards = int(np.ceil(num_samples / shard_size))
+  generated, start_time = 0, time.time()
+  for shard in xrange(num_shards):
+    name = 'shard_%05d' % shard
+    entry = index['shards'].get(name)
+    if entry and os.path.exists(os.path.join(output_dir, entry['images'])):
+      continue
+
+    shard_start_time = time.time()
+    num = min(shard_size, num_samples - shard * shard_size)
+    rng = np.random.RandomState([seed, shard])
+    z, labels = shard_latents(rng, num, engine.z_dim, engine.y_dim,
+                              mode, interp_steps, label)
+    y = one_hot(labels, engine.y_dim) if labels is not None else None
+    images = to_uint8(engine.generate(z, y), engine.y_dim)
+
+    entry = {'images': name + '.npy', 'count': num, 'shape': list(images.shape)}
+    np.save(os.path.join(output_dir, name + '.tmp.npy'), images)
+    os.rename(os.path.join(output_dir, name + '.tmp.npy'),
+              os.path.join(output_dir, entry['images']))
+    if labels is not None:
+      entry['labels'] = name + '_labels.npy'
+      np.save(os.path.join(output_dir, entry['labels']), labels)
+    index['shards'][name] = entry
+    write_json(index_path, index)
+
+    generated += num
+    print(" [*] %s: %d images, %.1f images/sec (overall %.1f images/sec)" % (
+      name, num, num / (time.time() - shard_start_time),
+      generated / (time.time() - start_time)))
+  return index
+
+FLAGS = tf.app.flags.FLAGS
+
+def main(_):
+  y_dim = 10 if FLAGS.dataset == 'mnist' else None
+  c_dim = 1 if FLAGS.dataset == 'mnist' else FLAGS.c_dim
+  engine = GeneratorEngine(FLAGS.checkpoint_dir, FLAGS.dataset,
+                           batch_size=FLAGS.batch_size,
+                           output_height=FLAGS.output_height,
+                           output_width=FLAGS.output_width,
+                           y_dim=y_dim, c_dim=c_dim,
+                           sample_ema=FLAGS.sample_ema,
+                           dynamic_depth=FLAGS.dynamic_depth,
+                           micro_batch_size=FLAGS.micro_batch_size)
+  generate_shards(engine, FLAGS.output_dir, FLAGS.num_samples,
+                  shard_size=FLAGS.shard_size, seed=FLAGS.seed, mode=FLAGS.mode,
+                  interp_steps=FLAGS.interp_steps, label=FLAGS.label)
+
+if __name__ == '__main__':
+  flags = tf.app.flags
+  flags.DEFINE_string("dataset", "celebA", "The name of the dataset the checkpoint was trained on [celebA]")
+  flags.DEFINE_string("checkpoint_dir", "checkpoint", "Directory name the checkpoints were saved to [checkpoint]")
+  flags.DEFINE_integer("batch_size", 64, "The batch size the checkpoint was trained with [64]")
+  flags.DEFINE_integer("output_height", 64, "The size of the output images [64]")
+  flags.DEFINE_integer("output_width", None, "The size of the output images. If None, same value as output_height [None]")
+  flags.DEFINE_integer("c_dim", 3, "Dimension of image color [3]")
+  flags.DEFINE_boolean("sample_ema", False, "True to use the moving averages of the generator weights saved with generator_ema [False]")
+  flags.DEFINE_boolean("dynamic_depth", False, "True if the checkpoint was trained with dynamic_depth or progressive [False]")
+  flags.DEFINE_integer("num_samples", 100000, "Number of images to generate [100000]")
+  flags.DEFINE_integer("shard_size", 10000, "Number of images per shard [10000]")
+  flags.DEFINE_integer("micro_batch_size", 1024, "Number of images per sampler run [1024]")
+  flags.DEFINE_integer("seed", 0, "Seed of the latents; shard k uses (seed, k) [0]")
+  flags.DEFINE_string("mode", "random", "random, lerp or slerp between random anchors [random]")
+  flags.DEFINE_integer("interp_steps", 8, "Samples per interpolation in lerp/slerp mode [8]")
+  flags.DEFINE_integer("label", -1, "Class of the conditional mnist samples, -1 for random [-1]")
+  flags.DEFINE_string("output_dir", "generated", "Directory of the shards and index.json [generated]")
+  tf.app.run()
@@ -0,0 +1,82 @@
+"""
+Generator-only inference for trained DCGAN checkpoints
+"""
+from __future__ import division
+import time
+import numpy as np
+import tensorflow as tf
+from six.moves import xrange
+
+from model import DCGAN
+
+class GeneratorEngine(object):
+  """Restores only the generator of a checkpoint and samples from it.
+
+  No dataset is read and neither the discriminator nor the losses are
+  built. `batch_size` and `dataset_name` only locate the checkpoint
+  directory (see `DCGAN.model_dir`). With `compute_dtype=tf.float16` the
+  generator runs in half precision from the float32 checkpoint. With
+  `sample_ema`, the moving averages of the generator weights (see the
+  generator_ema flag) are restored in place of the weights. A model
+  trained with `--dynamic_depth` or `--progressive` needs `dynamic_depth`.
+  """
+  def __init__(self, checkpoint_dir, dataset_name, batch_size=64,
+               output_height=64, output_width=None, y_dim=None, z_dim=100,
+               gf_dim=64, gfc_dim=1024, c_dim=3, micro_batch_size=256,
+               session_config=None, compute_dtype=tf.float32, sample_ema=False,
+               dynamic_depth=False):
+    start_time = time.time()
+    self.micro_batch_size = micro_batch_size
+
+    self.graph = tf.Graph()
+    with self.graph.as_default():
+      self.sess = tf.Session(config=session_config)
+      self.model = DCGAN(
+          self.sess,
+          batch_size=batch_size,
+          output_height=output_height,
+          output_width=output_width or output_height,
+          y_dim=y_dim,
+          z_dim=z_dim,
+          gf_dim=gf_dim,
+          gfc_dim=gfc_dim,
+          c_dim=c_dim,
+          dataset_name=dataset_name,
+          inference_only=True,
+          compute_dtype=compute_dtype,
+          sample_ema=sample_ema,
+          dynamic_depth=dynamic_depth)
+      could_load, self.counter = self.model.load(checkpoint_dir)
+    if not could_load:
+      self.sess.close()
+      raise Exception("[!] Train a model first, then run inference")
+    print(" [*] Generator ready in %.2fs" % (time.time() - start_time))
+
+  @property
+  def z_dim(self):
+    return self.model.z_dim
+
+  @property
+  def y_dim(self):
+    return self.model.y_dim
+
+  def generate(self, z, y=None, micro_batch_size=None):
+    """Returns the images generated from the rows of `z` (and one-hot `y`).
+
+    The rows are fed `micro_batch_size` at a time; the sampler accepts any
+    batch size, so the last micro-batch is not padded.
+    """
+    micro_batch_size = micro_batch_size or self.micro_batch_size
+    if self.y_dim and y is None:
+      raise ValueError("y is required by a conditional generator")
+
+    samples = []
+    for start in xrange(0, len(z), micro_batch_size):
+      feed_dict = {self.model.z: z[start:start+micro_batch_size]}
+      if self.y_dim:
+        feed_dict[self.model.y] = y[start:start+micro_batch_size]
+      samples.append(self.sess.run(self.model.sampler, feed_dict=feed_dict))
+    return np.concatenate(samples)
+
+  def close(self):
+    self.sess.close()
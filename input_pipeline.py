@@ -0,0 +1,245 @@
+"""
+Background image decoding and dataset caching for DCGAN.train
+"""
+from __future__ import division
+import os
+import json
+import hashlib
+import threading
+import multiprocessing
+import numpy as np
+from six.moves import queue
+
+from utils import get_image, get_image_uint8
+
+def process_pool(num_workers):
+  """Returns a `multiprocessing.Pool` whose workers are not forked from
+  this process.
+
+  Once a TF session exists, a fork copies its threads and locks into the
+  child in an undefined state. The workers are started by a forkserver,
+  or spawned where there is none; Python 2 has neither and forks.
+  """
+  if not hasattr(multiprocessing, 'get_context'):
+    return multiprocessing.Pool(num_workers)
+  try:
+    context = multiprocessing.get_context('forkserver')
+  except ValueError:
+    context = multiprocessing.get_context('spawn')
+  return context.Pool(num_workers)
+
+def load_batch(batch_files, input_height, input_width,
+               resize_height=64, resize_width=64,
+               crop=True, grayscale=False):
+  batch = [
+      get_image(batch_file,
+                input_height=input_height,
+                input_width=input_width,
+                resize_height=resize_height,
+                resize_width=resize_width,
+                crop=crop,
+                grayscale=grayscale) for batch_file in batch_files]
+  if grayscale:
+    return np.array(batch).astype(np.float32)[:, :, :, None]
+  else:
+    return np.array(batch).astype(np.float32)
+
+def _load_batch(args):
+  batch_files, kwargs = args
+  return load_batch(batch_files, **kwargs)
+
+def _load_batch_uint8(args):
+  batch_files, kwargs = args
+  batch = np.array([get_image_uint8(batch_file, **kwargs)
+                    for batch_file in batch_files], dtype=np.uint8)
+  if kwargs.get('grayscale'):
+    batch = batch[:, :, :, None]
+  return batch
+
+def normalize_batch(batch, out=None):
+  """Maps a uint8 batch to the [-1, 1] float32 range used by `transform`.
+
+  With `out`, the result is written there instead of a new array.
+  """
+  if out is None:
+    return batch.astype(np.float32) / np.float32(127.5) - np.float32(1.)
+  np.multiply(batch, np.float32(1. / 127.5), out=out, dtype=np.float32)
+  np.subtract(out, np.float32(1.), out=out)
+  return out
+
+def cache_header(files, input_height, input_width,
+                 resize_height=64, resize_width=64,
+                 crop=True, grayscale=False):
+  files_hash = hashlib.sha1()
+  for path in files:
+    files_hash.update(path.encode('utf-8'))
+    files_hash.update(b'\0')
+  return {
+    'num_files': len(files),
+    'files_sha1': files_hash.hexdigest(),
+    'input_height': input_height,
+    'input_width': input_width,
+    'resize_height': resize_height,
+    'resize_width': resize_width,
+    'crop': bool(crop),
+    'grayscale': bool(grayscale),
+  }
+
+def compile_dataset(files, cache_path, batch_size=256, num_workers=4, **kwargs):
+  """Writes every transformed image of `files` into one uint8 .npy file.
+
+  The array is memory-mapped, so training can take zero-copy slices of it.
+  A `<cache_path>.json` header records what the cache was built from.
+  """
+  if not files:
+    raise ValueError("no files to compile into %s" % cache_path)
+  header = cache_header(files, **kwargs)
+  num_batches = int(np.ceil(len(files) / batch_size))
+  tasks = [(files[idx*batch_size:(idx+1)*batch_size], kwargs)
+           for idx in range(num_batches)]
+
+  pool = process_pool(max(num_workers, 1))
+  try:
+    data = None
+    offset = 0
+    for batch in pool.imap(_load_batch_uint8, tasks):
+      if data is None:
+        shape = (len(files),) + batch.shape[1:]
+        data = np.lib.format.open_memmap(
+          cache_path + '.tmp', mode='w+', dtype=np.uint8, shape=shape)
+      data[offset:offset+len(batch)] = batch
+      offset += len(batch)
+      print(" [*] Compiled %d/%d images" % (offset, len(files)))
+    data.flush()
+    del data
+  finally:
+    pool.terminate()
+    pool.join()
+
+  os.rename(cache_path + '.tmp', cache_path)
+  header['shape'] = list((len(files),) + batch.shape[1:])
+  with open(cache_path + '.json', 'w') as header_f:
+    json.dump(header, header_f, indent=2, sort_keys=True)
+
+def load_dataset_cache(files, cache_path, **kwargs):
+  """Returns the memory-mapped cache, or None when it is missing or stale."""
+  header_path = cache_path + '.json'
+  if not (os.path.exists(cache_path) and os.path.exists(header_path)):
+    return None
+  with open(header_path) as header_f:
+    header = json.load(header_f)
+  shape = header.pop('shape', None)
+  if header != cache_header(files, **kwargs):
+    print(" [!] Dataset cache %s is stale" % cache_path)
+    return None
+  data = np.load(cache_path, mmap_mode='r')
+  if list(data.shape) != shape:
+    return None
+  return data
+
+class BatchPrefetcher(object):
+  """Decodes batches of image files in a process pool.
+
+  A feeder thread submits one task per batch and keeps at most `prefetch`
+  of them in flight, so batches come back in order while the main thread
+  is busy in `sess.run`. A `pool` passed in is shared and left running by
+  `close`; otherwise one of `num_workers` processes is started.
+  """
+  def __init__(self, files, batch_size, num_batches, num_workers=4,
+               prefetch=8, pool=None, **kwargs):
+    self.files = files
+    self.batch_size = batch_size
+    self.num_batches = num_batches
+    self.kwargs = kwargs
+
+    self.own_pool = pool is None
+    self.pool = process_pool(num_workers) if pool is None else pool
+    self.pending = queue.Queue(maxsize=max(prefetch, 1))
+    self.stopped = threading.Event()
+
+    self.thread = threading.Thread(target=self._feed)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _feed(self):
+    for idx in range(self.num_batches):
+      if self.stopped.is_set():
+        break
+      batch_files = self.files[idx*self.batch_size:(idx+1)*self.batch_size]
+      result = self.pool.apply_async(_load_batch, ((batch_files, self.kwargs),))
+      while not self.stopped.is_set():
+        try:
+          self.pending.put(result, timeout=0.1)
+          break
+        except queue.Full:
+          pass
+
+  def __iter__(self):
+    for _ in range(self.num_batches):
+      yield self.pending.get().get()
+
+  def close(self):
+    self.stopped.set()
+    self.thread.join()
+    if self.own_pool:
+      self.pool.terminate()
+      self.pool.join()
+
+class FeedBuffers(object):
+  """A ring of preallocated host arrays that batches are written into.
+
+  TF may alias the memory of a fed array in the tensor it makes of it, so
+  an array is only handed out again after `size` others, once the batch
+  it held has left the input queue.
+  """
+  def __init__(self, shape, size, dtype=np.float32):
+    self.arrays = [np.empty(shape, dtype=dtype) for _ in range(size)]
+    self.idx = 0
+
+  def next(self):
+    array = self.arrays[self.idx]
+    self.idx = (self.idx + 1) % len(self.arrays)
+    return array
+
+class QueueFeeder(object):
+  """Calls `enqueue` on every batch of `batches` from a background thread.
+
+  An error in the thread runs `close`, which should cancel the queue so
+  the consumer is not left waiting; `join` re-raises it.
+  """
+  def __init__(self, batches, enqueue, close):
+    self.batches = batches
+    self.enqueue = enqueue
+    self.close_queue = close
+    self.stopped = False
+    self.error = None
+
+    self.thread = threading.Thread(target=self._feed)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _feed(self):
+    try:
+      for batch in self.batches:
+        self.enqueue(batch)
+    except Exception as e:
+      if not self.stopped:
+        self.error = e
+        self.close_queue()
+
+  def join(self):
+    self.thread.join()
+    if self.error is not None:
+      error, self.error = self.error, None
+      raise error
+
+  def close(self):
+    """Cancels the batches still to be enqueued and waits for the thread.
+
+    The queue may be closed for good, so only call this when no more
+    batches will be dequeued from it; `join` waits for a finished feed.
+    """
+    if self.thread.is_alive():
+      self.stopped = True
+      self.close_queue()
+    self.join()
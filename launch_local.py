@@ -0,0 +1,79 @@
+"""
+Runs a distributed training cluster as local processes, for testing
+
+    $ python launch_local.py --num_ps=1 --num_workers=2 -- --dataset mnist --input_height=28 --output_height=28 --train
+
+Starts `num_ps` parameter servers and `num_workers` workers of main.py on
+consecutive ports from `--port`, passing the arguments after `--` to every
+task. Worker output goes to logs/worker_<i>.log, except the chief's, which
+is shown. The parameter servers are stopped once all workers exit, and
+the other tasks as soon as a worker fails.
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--num_ps', type=int, default=1)
+  parser.add_argument('--num_workers', type=int, default=2)
+  parser.add_argument('--port', type=int, default=2222)
+  parser.add_argument('main_args', nargs=argparse.REMAINDER)
+  args = parser.parse_args()
+  main_args = [arg for arg in args.main_args if arg != '--']
+
+  ps_hosts = ['localhost:%d' % (args.port + idx) for idx in range(args.num_ps)]
+  worker_hosts = ['localhost:%d' % (args.port + args.num_ps + idx)
+                  for idx in range(args.num_workers)]
+  main_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+  cluster_args = ['--ps_hosts=%s' % ','.join(ps_hosts),
+                  '--worker_hosts=%s' % ','.join(worker_hosts)]
+  if not os.path.exists('logs'):
+    os.makedirs('logs')
+
+  logs = []
+  def start(job_name, task_index, log_name=None):
+    cmd = [sys.executable, main_py, '--job_name=%s' % job_name,
+           '--task_index=%d' % task_index] + cluster_args + main_args
+    # the parameter servers need no GPU
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='') if job_name == 'ps' else None
+    stdout = None
+    if log_name is not None:
+      stdout = open(os.path.join('logs', log_name), 'w')
+      logs.append(stdout)
+    return subprocess.Popen(cmd, stdout=stdout, stderr=subprocess.STDOUT, env=env)
+
+  ps, workers = [], []
+  try:
+    for idx in range(args.num_ps):
+      ps.append(start('ps', idx, 'ps_%d.log' % idx))
+    workers.append(start('worker', 0))
+    for idx in range(1, args.num_workers):
+      workers.append(start('worker', idx, 'worker_%d.log' % idx))
+    # Poll rather than wait: when the chief dies before initializing the
+    # model, the other workers wait for it forever.
+    while True:
+      returncodes = [worker.poll() for worker in workers]
+      if all(code is not None for code in returncodes) or \
+          any(code not in (None, 0) for code in returncodes):
+        break
+      time.sleep(1)
+  finally:
+    for process in ps + workers:
+      if process.poll() is None:
+        process.terminate()
+    for process in ps + workers:
+      process.wait()
+    for log in logs:
+      log.close()
+  # the first failure; a worker killed by signal N has returncode -N,
+  # reported like a shell does
+  failed = [code for code in returncodes if code not in (None, 0)]
+  if failed:
+    sys.exit(failed[0] if failed[0] > 0 else 128 - failed[0])
+
+if __name__ == '__main__':
+  main()
@@ -1,9 +1,10 @@
 import os
+import time
 import scipy.misc
 import numpy as np
 
 from model import DCGAN
-from utils import pp, visualize, to_json, show_all_variables
+from utils import pp, visualize, to_json, to_binary, show_all_variables
 
 import tensorflow as tf
 
@@ -18,6 +19,22 @@ flags.DEFINE_integer("input_width", None, "The size of image to use (will be cen
 flags.DEFINE_integer("output_height", 64, "The size of the output images to produce [64]")
 flags.DEFINE_integer("output_width", None, "The size of the output images to produce. If None, same value as output_height [None]")
 flags.DEFINE_integer("visualize_option",1,"The method use to visualize")
+flags.DEFINE_string("visualize_format", "gif", "Animation format of visualize options 2-4, gif or mp4 [gif]")
+flags.DEFINE_integer("visualize_batch_size", 1024, "Number of images generated per sampler run when visualizing [1024]")
+flags.DEFINE_integer("log_interval", 1, "Print the losses every log_interval steps; other steps fetch no loss [1]")
+flags.DEFINE_boolean("async_checkpoint", True, "True to write checkpoints from a background thread after a quick in-memory snapshot [True]")
+flags.DEFINE_integer("checkpoint_steps", 500, "Save a checkpoint every checkpoint_steps steps, 0 to disable [500]")
+flags.DEFINE_integer("checkpoint_secs", 0, "Save a checkpoint every checkpoint_secs seconds, 0 to disable [0]")
+flags.DEFINE_integer("checkpoint_keep", 5, "Number of most recent checkpoints to keep, at least 1 as training resumes from the latest [5]")
+flags.DEFINE_integer("checkpoint_keep_best", 0, "Number of checkpoints with the lowest checkpoint_metric to keep as well [0]")
+flags.DEFINE_string("checkpoint_metric", "g_loss", "Last logged loss or evaluation result ranking the kept-best checkpoints, d_loss, g_loss or fid [g_loss]")
+flags.DEFINE_string("generator_checkpoint_dir", "", "If set, also save the generator variables alone there for serving [\"\"]")
+flags.DEFINE_integer("scalar_summary_interval", 10, "Record the loss scalar summaries every scalar_summary_interval steps, 0 to disable [10]")
+flags.DEFINE_integer("histogram_summary_interval", 500, "Record the histogram and image summaries every histogram_summary_interval steps, 0 to disable [500]")
+flags.DEFINE_integer("profile_interval", 100, "Print and summarize p50/p95/p99 of each training phase every profile_interval steps, 0 to disable [100]")
+flags.DEFINE_integer("profile_window", 1000, "Number of recent steps the phase percentiles are computed over [1000]")
+flags.DEFINE_integer("trace_step", -1, "Write Chrome traces of trace_num_steps steps from this step on, to logs/timeline; SIGUSR1 also starts a trace [-1]")
+flags.DEFINE_integer("trace_num_steps", 3, "Number of steps traced per trace request [3]")
 flags.DEFINE_string("dataset", "celebA", "The name of dataset [celebA, mnist, lsun]")
 flags.DEFINE_string("input_fname_pattern", "*.jpg", "Glob pattern of filename of input images [*]")
 flags.DEFINE_string("checkpoint_dir", "checkpoint", "Directory name to save the checkpoints [checkpoint]")
@@ -25,11 +42,145 @@ flags.DEFINE_string("sample_dir", "samples", "Directory name to save the image s
 flags.DEFINE_boolean("train", False, "True for training, False for testing [False]")
 flags.DEFINE_boolean("crop", False, "True for training, False for testing [False]")
 flags.DEFINE_boolean("visualize", False, "True for visualizing, False for nothing [False]")
+flags.DEFINE_boolean("generator_only", False, "True to build and restore only the generator when testing, without reading the dataset [False]")
+flags.DEFINE_integer("c_dim", 3, "Dimension of image color of the checkpoint, used with generator_only [3]")
 flags.DEFINE_boolean("W_GAN",True,"True use W-GAN,false use DC-GAN")
 flags.DEFINE_integer("CRITIC_NUM",5,"CRITIC_NUM of W-GAN")
 flags.DEFINE_integer("LAMBDA",10,"LAMBDA of W-GAN")
+flags.DEFINE_boolean("fused_critic", False, "True to run the CRITIC_NUM critic updates and the generator update of W-GAN in one session call, each critic update on a fresh batch [False]")
+flags.DEFINE_boolean("mixed_precision", False, "True to compute in float16 with float32 weights and dynamic loss scaling; also applies to the sampler when testing [False]")
+flags.DEFINE_float("loss_scale_init", 2.**15, "Initial loss scale of mixed precision training [32768]")
+flags.DEFINE_integer("loss_scale_period", 1000, "Double the loss scale after this many steps without overflow [1000]")
+flags.DEFINE_integer("num_towers", 1, "Number of data-parallel replicas of G and D, each on its own device and slice of the batch [1]")
+flags.DEFINE_string("tower_device", "gpu", "Device type of the towers, gpu or cpu; cpu towers run on as many CPU devices [gpu]")
+flags.DEFINE_string("job_name", "", "Distributed training: ps or worker; empty trains on this process alone [\"\"]")
+flags.DEFINE_integer("task_index", 0, "Distributed training: index of this task within its job, worker 0 is the chief [0]")
+flags.DEFINE_string("ps_hosts", "localhost:2222", "Distributed training: comma separated host:port of the parameter servers [localhost:2222]")
+flags.DEFINE_string("worker_hosts", "localhost:2223", "Distributed training: comma separated host:port of the workers [localhost:2223]")
+flags.DEFINE_boolean("dynamic_depth", False, "True to give the unconditional G and D one stride-2 stage per doubling of the output size above 4x4 (at least four) instead of four; implied by progressive [False]")
+flags.DEFINE_string("export_web", "", "float32, float16 or int8 to write the generator to web/js/layers.{bin,json} for the web demo after training or loading it, empty to skip [\"\"]")
+flags.DEFINE_boolean("progressive", False, "True to grow G and D one stride-2 stage at a time, from progressive_start_height up to output_height [False]")
+flags.DEFINE_integer("progressive_start_height", 16, "Output height of the first progressive stage [16]")
+flags.DEFINE_integer("progressive_steps", 20000, "Training steps of every progressive stage but the last; the new layers fade in over the first half [20000]")
+flags.DEFINE_float("generator_ema", 0., "Decay of an exponential moving average of the generator weights kept in training and checkpointed, e.g. 0.999; 0 to disable [0]")
+flags.DEFINE_boolean("sample_ema", False, "True to sample, visualize and export with the generator weight averages of generator_ema instead of the weights [False]")
+flags.DEFINE_integer("eval_interval", 0, "Compute the FID (and Inception score) in the background every eval_interval steps, 0 to disable [0]")
+flags.DEFINE_integer("eval_samples", 10000, "Number of generated and of real images the FID is computed over [10000]")
+flags.DEFINE_integer("eval_batch_size", 100, "Number of images per sampler and feature network run when evaluating [100]")
+flags.DEFINE_string("eval_graph", "", "Frozen GraphDef of the feature network, e.g. Inception's classify_image_graph_def.pb; empty uses a fixed random conv net [\"\"]")
+flags.DEFINE_string("eval_input_tensor", "ExpandDims:0", "Image input tensor of eval_graph [ExpandDims:0]")
+flags.DEFINE_string("eval_feature_tensor", "pool_3:0", "Feature tensor of eval_graph the FID is computed on [pool_3:0]")
+flags.DEFINE_string("eval_logits_tensor", "softmax/logits:0", "Class logits tensor of eval_graph for the Inception score, empty to skip it (its dense layer is re-applied to the batch of features) [softmax/logits:0]")
+flags.DEFINE_integer("eval_input_size", 299, "Height and width the images are resized to for eval_graph [299]")
+flags.DEFINE_integer("eval_threads", 2, "Number of CPU threads of the feature network [2]")
+flags.DEFINE_string("input_mode", "feed", "How batches reach the graph: feed (every session run feeds the batch and z) or queue (a background thread enqueues preallocated batches, dequeued once per step, and z is sampled in the graph) [feed]")
+flags.DEFINE_integer("num_workers", 0, "Number of processes decoding training images, 0 decodes on the main thread [0]")
+flags.DEFINE_integer("prefetch_batches", 8, "Number of decoded batches to keep ready ahead of training [8]")
+flags.DEFINE_integer("index_workers", 8, "Number of threads listing and decoding files when updating the dataset index [8]")
+flags.DEFINE_boolean("reindex_dataset", False, "True to rescan and re-decode every file of the dataset index instead of only the changed directories [False]")
+flags.DEFINE_boolean("cache_dataset", False, "True to train from a memory-mapped cache of the transformed images, built on first use [False]")
+flags.DEFINE_boolean("compile_dataset", False, "True to build the dataset cache if it is missing or stale, then exit [False]")
 FLAGS = flags.FLAGS
 
+def build_dcgan(sess, inference_only=False, stage=None, fade_in=None):
+  if FLAGS.dataset == 'mnist':
+    return DCGAN(
+        sess,
+        input_width=FLAGS.input_width,
+        input_height=FLAGS.input_height,
+        output_width=FLAGS.output_width,
+        output_height=FLAGS.output_height,
+        batch_size=FLAGS.batch_size,
+        sample_num=FLAGS.batch_size,
+        y_dim=10,
+        c_dim=1,
+        dataset_name=FLAGS.dataset,
+        input_fname_pattern=FLAGS.input_fname_pattern,
+        crop=FLAGS.crop,
+        checkpoint_dir=FLAGS.checkpoint_dir,
+        sample_dir=FLAGS.sample_dir,
+        FLAGS=FLAGS,
+        inference_only=inference_only)
+  return DCGAN(
+      sess,
+      input_width=FLAGS.input_width,
+      input_height=FLAGS.input_height,
+      output_width=FLAGS.output_width,
+      output_height=FLAGS.output_height,
+      batch_size=FLAGS.batch_size,
+      sample_num=FLAGS.batch_size,
+      c_dim=FLAGS.c_dim,
+      dataset_name=FLAGS.dataset,
+      input_fname_pattern=FLAGS.input_fname_pattern,
+      crop=FLAGS.crop,
+      checkpoint_dir=FLAGS.checkpoint_dir,
+      sample_dir=FLAGS.sample_dir,
+      FLAGS=FLAGS,
+      inference_only=inference_only,
+      stage=stage,
+      fade_in=fade_in)
+
+def train_progressive(run_config):
+  """Trains every progressive stage in its own graph and session.
+
+  Each stage starts from the checkpoint of the previous one (or resumes
+  its own) and stops after its steps, so an interrupted run picks up at
+  the stage it was in. The final stage fades its layers in with a graph of
+  its own, then trains for the epochs without the blend.
+  """
+  if FLAGS.dataset == 'mnist':
+    raise ValueError("progressive training needs an unconditional model")
+  if FLAGS.job_name:
+    raise ValueError("progressive training is not supported in distributed mode")
+
+  # the stage layout only needs the model's hyperparameters
+  with tf.Graph().as_default():
+    dcgan = build_dcgan(None, inference_only=True)
+    first_stage, num_stages = dcgan.first_stage, dcgan.num_stages
+
+  phases = [(stage, None) for stage in range(first_stage, num_stages)]
+  if first_stage < num_stages:
+    # both phases of the final stage share its checkpoints: a run resumed
+    # past the fade goes on without the blend
+    with tf.Graph().as_default():
+      dcgan = build_dcgan(None, inference_only=True, stage=num_stages, fade_in=True)
+      _, fade_end = dcgan.stage_steps()
+      _, counter = dcgan.load(FLAGS.checkpoint_dir, restore=False)
+    if counter < fade_end:
+      phases.append((num_stages, True))
+  phases.append((num_stages, False))
+  for stage, fade_in in phases:
+    with tf.Graph().as_default():
+      with tf.Session(config=run_config) as sess:
+        dcgan = build_dcgan(sess, stage=stage, fade_in=fade_in)
+        print(" [*] Progressive stage %d/%d: %dx%d%s" % (
+          stage, num_stages, dcgan.stage_height, dcgan.stage_width,
+          ", fading in" if dcgan.fade_in else ""))
+        show_all_variables()
+        dcgan.train(FLAGS)
+        if stage == num_stages and not fade_in:
+          visualize(sess, dcgan, FLAGS, FLAGS.visualize_option)
+
+def export_web(dcgan, dtype):
+  """Writes the generator to web/js/layers.{bin,json}, which web/js/app.js
+  loads into its fixed 64x64 RGB network of four stages."""
+  if dcgan.y_dim or dcgan.num_stages != 4 or dcgan.c_dim != 3 or \
+      (dcgan.output_height, dcgan.output_width) != (64, 64):
+    raise ValueError("the web demo needs an unconditional 64x64 RGB generator "
+                     "of four stages")
+  # by name: dcgan.h*_w may hold the moving averages or evaluation copies
+  variables = dict((var.op.name, var) for var in tf.global_variables())
+  def layer(idx, bn):
+    if idx == 0:
+      scope = 'generator/g_h0_lin'
+      return [variables[scope + '/Matrix'], variables[scope + '/bias'], bn]
+    scope = 'generator/g_h%d' % idx
+    return [variables[scope + '/w'], variables[scope + '/biases'], bn]
+  to_binary("./web/js/layers.bin", layer(0, dcgan.g_bn0), layer(1, dcgan.g_bn1),
+            layer(2, dcgan.g_bn2), layer(3, dcgan.g_bn3), layer(4, None),
+            dtype=dtype)
+  print(" [*] Wrote ./web/js/layers.bin and ./web/js/layers.json (%s)" % dtype)
+
 def main(_):
   pp.pprint(flags.FLAGS.__flags)
 
@@ -37,6 +188,11 @@ def main(_):
     FLAGS.input_width = FLAGS.input_height
   if FLAGS.output_width is None:
     FLAGS.output_width = FLAGS.output_height
+  if FLAGS.compile_dataset:
+    FLAGS.cache_dataset = True
+  if FLAGS.export_web not in ('', 'float32', 'float16', 'int8'):
+    raise ValueError("export_web must be float32, float16 or int8, got %s"
+                     % FLAGS.export_web)
 
   if not os.path.exists(FLAGS.checkpoint_dir):
     os.makedirs(FLAGS.checkpoint_dir)
@@ -46,39 +202,39 @@ def main(_):
   #gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=0.333)
   run_config = tf.ConfigProto()
   run_config.gpu_options.allow_growth=True
+  if FLAGS.num_towers > 1:
+    run_config.allow_soft_placement = True
+    if FLAGS.tower_device == 'cpu':
+      run_config.device_count['CPU'] = FLAGS.num_towers
 
-  with tf.Session(config=run_config) as sess:
-    if FLAGS.dataset == 'mnist':
-      dcgan = DCGAN(
-          sess,
-          input_width=FLAGS.input_width,
-          input_height=FLAGS.input_height,
-          output_width=FLAGS.output_width,
-          output_height=FLAGS.output_height,
-          batch_size=FLAGS.batch_size,
-          sample_num=FLAGS.batch_size,
-          y_dim=10,
-          dataset_name=FLAGS.dataset,
-          input_fname_pattern=FLAGS.input_fname_pattern,
-          crop=FLAGS.crop,
-          checkpoint_dir=FLAGS.checkpoint_dir,
-          sample_dir=FLAGS.sample_dir,
-          FLAGS=FLAGS)
-    else:
-      dcgan = DCGAN(
-          sess,
-          input_width=FLAGS.input_width,
-          input_height=FLAGS.input_height,
-          output_width=FLAGS.output_width,
-          output_height=FLAGS.output_height,
-          batch_size=FLAGS.batch_size,
-          sample_num=FLAGS.batch_size,
-          dataset_name=FLAGS.dataset,
-          input_fname_pattern=FLAGS.input_fname_pattern,
-          crop=FLAGS.crop,
-          checkpoint_dir=FLAGS.checkpoint_dir,
-          sample_dir=FLAGS.sample_dir,
-          FLAGS=FLAGS)
+  # Between-graph replication: every worker builds the full model, with
+  # the variables placed on the parameter servers
+  device_fn, target = None, ''
+  if FLAGS.job_name:
+    if FLAGS.num_towers > 1:
+      raise ValueError("num_towers > 1 is not supported in distributed mode")
+    cluster = tf.train.ClusterSpec({'ps': FLAGS.ps_hosts.split(','),
+                                    'worker': FLAGS.worker_hosts.split(',')})
+    server = tf.train.Server(cluster, job_name=FLAGS.job_name,
+                             task_index=FLAGS.task_index, config=run_config)
+    if FLAGS.job_name == 'ps':
+      server.join()
+      return
+    device_fn = tf.train.replica_device_setter(
+      worker_device='/job:worker/task:%d' % FLAGS.task_index, cluster=cluster)
+    target = server.target
+
+  if FLAGS.progressive and FLAGS.train and not FLAGS.compile_dataset:
+    train_progressive(run_config)
+    return
+
+  start_time = time.time()
+  inference_only = FLAGS.generator_only and not FLAGS.train
+  with tf.device(device_fn), tf.Session(target, config=run_config) as sess:
+    dcgan = build_dcgan(sess, inference_only=inference_only)
+
+    if FLAGS.compile_dataset:
+      return
 
     show_all_variables()
 
@@ -87,7 +243,10 @@ def main(_):
     else:
       if not dcgan.load(FLAGS.checkpoint_dir)[0]:
         raise Exception("[!] Train a model first, then run test mode")
-      
+      print(" [*] Model ready in %.2fs" % (time.time() - start_time))
+
+    if FLAGS.export_web:
+      export_web(dcgan, FLAGS.export_web)
 
     # to_json("./web/js/layers.js", [dcgan.h0_w, dcgan.h0_b, dcgan.g_bn0],
     #                 [dcgan.h1_w, dcgan.h1_b, dcgan.g_bn1],
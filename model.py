@@ -2,23 +2,50 @@ from __future__ import division
 import os
 import time
 import math
-from glob import glob
+import itertools
+import contextlib
 import tensorflow as tf
 import numpy as np
 from six.moves import xrange
 
 from ops import *
 from utils import *
+from input_pipeline import load_batch, normalize_batch, BatchPrefetcher, \
+    compile_dataset, load_dataset_cache, cache_header, FeedBuffers, QueueFeeder, \
+    process_pool
+from profiler import StepProfiler
+from checkpoint import AsyncCheckpointer
+from evaluation import FeatureExtractor, Evaluator, reference_path
+from dataset_index import DatasetIndex
 
 def conv_out_size_same(size, stride):
   return int(math.ceil(float(size) / float(stride)))
 
+def stage_sizes(size, num_stages):
+  """Returns the feature map size after each of `num_stages` stride-2
+  stages, from the smallest one to `size`."""
+  sizes = [size]
+  for _ in xrange(num_stages):
+    sizes.insert(0, conv_out_size_same(sizes[0], 2))
+  return sizes
+
+def average_gradients(tower_grads):
+  """Averages lists of (gradient, variable) pairs computed per tower."""
+  average_grads = []
+  for grads_and_vars in zip(*tower_grads):
+    grads = [grad for grad, _ in grads_and_vars]
+    average_grads.append(
+      (tf.add_n(grads) / float(len(grads)), grads_and_vars[0][1]))
+  return average_grads
+
 class DCGAN(object):
   def __init__(self, sess, input_height=108, input_width=108, crop=True,
          batch_size=64, sample_num = 64, output_height=64, output_width=64,
          y_dim=None, z_dim=100, gf_dim=64, df_dim=64,
          gfc_dim=1024, dfc_dim=1024, c_dim=3, dataset_name='default',
-         input_fname_pattern='*.jpg', checkpoint_dir=None, sample_dir=None,FLAGS=None):
+         input_fname_pattern='*.jpg', checkpoint_dir=None, sample_dir=None,FLAGS=None,
+         inference_only=False, compute_dtype=None, stage=None, sample_ema=None,
+         fade_in=None, dynamic_depth=None):
     """
 
     Args:
@@ -31,6 +58,18 @@ class DCGAN(object):
       gfc_dim: (optional) Dimension of gen units for for fully connected layer. [1024]
       dfc_dim: (optional) Dimension of discrim units for fully connected layer. [1024]
       c_dim: (optional) Dimension of image color. For grayscale input, set to 1. [3]
+      inference_only: (optional) Build only the sampler, without reading the dataset. [False]
+      compute_dtype: (optional) Dtype of the activations; the weights stay float32.
+        [tf.float16 with FLAGS.mixed_precision, else tf.float32]
+      stage: (optional) Number of stride-2 stages of G and D to build, for
+        progressive training of the unconditional model. [num_stages]
+      sample_ema: (optional) Sample with the moving averages of the generator
+        weights. [FLAGS.sample_ema]
+      fade_in: (optional) Blend the layers of `stage` in with those of the
+        previous stage, when progressive. [True below the final stage]
+      dynamic_depth: (optional) Give the unconditional G and D one stage per
+        doubling of the output size rather than four.
+        [FLAGS.dynamic_depth or FLAGS.progressive]
     """
     self.sess = sess
     self.crop = crop
@@ -52,325 +91,813 @@ class DCGAN(object):
     self.gfc_dim = gfc_dim
     self.dfc_dim = dfc_dim
 
+    if compute_dtype is None:
+      mixed_precision = FLAGS is not None and FLAGS.mixed_precision
+      compute_dtype = tf.float16 if mixed_precision else tf.float32
+    self.compute_dtype = compute_dtype
+
+    if sample_ema is None:
+      sample_ema = FLAGS is not None and FLAGS.sample_ema
+    self.sample_ema = sample_ema
+    self.g_ema = None
+
+    # G and D have four stride-2 stages. With dynamic depth, the
+    # unconditional ones have one per doubling of the output size above
+    # 4x4, and at least four (the original 64x64 layout). With progressive
+    # training only the first `stage` stages are built, at the size of
+    # `stage_heights[stage]` x `stage_widths[stage]`.
+    if dynamic_depth is None:
+      dynamic_depth = FLAGS is not None and (FLAGS.dynamic_depth or FLAGS.progressive)
+    self.num_stages = 4
+    if dynamic_depth and not self.y_dim:
+      self.num_stages = max(4, int(math.floor(
+        math.log(min(output_height, output_width) / 4., 2))))
+    self.stage = self.num_stages if stage is None else stage
+    self.stage_heights = stage_sizes(output_height, self.num_stages)
+    self.stage_widths = stage_sizes(output_width, self.num_stages)
+    self.stage_height = self.stage_heights[self.stage]
+    self.stage_width = self.stage_widths[self.stage]
+
+    self.progressive = FLAGS is not None and FLAGS.progressive
+    self.first_stage = self.stage
+    if self.progressive:
+      if self.y_dim:
+        raise ValueError("progressive training needs an unconditional model")
+      self.first_stage = min(
+        idx for idx, size in enumerate(self.stage_heights)
+        if size >= FLAGS.progressive_start_height and idx > 0)
+    # Within each stage after the first, the new layers fade in over the
+    # first half of its steps; see alpha_value. The final stage is built
+    # without the blend, which is dead weight once alpha reaches 1, unless
+    # asked for the fade itself (see stage_steps).
+    if fade_in is None:
+      fade_in = self.stage < self.num_stages
+    self.fade_in = fade_in and self.stage > self.first_stage
+    self.alpha_value = 1.
+
     # batch normalization : deals with poor initialization helps gradient flow
     self.d_bn1 = batch_norm(name='d_bn1')
     self.d_bn2 = batch_norm(name='d_bn2')
-
     if not self.y_dim:
-      self.d_bn3 = batch_norm(name='d_bn3')
+      for idx in xrange(3, self.num_stages):
+        setattr(self, 'd_bn%d' % idx, batch_norm(name='d_bn%d' % idx))
 
     self.g_bn0 = batch_norm(name='g_bn0')
     self.g_bn1 = batch_norm(name='g_bn1')
     self.g_bn2 = batch_norm(name='g_bn2')
-
     if not self.y_dim:
-      self.g_bn3 = batch_norm(name='g_bn3')
+      for idx in xrange(3, self.num_stages):
+        setattr(self, 'g_bn%d' % idx, batch_norm(name='g_bn%d' % idx))
 
     self.dataset_name = dataset_name
     self.input_fname_pattern = input_fname_pattern
     self.checkpoint_dir = checkpoint_dir
+    self.inference_only = inference_only
+
+    # Between-graph replicated training, see initialize_variables
+    self.distributed = FLAGS is not None and FLAGS.job_name == 'worker'
+    self.task_index, self.num_tasks = 0, 1
+    if self.distributed:
+      self.task_index = FLAGS.task_index
+      self.num_tasks = len(FLAGS.worker_hosts.split(','))
+    self.is_chief = self.task_index == 0
+
+    if self.inference_only:
+      self.c_dim = c_dim
+      self.grayscale = (self.c_dim == 1)
+      self.build_sampler()
+      return
 
     if self.dataset_name == 'mnist':
       self.data_X, self.data_y = self.load_mnist()
+      self.data_order = np.random.RandomState(547).permutation(
+        len(self.data_X))[self.task_index::self.num_tasks]
       self.c_dim = self.data_X[0].shape[-1]
+    elif self.dataset_name == 'synthetic':
+      # batches are supplied by the caller, see benchmark.py
+      self.c_dim = c_dim
     else:
-      self.data = glob(os.path.join("./data", self.dataset_name, self.input_fname_pattern))
-      imreadImg = imread(self.data[0]);
-      if len(imreadImg.shape) >= 3: #check if image is a non-grayscale image by checking channel number
-        self.c_dim = imread(self.data[0]).shape[-1]
+      self.data_index = DatasetIndex(
+        os.path.join("./data", self.dataset_name), self.input_fname_pattern,
+        os.path.join("./data", "%s.index" % self.dataset_name),
+        num_workers=self.FLAGS.index_workers)
+      if self.is_chief:
+        self.data_index.update(full=self.FLAGS.reindex_dataset)
       else:
-        self.c_dim = 1
+        # only the chief updates the shared index, the others read it
+        self.data_index.wait()
+      # the channels of most images; the others are skipped
+      self.c_dim = self.data_index.channels()
+      self.data = self.dataset_files(update=False)
 
     self.grayscale = (self.c_dim == 1)
 
+    self.data_cache = None
+    self.decode_pool = None
+    if self.dataset_name not in ('mnist', 'synthetic') and self.FLAGS.cache_dataset:
+      cache_name = self.dataset_name
+      if self.stage < self.num_stages:
+        # every progressive stage caches images of its own size
+        cache_name += "_%dx%d" % (self.stage_height, self.stage_width)
+      if self.distributed:
+        cache_name += ".shard%d-of-%d" % (self.task_index, self.num_tasks)
+      cache_path = os.path.join("./data", "%s.cache.npy" % cache_name)
+      self.data_cache = load_dataset_cache(self.data, cache_path, **self.image_kwargs)
+      if self.data_cache is None:
+        print(" [*] Compiling %d images into %s" % (len(self.data), cache_path))
+        compile_dataset(self.data, cache_path,
+                        num_workers=max(self.FLAGS.num_workers, 1),
+                        **self.image_kwargs)
+        self.data_cache = load_dataset_cache(self.data, cache_path, **self.image_kwargs)
+
     self.build_model()
 
-  def build_model(self):
-    if self.y_dim:
-      self.y= tf.placeholder(tf.float32, [self.batch_size, self.y_dim], name='y')
+  def dataset_files(self, update=True):
+    """Returns the valid image files of the dataset, sorted; a worker's
+    disjoint share of them in distributed mode.
 
+    With `update`, the dataset index first picks up the files added,
+    changed or removed since; the workers other than the chief reload
+    the index the chief keeps up to date. Images that do not decode, do not have
+    `c_dim` channels (unless grayscale) or are too small to crop are
+    left out.
+    """
+    if update and self.is_chief:
+      self.data_index.update()
+    elif update:
+      self.data_index.load()
+    min_height, min_width = 0, 0
     if self.crop:
-      image_dims = [self.output_height, self.output_width, self.c_dim]
+      min_height, min_width = self.input_height, self.input_width
+    files = self.data_index.files(
+      channels=self.c_dim if self.c_dim != 1 else None,
+      min_height=min_height, min_width=min_width)
+    if len(files) < len(self.data_index):
+      print(" [!] Skipping %d of %d images that are invalid, have another "
+            "number of channels or are too small" % (
+              len(self.data_index) - len(files), len(self.data_index)))
+    if self.distributed:
+      files = files[self.task_index::self.num_tasks]
+    return files
+
+  def initialize_variables(self):
+    """Initializes the variables or restores the latest checkpoint.
+
+    Returns the step counter to start from. In distributed mode only the
+    chief does so, once per cluster, and then initializes a `model_ready`
+    flag on the parameter servers; the other workers wait for that flag
+    and start from the counter of the latest checkpoint.
+    """
+    if self.distributed:
+      model_ready = tf.Variable(True, trainable=False, collections=[],
+                                name='model_ready')
+      is_ready = tf.is_variable_initialized(model_ready)
+      if not self.is_chief or self.sess.run(is_ready):
+        while not self.sess.run(is_ready):
+          print(" [*] Waiting for the chief to initialize the model...")
+          time.sleep(1)
+        return max(self.load(self.checkpoint_dir, restore=False)[1], 1)
+
+    try:
+      tf.global_variables_initializer().run()
+    except:
+      tf.initialize_all_variables().run()
+
+    counter = 1
+    could_load, checkpoint_counter = self.load(self.checkpoint_dir)
+    if not could_load and self.progressive and self.stage > self.first_stage:
+      could_load, checkpoint_counter = self.load_previous_stage(self.checkpoint_dir)
+    if could_load:
+      counter = checkpoint_counter
+      print(" [*] Load SUCCESS")
+    else:
+      print(" [!] Load failed...")
+
+    if self.distributed:
+      self.sess.run(model_ready.initializer)
+    return counter
+
+  def build_model(self):
+    if self.crop:
+      image_dims = [self.stage_height, self.stage_width, self.c_dim]
     else:
       image_dims = [self.input_height, self.input_width, self.c_dim]
 
-    self.inputs = tf.placeholder(
-      tf.float32, [self.batch_size] + image_dims, name='real_images')
+    # In the queue input mode the real batch, the labels and z default to
+    # the dequeued batch and in-graph noise; feeding them still works.
+    self.input_queue = self.FLAGS.input_mode == 'queue'
+    if self.input_queue:
+      if self.distributed:
+        raise ValueError("input_mode queue is not supported in distributed mode")
+      self.build_input_queue(image_dims)
+      if self.y_dim:
+        self.y = tf.placeholder_with_default(
+          self.input_buffers[1], [None, self.y_dim], name='y')
+      self.inputs = tf.placeholder_with_default(
+        self.input_buffers[0], [self.batch_size] + image_dims, name='real_images')
+      self.z = tf.placeholder_with_default(
+        tf.random_uniform([self.batch_size, self.z_dim], -1., 1.),
+        [None, self.z_dim], name='z')
+    else:
+      if self.y_dim:
+        self.y= tf.placeholder(tf.float32, [None, self.y_dim], name='y')
+      self.inputs = tf.placeholder(
+        tf.float32, [self.batch_size] + image_dims, name='real_images')
+      self.z = tf.placeholder(
+        tf.float32, [None, self.z_dim], name='z')
 
     inputs = self.inputs
-
-    self.z = tf.placeholder(
-      tf.float32, [None, self.z_dim], name='z')
     self.z_sum = histogram_summary("z", self.z)
 
-    if self.y_dim:
-      self.G = self.generator(self.z, self.y)
-      self.D, self.D_logits = \
-          self.discriminator(inputs, self.y, reuse=False)
-
-      self.sampler = self.sampler(self.z, self.y)
-      self.D_, self.D_logits_ = \
-          self.discriminator(self.G, self.y, reuse=True)
+    # Weight of the layers of the newest stage while they fade in
+    self.alpha = None
+    if self.fade_in:
+      self.alpha = tf.placeholder_with_default(1., [], name='alpha')
+
+    # Dynamic loss scaling of float16 training; the scale of D also
+    # applies to the inner gradient of the gradient penalty.
+    self.d_loss_scale = self.g_loss_scale = None
+    if self.compute_dtype == tf.float16:
+      with tf.variable_scope("loss_scale"):
+        with tf.variable_scope("d"):
+          self.d_loss_scale = \
+              tf.contrib.mixed_precision.ExponentialUpdateLossScaleManager(
+                self.FLAGS.loss_scale_init, self.FLAGS.loss_scale_period)
+        with tf.variable_scope("g"):
+          self.g_loss_scale = \
+              tf.contrib.mixed_precision.ExponentialUpdateLossScaleManager(
+                self.FLAGS.loss_scale_init, self.FLAGS.loss_scale_period)
+
+    # Each tower gets an equal slice of the batch; their outputs are
+    # concatenated and their losses averaged below.
+    num_towers = self.FLAGS.num_towers
+    if self.batch_size % num_towers != 0:
+      raise ValueError("batch_size %d is not divisible by num_towers %d" % (
+        self.batch_size, num_towers))
+    if num_towers > 1:
+      tower_inputs = tf.split(inputs, num_towers)
+      tower_z = tf.split(self.z, num_towers)
+      tower_y = tf.split(self.y, num_towers) if self.y_dim else [None] * num_towers
     else:
-      self.G = self.generator(self.z)
-      self.D, self.D_logits = self.discriminator(inputs)
+      tower_inputs, tower_z = [inputs], [self.z]
+      tower_y = [self.y if self.y_dim else None]
+
+    self.towers = []
+    for idx in xrange(num_towers):
+      with self.tower_scope(idx):
+        self.towers.append(self.build_tower(
+          tower_inputs[idx], tower_z[idx], tower_y[idx], reuse=idx > 0))
+
+    # Moving averages of the generator weights, created before the sampler
+    # and the saver so that both cover them; build_train_ops updates them.
+    self.g_ema_vars = [var for var in tf.trainable_variables()
+                       if var.op.name.startswith('generator/')]
+    generator_ema = self.FLAGS.generator_ema
+    if generator_ema > 0 or self.sample_ema:
+      self.g_ema = tf.train.ExponentialMovingAverage(generator_ema)
+      # the returned update op is not used, as it would not wait for g_optim
+      self.g_ema.apply(self.g_ema_vars)
+
+    self.sampler = self.sampler(self.z, self.y if self.y_dim else None)
+
+    self.G = self.combine_towers('G', concat)
+    self.D = self.combine_towers('D', concat)
+    self.D_logits = self.combine_towers('D_logits', concat)
+    self.D_ = self.combine_towers('D_', concat)
+    self.D_logits_ = self.combine_towers('D_logits_', concat)
+    self.g_loss = self.combine_towers('g_loss')
+    self.d_loss = self.combine_towers('d_loss')
+    if self.FLAGS.W_GAN is False:
+        self.d_loss_real = self.combine_towers('d_loss_real')
+        self.d_loss_fake = self.combine_towers('d_loss_fake')
+        self.d_loss_real_sum = scalar_summary("d_loss_real", self.d_loss_real)
+        self.d_loss_fake_sum = scalar_summary("d_loss_fake", self.d_loss_fake)
 
-      self.sampler = self.sampler(self.z)
-      self.D_, self.D_logits_ = self.discriminator(self.G, reuse=True)
     if self.FLAGS.W_GAN is False:
-        self.d_sum = histogram_summary("d", self.D)
+        self.d_sum_hist = histogram_summary("d", self.D)
         self.d__sum = histogram_summary("d_", self.D_)
         self.G_sum = image_summary("G", self.G)
     else:
-        self.d_sum = histogram_summary("d", self.D_logits)
+        self.d_sum_hist = histogram_summary("d", self.D_logits)
         self.d__sum = histogram_summary("d_", self.D_logits_)
         self.G_sum = image_summary("G", self.G)
 
+    self.g_loss_sum = scalar_summary("g_loss", self.g_loss)
+    self.d_loss_sum = scalar_summary("d_loss", self.d_loss)
+
+    t_vars = tf.trainable_variables()
+
+    self.d_vars = [var for var in t_vars if 'd_' in var.name]
+    self.g_vars = [var for var in t_vars if 'g_' in var.name]
+
+    # The loss scales are not saved, so float16 and float32 runs share
+    # checkpoints
+    self.model_vars = [var for var in tf.global_variables()
+                       if not var.op.name.startswith('loss_scale/')]
+    self.saver = tf.train.Saver(self.model_vars)
+
+  def build_input_queue(self, image_dims):
+    """Builds the queue the training batches reach the graph through.
+
+    A host thread enqueues batches (see `start_input_queue`); once per step
+    `dequeue_op` copies the next one into the `input_buffers` variables,
+    which every update of the step then reads without a feed.
+    """
+    shapes = [[self.batch_size] + image_dims]
+    names = ['images']
+    if self.y_dim:
+      shapes.append([self.batch_size, self.y_dim])
+      names.append('labels')
+
+    with tf.name_scope('input_queue'):
+      self.enqueue_inputs = [tf.placeholder(tf.float32, shape, name=name)
+                             for shape, name in zip(shapes, names)]
+      queue = tf.FIFOQueue(max(self.FLAGS.prefetch_batches, 1),
+                           [tf.float32] * len(shapes), shapes=shapes)
+      self.enqueue_op = queue.enqueue(self.enqueue_inputs)
+      self.close_queue_op = queue.close(cancel_pending_enqueues=True)
+
+      self.input_buffers = [
+        tf.Variable(tf.zeros(shape), trainable=False, collections=[],
+                    name='%s_buffer' % name)
+        for shape, name in zip(shapes, names)]
+      self.input_buffers_init = tf.variables_initializer(self.input_buffers)
+      dequeued = queue.dequeue()
+      if not isinstance(dequeued, (list, tuple)):
+        dequeued = [dequeued]
+      self.dequeue_op = tf.group(*[tf.assign(buffer, value) for buffer, value
+                                   in zip(self.input_buffers, dequeued)])
+
+  def start_input_queue(self, batches):
+    """Enqueues the (images[, labels]) tuples of `batches` in the background."""
+    def enqueue(batch):
+      self.sess.run(self.enqueue_op,
+                    feed_dict=dict(zip(self.enqueue_inputs, batch)))
+    def close():
+      self.sess.run(self.close_queue_op)
+    return QueueFeeder(batches, enqueue, close)
+
+  @contextlib.contextmanager
+  def tower_scope(self, idx):
+    """Places tower `idx` on its device, with the variables on the CPU.
+
+    Only the first tower updates the batch norm moving statistics; every
+    tower normalizes with the statistics of its own slice of the batch.
+    """
+    if self.FLAGS.num_towers == 1:
+      yield
+      return
+    device = '/%s:%d' % (self.FLAGS.tower_device, idx)
+    def device_fn(op):
+      if op.type in ('Variable', 'VariableV2', 'VarHandleOp'):
+        return '/cpu:0'
+      return device
+    with tf.device(device_fn), tf.name_scope('tower_%d' % idx), \
+        batch_norm_updates(idx == 0):
+      yield
+
+  def build_tower(self, inputs, z, y=None, reuse=False):
+    """Builds G, D and the losses of one tower, returned as a dict."""
     def sigmoid_cross_entropy_with_logits(x, y):
       try:
         return tf.nn.sigmoid_cross_entropy_with_logits(logits=x, labels=y)
       except:
         return tf.nn.sigmoid_cross_entropy_with_logits(logits=x, targets=y)
+
+    tower = {}
+    tower['G'] = G = self.generator(z, y, reuse=reuse)
+    tower['D'], tower['D_logits'] = self.discriminator(inputs, y, reuse=reuse)
+    tower['D_'], tower['D_logits_'] = self.discriminator(G, y, reuse=True)
+
     if self.FLAGS.W_GAN is True:
         # Standard WGAN loss
-            self.g_loss = -tf.reduce_mean(self.D_logits_)
-            self.d_loss = tf.reduce_mean(self.D_logits_) - tf.reduce_mean(self.D_logits)
-
-            # Gradient penalty
-            alpha = tf.random_uniform(
-                shape=[self.batch_size,1], 
-                minval=0.,
-                maxval=1.
-            )
-            differences = tf.reshape(self.G - inputs,[self.batch_size,-1])
-            interpolates = tf.reshape(inputs,[self.batch_size,-1]) + (alpha*differences)
-            interpolates = tf.reshape(interpolates,inputs.get_shape())
-            _ ,d_image = self.discriminator(interpolates,reuse=True)
-            gradients = tf.gradients(d_image, [interpolates])[0]
-            slopes = tf.sqrt(tf.reduce_sum(tf.square(gradients), reduction_indices=[1]))
-            gradient_penalty = tf.reduce_mean((slopes-1.)**2)
-            self.d_loss += self.FLAGS.LAMBDA*gradient_penalty
+        tower['g_loss'] = -tf.reduce_mean(tower['D_logits_'])
+        tower['d_loss'] = tf.reduce_mean(tower['D_logits_']) \
+            - tf.reduce_mean(tower['D_logits'])
 
+        # Gradient penalty, over the tower's own slice of the batch
+        tower['d_loss'] += self.FLAGS.LAMBDA*self.gradient_penalty(inputs, G, y)
     else:
-        self.d_loss_real = tf.reduce_mean(
-          sigmoid_cross_entropy_with_logits(self.D_logits, tf.ones_like(self.D)))
-        self.d_loss_fake = tf.reduce_mean(
-          sigmoid_cross_entropy_with_logits(self.D_logits_, tf.zeros_like(self.D_)))
-        self.g_loss = tf.reduce_mean(
-          sigmoid_cross_entropy_with_logits(self.D_logits_, tf.ones_like(self.D_)))
+        tower['d_loss_real'] = tf.reduce_mean(
+          sigmoid_cross_entropy_with_logits(
+            tower['D_logits'], tf.ones_like(tower['D'])))
+        tower['d_loss_fake'] = tf.reduce_mean(
+          sigmoid_cross_entropy_with_logits(
+            tower['D_logits_'], tf.zeros_like(tower['D_'])))
+        tower['g_loss'] = tf.reduce_mean(
+          sigmoid_cross_entropy_with_logits(
+            tower['D_logits_'], tf.ones_like(tower['D_'])))
+        tower['d_loss'] = tower['d_loss_real'] + tower['d_loss_fake']
+    return tower
+
+  def combine_towers(self, key, merge=None):
+    """Concatenates (with `merge`) or averages `key` over the towers."""
+    values = [tower[key] for tower in self.towers]
+    if len(values) == 1 or values[0] is None:
+      return values[0]
+    if merge is not None:
+      return merge(values, 0)
+    return tf.add_n(values) / float(len(values))
+
+  def build_sampler(self):
+    """Builds only the generator in inference mode.
+
+    The saver covers the `generator/` variables alone, so `load` restores
+    them from a full training checkpoint.
+    """
+    if self.y_dim:
+      self.y = tf.placeholder(tf.float32, [None, self.y_dim], name='y')
+    self.z = tf.placeholder(
+      tf.float32, [None, self.z_dim], name='z')
+    self.alpha = None
+    if self.fade_in:
+      self.alpha = tf.placeholder_with_default(1., [], name='alpha')
+
+    self.sampler = self.generator(self.z, self.y if self.y_dim else None,
+                                  train=False)
+
+    self.g_vars = [var for var in tf.trainable_variables() if 'g_' in var.name]
+    var_list = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope='generator')
+    if self.sample_ema:
+      # restore the moving averages into the weights themselves
+      var_list = dict(
+        (name, var) for name, var in tf.train.ExponentialMovingAverage(0.)
+        .variables_to_restore(self.g_vars).items()
+        if var.op.name.startswith('generator/'))
+    self.saver = tf.train.Saver(var_list)
+
+  def gradient_penalty(self, inputs, G, y=None):
+    batch_size = int(inputs.get_shape()[0])
+    alpha = tf.random_uniform(
+        shape=[batch_size,1], 
+        minval=0.,
+        maxval=1.
+    )
+    differences = tf.reshape(G - inputs,[batch_size,-1])
+    interpolates = tf.reshape(inputs,[batch_size,-1]) + (alpha*differences)
+    interpolates = tf.reshape(interpolates,inputs.get_shape())
+    _ ,d_image = self.discriminator(interpolates, y, reuse=True)
+    if self.d_loss_scale is not None:
+      # keep the float16 backward pass of D from underflowing
+      scale = self.d_loss_scale.get_loss_scale()
+      gradients = tf.gradients(d_image * scale, [interpolates])[0] / scale
+    else:
+      gradients = tf.gradients(d_image, [interpolates])[0]
+    slopes = tf.sqrt(tf.reduce_sum(tf.square(gradients), reduction_indices=[1]))
+    return tf.reduce_mean((slopes-1.)**2)
 
-        self.d_loss_real_sum = scalar_summary("d_loss_real", self.d_loss_real)
-        self.d_loss_fake_sum = scalar_summary("d_loss_fake", self.d_loss_fake)
-                              
-        self.d_loss = self.d_loss_real + self.d_loss_fake
+  def build_fused_critic(self, d_optimizer, g_optimizer):
+    """Builds one op running CRITIC_NUM critic updates and a generator update.
 
-    self.g_loss_sum = scalar_summary("g_loss", self.g_loss)
-    self.d_loss_sum = scalar_summary("d_loss", self.d_loss)
+    Every critic update gets its own slice of `critic_inputs`/`critic_z`. The
+    updates are unrolled and chained with control dependencies; the weights
+    are re-read inside each link so that every step sees the previous update.
+    The generator update reads `z` (and `y`).
+    """
+    critic_num = self.FLAGS.CRITIC_NUM
+    image_dims = self.inputs.get_shape().as_list()[1:]
 
-    t_vars = tf.trainable_variables()
+    self.critic_inputs = tf.placeholder(
+      tf.float32, [critic_num, self.batch_size] + image_dims, name='critic_real_images')
+    self.critic_z = tf.placeholder(
+      tf.float32, [critic_num, self.batch_size, self.z_dim], name='critic_z')
+    if self.y_dim:
+      self.critic_y = tf.placeholder(
+        tf.float32, [critic_num, self.batch_size, self.y_dim], name='critic_y')
+
+    reads = {}
+    def read_getter(getter, *args, **kwargs):
+      var = getter(*args, **kwargs)
+      if not kwargs.get('trainable', True):
+        return var
+      if var.op.name not in reads:
+        reads[var.op.name] = var.read_value()
+      return reads[var.op.name]
+
+    def apply_step(optimizer, loss, var_list, loss_scale):
+      var_list = [var for var in var_list if var.op.name in reads]
+      if loss_scale is not None:
+        scale = loss_scale.get_loss_scale()
+        grads = tf.gradients(loss * scale, [reads[var.op.name] for var in var_list])
+        grads = [grad / scale for grad in grads]
+      else:
+        grads = tf.gradients(loss, [reads[var.op.name] for var in var_list])
+      return optimizer.apply_gradients(zip(grads, var_list))
+
+    step = tf.no_op()
+    with tf.variable_scope(tf.get_variable_scope(), custom_getter=read_getter):
+      for idx in xrange(critic_num):
+        reads.clear()
+        with tf.control_dependencies([step]):
+          y = self.critic_y[idx] if self.y_dim else None
+          inputs = self.critic_inputs[idx]
+          G = self.generator(self.critic_z[idx], y, reuse=True)
+          _, D_logits = self.discriminator(inputs, y, reuse=True)
+          _, D_logits_ = self.discriminator(G, y, reuse=True)
+          d_loss = tf.reduce_mean(D_logits_) - tf.reduce_mean(D_logits) \
+              + self.FLAGS.LAMBDA*self.gradient_penalty(inputs, G, y)
+        step = apply_step(d_optimizer, d_loss, self.d_vars, self.d_loss_scale)
+
+      reads.clear()
+      with tf.control_dependencies([step]):
+        y = self.y if self.y_dim else None
+        G = self.generator(self.z, y, reuse=True)
+        _, D_logits_ = self.discriminator(G, y, reuse=True)
+        g_loss = -tf.reduce_mean(D_logits_)
+      step = apply_step(g_optimizer, g_loss, self.g_vars, self.g_loss_scale)
+
+    self.fused_d_loss = d_loss
+    self.fused_g_loss = g_loss
+    with tf.name_scope("fused_critic"):
+      self.fused_sum = merge_summary([
+        scalar_summary("d_loss", d_loss), scalar_summary("g_loss", g_loss)])
+    return step
+
+
+  def build_train_ops(self, config):
+    if self.FLAGS.W_GAN is False:
+        d_optimizer = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1)
+        g_optimizer = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1)
+    else:
+        d_optimizer = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1,beta2=0.9)
+        g_optimizer = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1,beta2=0.9)
+    if self.d_loss_scale is not None:
+      # Scales the losses, skips the updates whose gradients overflow
+      d_optimizer = tf.contrib.mixed_precision.LossScaleOptimizer(
+        d_optimizer, self.d_loss_scale)
+      g_optimizer = tf.contrib.mixed_precision.LossScaleOptimizer(
+        g_optimizer, self.g_loss_scale)
+    if len(self.towers) > 1:
+      # Gradients are computed on each tower's device and averaged
+      d_grads, g_grads = [], []
+      for idx, tower in enumerate(self.towers):
+        with self.tower_scope(idx):
+          d_grads.append(d_optimizer.compute_gradients(
+            tower['d_loss'], var_list=self.d_vars,
+            colocate_gradients_with_ops=True))
+          g_grads.append(g_optimizer.compute_gradients(
+            tower['g_loss'], var_list=self.g_vars,
+            colocate_gradients_with_ops=True))
+      self.d_optim = d_optimizer.apply_gradients(average_gradients(d_grads))
+      self.g_optim = g_optimizer.apply_gradients(average_gradients(g_grads))
+    else:
+      self.d_optim = d_optimizer.minimize(self.d_loss, var_list=self.d_vars)
+      self.g_optim = g_optimizer.minimize(self.g_loss, var_list=self.g_vars)
+
+    self.fused_optim = None
+    if self.FLAGS.W_GAN is True and self.FLAGS.fused_critic:
+      if len(self.towers) > 1:
+        raise ValueError("fused_critic does not support num_towers > 1")
+      if self.input_queue:
+        raise ValueError("fused_critic does not support input_mode queue")
+      # Each generator step consumes CRITIC_NUM fresh batches of real images.
+      self.fused_optim = self.build_fused_critic(d_optimizer, g_optimizer)
+      self.batches_per_step = self.FLAGS.CRITIC_NUM
+    else:
+      self.batches_per_step = 1
+
+    # Average the generator weights once they are updated, in the same run
+    decay = self.FLAGS.generator_ema
+    if decay > 0:
+      def update_ema(optim):
+        with tf.control_dependencies([optim]):
+          return tf.group(*[
+            tf.assign_sub(self.g_ema.average(var),
+                          (1. - decay) * (self.g_ema.average(var) - var))
+            for var in self.g_ema_vars], name='generator_ema')
+      self.g_optim = update_ema(self.g_optim)
+      if self.fused_optim is not None:
+        self.fused_optim = update_ema(self.fused_optim)
+    elif self.sample_ema:
+      raise ValueError("sample_ema needs generator_ema > 0 in training")
+
+    # Cheap scalar summaries and expensive histogram/image summaries are
+    # fetched on their own intervals, see summaries_due.
+    if self.FLAGS.W_GAN is True:
+        self.g_sum = merge_summary([self.g_loss_sum])
+        self.d_sum = merge_summary([self.d_loss_sum])
+    else:
+        self.g_sum = merge_summary([self.d_loss_fake_sum, self.g_loss_sum])
+        self.d_sum = merge_summary([self.d_loss_real_sum, self.d_loss_sum])
+    self.g_hist_sum = merge_summary([self.z_sum, self.d__sum, self.G_sum])
+    self.d_hist_sum = merge_summary([self.z_sum, self.d_sum_hist])
+    self.scalar_summary_interval = config.scalar_summary_interval
+    self.histogram_summary_interval = config.histogram_summary_interval
+
+    self.profiler = StepProfiler(window=config.profile_window,
+                                 trace_dir=os.path.join("./logs", "timeline"))
+
+  def summaries_due(self, counter, scalar_sum, hist_sum=None):
+    """Returns the summary ops to fetch at step `counter`."""
+    summaries = []
+    if self.scalar_summary_interval > 0 and \
+        np.mod(counter, self.scalar_summary_interval) == 0:
+      summaries.append(scalar_sum)
+    if hist_sum is not None and self.histogram_summary_interval > 0 and \
+        np.mod(counter, self.histogram_summary_interval) == 0:
+      summaries.append(hist_sum)
+    return summaries
+
+  def train_step(self, batch_images, batch_labels, batch_z, counter, log=False):
+    """Runs the D and G updates of one training step.
+
+    When `log` is set, returns (d_loss, g_loss) fetched from the same runs
+    that apply the updates, i.e. before the last update of each network.
+    Otherwise no loss is fetched and None is returned. Summaries are only
+    fetched on the steps `summaries_due` selects. The feed, update and
+    summary phases are timed by `self.profiler`.
+
+    In the queue input mode the batch is dequeued instead and
+    `batch_images`, `batch_labels` and `batch_z` are ignored.
+    """
+    profiler = self.profiler
+    def run(phase, optim, summaries, loss, feed_dict):
+      fetches = {'optim': optim, 'summaries': summaries}
+      if log and loss is not None:
+        fetches['loss'] = loss
+      results = profiler.run(self.sess, phase, fetches, feed_dict)
+      with profiler.phase('summary'):
+        for summary_str in results['summaries']:
+          self.writer.add_summary(summary_str, counter)
+      return results.get('loss')
+
+    with profiler.phase('feed'):
+      if self.input_queue:
+        d_feed_dict, g_feed_dict = {}, {}
+      else:
+        d_feed_dict = { self.inputs: batch_images, self.z: batch_z }
+        g_feed_dict = { self.z: batch_z }
+        if self.y_dim:
+          d_feed_dict[self.y] = batch_labels[-self.batch_size:]
+          g_feed_dict[self.y] = batch_labels[-self.batch_size:]
+
+      if self.fused_optim is not None:
+        d_feed_dict = {
+          self.critic_inputs: batch_images.reshape(
+            self.critic_inputs.get_shape().as_list()),
+          self.critic_z: np.random.uniform(
+            -1, 1, self.critic_z.get_shape().as_list()).astype(np.float32),
+        }
+        d_feed_dict.update(g_feed_dict)
+        if self.y_dim:
+          d_feed_dict[self.critic_y] = batch_labels.reshape(
+            self.critic_y.get_shape().as_list())
+      d_feed_dict.update(self.alpha_feed())
+      g_feed_dict.update(self.alpha_feed())
+
+    if self.input_queue:
+      profiler.run(self.sess, 'input', self.dequeue_op)
+
+    if self.fused_optim is not None:
+      # Update D network CRITIC_NUM times, then G network, in one run
+      return run('d_update', self.fused_optim,
+                 self.summaries_due(counter, self.fused_sum),
+                 (self.fused_d_loss, self.fused_g_loss), d_feed_dict)
+
+    d_summaries = self.summaries_due(counter, self.d_sum, self.d_hist_sum)
+    g_summaries = self.summaries_due(counter, self.g_sum, self.g_hist_sum)
+    if self.FLAGS.W_GAN is False:
+      # Update D network
+      d_loss = run('d_update', self.d_optim, d_summaries, self.d_loss,
+                   d_feed_dict)
 
-    self.d_vars = [var for var in t_vars if 'd_' in var.name]
-    self.g_vars = [var for var in t_vars if 'g_' in var.name]
+      # Update G network
+      run('g_update', self.g_optim, g_summaries, None, g_feed_dict)
+    else:
+      # Update D network, only the last critic update records a summary
+      for _ in xrange(self.FLAGS.CRITIC_NUM - 1):
+        run('d_update', self.d_optim, [], None, d_feed_dict)
+      d_loss = run('d_update', self.d_optim, d_summaries, self.d_loss,
+                   d_feed_dict)
 
-    self.saver = tf.train.Saver()
+    # Update G network; in DC-GAN mode this runs g_optim twice to make sure
+    # that d_loss does not go to zero (different from paper)
+    g_loss = run('g_update', self.g_optim, g_summaries, self.g_loss,
+                 g_feed_dict)
 
+    if log:
+      return d_loss, g_loss
 
   def train(self, config):
-    if self.FLAGS.W_GAN is False:
-        d_optim = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1) \
-                  .minimize(self.d_loss, var_list=self.d_vars)
-        g_optim = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1) \
-                  .minimize(self.g_loss, var_list=self.g_vars)
-    else:
-        d_optim = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1,beta2=0.9) \
-                  .minimize(self.d_loss, var_list=self.d_vars)
-        g_optim = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1,beta2=0.9) \
-                  .minimize(self.g_loss, var_list=self.g_vars)
-    try:
-      tf.global_variables_initializer().run()
-    except:
-      tf.initialize_all_variables().run()
-    if self.FLAGS.W_GAN is True:
-        self.g_sum = merge_summary([self.z_sum, self.d__sum,
-          self.G_sum, self.g_loss_sum])
-        self.d_sum = merge_summary(
-            [self.z_sum, self.d_sum,  self.d_loss_sum])
-    else:
-        self.g_sum = merge_summary([self.z_sum, self.d__sum,
-          self.G_sum, self.d_loss_fake_sum, self.g_loss_sum])
-        self.d_sum = merge_summary(
-            [self.z_sum, self.d_sum, self.d_loss_real_sum, self.d_loss_sum])
-    self.writer = SummaryWriter("./logs", self.sess.graph)
+    self.build_train_ops(config)
+    step_size = config.batch_size * self.batches_per_step
+    generator_dir = None
+    if config.generator_checkpoint_dir:
+      generator_dir = os.path.join(config.generator_checkpoint_dir, self.model_dir)
+    checkpointer = AsyncCheckpointer(
+      self.sess, self.model_vars,
+      os.path.join(config.checkpoint_dir, self.model_dir), "DCGAN.model",
+      max_to_keep=config.checkpoint_keep, keep_best=config.checkpoint_keep_best,
+      generator_dir=generator_dir, save_steps=config.checkpoint_steps,
+      save_secs=config.checkpoint_secs)
+    counter = self.initialize_variables()
+    log_dir = "./logs"
+    if not self.is_chief:
+      log_dir = os.path.join(log_dir, "worker_%d" % self.task_index)
+    self.writer = SummaryWriter(log_dir, self.sess.graph)
+    self.image_writer = ImageWriter()
+    profiler = self.profiler
+    profiler.install_signal_handler(config.trace_num_steps)
+    evaluator = None
+    if self.is_chief and config.eval_interval > 0:
+      evaluator = self.build_evaluator(config)
 
     sample_z = np.random.uniform(-1, 1, size=(self.sample_num , self.z_dim))
     
     if config.dataset == 'mnist':
-      sample_inputs = self.data_X[0:self.sample_num]
-      sample_labels = self.data_y[0:self.sample_num]
+      sample_inputs, sample_labels = self.mnist_batch(
+        self.data_order[0:self.sample_num])
     else:
-      sample_files = self.data[0:self.sample_num]
-      sample = [
-          get_image(sample_file,
-                    input_height=self.input_height,
-                    input_width=self.input_width,
-                    resize_height=self.output_height,
-                    resize_width=self.output_width,
-                    crop=self.crop,
-                    grayscale=self.grayscale) for sample_file in sample_files]
-      if (self.grayscale):
-        sample_inputs = np.array(sample).astype(np.float32)[:, :, :, None]
+      if self.data_cache is not None:
+        sample_inputs = normalize_batch(self.data_cache[0:self.sample_num])
       else:
-        sample_inputs = np.array(sample).astype(np.float32)
-  
-    counter = 1
-    start_time = time.time()
-    could_load, checkpoint_counter = self.load(self.checkpoint_dir)
-    if could_load:
-      counter = checkpoint_counter
-      print(" [*] Load SUCCESS")
-    else:
-      print(" [!] Load failed...")
+        sample_files = self.data[0:self.sample_num]
+        sample_inputs = load_batch(sample_files, **self.image_kwargs)
+
+    if self.input_queue:
+      self.sess.run(self.input_buffers_init)
+      # enough host buffers for a full queue, the batch being dequeued and
+      # the one being written
+      num_buffers = max(config.prefetch_batches, 1) + 2
+      image_buffers = FeedBuffers(self.inputs.get_shape().as_list(), num_buffers)
+      label_buffers = None
+      if self.y_dim:
+        label_buffers = FeedBuffers([self.batch_size, self.y_dim], num_buffers)
 
-    for epoch in xrange(config.epoch):
+    start_time = time.time()
+    checkpointer.restore_state(counter)
+    losses = {}
+
+    # An intermediate progressive stage trains until its last step,
+    # whatever the number of epochs
+    stage_start, stage_end = self.stage_steps()
+    epochs = xrange(config.epoch) if stage_end is None else itertools.count()
+    for epoch in epochs:
+      if stage_end is not None and counter >= stage_end:
+        break
       if config.dataset == 'mnist':
-        batch_idxs = min(len(self.data_X), config.train_size) // config.batch_size
-      else:      
-        self.data = glob(os.path.join(
-          "./data", config.dataset, self.input_fname_pattern))
-        batch_idxs = min(len(self.data), config.train_size) // config.batch_size
-
+        batch_idxs = min(len(self.data_order), config.train_size) // step_size
+      else:
+        if self.data_cache is None:
+          self.data = self.dataset_files()
+        batch_idxs = min(len(self.data), config.train_size) // step_size
+        batches = self.image_batches(config, batch_idxs * self.batches_per_step)
+      feeder = None
+      if self.input_queue:
+        feeder = self.start_input_queue(self.queue_batches(
+          config, batch_idxs, image_buffers, label_buffers))
+
+      stopped_early = False
       for idx in xrange(0, batch_idxs):
-        if config.dataset == 'mnist':
-          batch_images = self.data_X[idx*config.batch_size:(idx+1)*config.batch_size]
-          batch_labels = self.data_y[idx*config.batch_size:(idx+1)*config.batch_size]
-        else:
-          batch_files = self.data[idx*config.batch_size:(idx+1)*config.batch_size]
-          batch = [
-              get_image(batch_file,
-                        input_height=self.input_height,
-                        input_width=self.input_width,
-                        resize_height=self.output_height,
-                        resize_width=self.output_width,
-                        crop=self.crop,
-                        grayscale=self.grayscale) for batch_file in batch_files]
-          if self.grayscale:
-            batch_images = np.array(batch).astype(np.float32)[:, :, :, None]
+        if stage_end is not None and counter >= stage_end:
+          stopped_early = True
+          break
+        if self.fade_in:
+          self.alpha_value = min(1., (counter - stage_start) /
+                                 max(config.progressive_steps // 2, 1))
+        profiler.start_step(counter)
+        if counter == config.trace_step:
+          profiler.request_trace(config.trace_num_steps)
+        with profiler.phase('input'):
+          batch_images = batch_labels = batch_z = None
+          if self.input_queue:
+            # dequeued by train_step
+            pass
+          elif config.dataset == 'mnist':
+            batch_images, batch_labels = self.mnist_batch(
+              self.data_order[idx*step_size:(idx+1)*step_size])
+          elif self.batches_per_step > 1:
+            batch_images = np.concatenate(
+              [next(batches) for _ in xrange(self.batches_per_step)])
           else:
-            batch_images = np.array(batch).astype(np.float32)
-
-        batch_z = np.random.uniform(-1, 1, [config.batch_size, self.z_dim]) \
-              .astype(np.float32)
-        if self.FLAGS.W_GAN is False:
-            if config.dataset == 'mnist':
-              # Update D network
-              _, summary_str = self.sess.run([d_optim, self.d_sum],
-                feed_dict={ 
-                  self.inputs: batch_images,
-                  self.z: batch_z,
-                  self.y:batch_labels,
-                })
-              self.writer.add_summary(summary_str, counter)
-
-              # Update G network
-              _, summary_str = self.sess.run([g_optim, self.g_sum],
-                feed_dict={
-                  self.z: batch_z, 
-                  self.y:batch_labels,
-                })
-              self.writer.add_summary(summary_str, counter)
-
-              # Run g_optim twice to make sure that d_loss does not go to zero (different from paper)
-              _, summary_str = self.sess.run([g_optim, self.g_sum],
-                feed_dict={ self.z: batch_z, self.y:batch_labels })
-              self.writer.add_summary(summary_str, counter)
-              
-              errD_fake = self.d_loss_fake.eval({
-                  self.z: batch_z, 
-                  self.y:batch_labels
-              })
-              errD_real = self.d_loss_real.eval({
-                  self.inputs: batch_images,
-                  self.y:batch_labels
-              })
-              errG = self.g_loss.eval({
-                  self.z: batch_z,
-                  self.y: batch_labels
-              })
-            else:
-              # Update D network
-              _, summary_str = self.sess.run([d_optim, self.d_sum],
-                feed_dict={ self.inputs: batch_images, self.z: batch_z })
-              self.writer.add_summary(summary_str, counter)
-
-              # Update G network
-              _, summary_str = self.sess.run([g_optim, self.g_sum],
-                feed_dict={ self.z: batch_z })
-              self.writer.add_summary(summary_str, counter)
-
-              # Run g_optim twice to make sure that d_loss does not go to zero (different from paper)
-              _, summary_str = self.sess.run([g_optim, self.g_sum],
-                feed_dict={ self.z: batch_z })
-              self.writer.add_summary(summary_str, counter)
-              
-              errD_fake = self.d_loss_fake.eval({ self.z: batch_z })
-              errD_real = self.d_loss_real.eval({ self.inputs: batch_images })
-              errG = self.g_loss.eval({self.z: batch_z})
-        else:
-            if config.dataset == 'mnist':
-              for _ in range(self.FLAGS.CRITIC_NUM):
-                  # Update D network
-                  _, summary_str = self.sess.run([d_optim, self.d_sum],
-                    feed_dict={ 
-                      self.inputs: batch_images,
-                      self.z: batch_z,
-                      self.y:batch_labels,
-                    })
-              self.writer.add_summary(summary_str, counter)
-
-              # Update G network
-              _, summary_str = self.sess.run([g_optim, self.g_sum],
-                feed_dict={
-                  self.z: batch_z, 
-                  self.y:batch_labels,
-                })
-              self.writer.add_summary(summary_str, counter)
-
-              errD = self.d_loss.eval({
-                  self.z: batch_z, 
-                  self.y:batch_labels,
-                  self.inputs: batch_images
-              })
-              errG = self.g_loss.eval({
-                  self.z: batch_z,
-                  self.y: batch_labels
-              })
-            else:
-              for _ in range(self.FLAGS.CRITIC_NUM):
-                  # Update D network
-                  _, summary_str = self.sess.run([d_optim, self.d_sum],
-                    feed_dict={ self.inputs: batch_images, self.z: batch_z })
-              self.writer.add_summary(summary_str, counter)
-
-              # Update G network
-              _, summary_str = self.sess.run([g_optim, self.g_sum],
-                feed_dict={ self.z: batch_z })
-              self.writer.add_summary(summary_str, counter)
-
-           
-              errD = self.d_loss.eval({ self.z: batch_z , self.inputs: batch_images})
-              errG = self.g_loss.eval({self.z: batch_z})
+            batch_images = next(batches)
+
+          if not self.input_queue:
+            batch_z = np.random.uniform(-1, 1, [config.batch_size, self.z_dim]) \
+                  .astype(np.float32)
+        log = np.mod(counter, config.log_interval) == 0
+        try:
+          errors = self.train_step(
+            batch_images, batch_labels, batch_z, counter, log=log)
+        except (tf.errors.OutOfRangeError, tf.errors.CancelledError):
+          # the feeder failed and closed the queue; raise its error
+          if feeder is not None:
+            feeder.join()
+          raise
         counter += 1
-        if self.FLAGS.W_GAN is False:
-            print("Epoch: [%2d] [%4d/%4d] time: %4.4f, d_loss: %.8f, g_loss: %.8f" \
-              % (epoch, idx, batch_idxs,
-                time.time() - start_time, errD_fake+errD_real, errG))
-        else:
-            print("Epoch: [%2d] [%4d/%4d] time: %4.4f, d_loss: %.8f, g_loss: %.8f" \
-              % (epoch, idx, batch_idxs,
-                time.time() - start_time, errD, errG))
-        if np.mod(counter, 100) == 1:
+        if log:
+          errD, errG = errors
+          losses.update({'d_loss': errD, 'g_loss': errG})
+          input_time = profiler.current['input']
+          compute_time = sum(seconds for name, seconds in profiler.current.items()
+                             if name != 'input')
+          print("Epoch: [%2d] [%4d/%4d] time: %4.4f, input: %.4f, compute: %.4f, d_loss: %.8f, g_loss: %.8f" \
+            % (epoch, idx, batch_idxs,
+              time.time() - start_time, input_time, compute_time, errD, errG))
+        # Only the chief writes samples and checkpoints
+        if self.is_chief and np.mod(counter, 100) == 1:
           if config.dataset == 'mnist':
-            samples, d_loss, g_loss = self.sess.run(
+            samples, d_loss, g_loss = profiler.run(self.sess, 'sample_eval',
               [self.sampler, self.d_loss, self.g_loss],
               feed_dict={
                   self.z: sample_z,
@@ -378,49 +905,263 @@ class DCGAN(object):
                   self.y:sample_labels,
               }
             )
-            save_images(samples, image_manifold_size(samples.shape[0]),
-                  './{}/train_{:02d}_{:04d}.png'.format(config.sample_dir, epoch, idx))
+            with profiler.phase('sample_dump'):
+              self.image_writer.save(samples, image_manifold_size(samples.shape[0]),
+                    './{}/train_{:02d}_{:04d}.png'.format(config.sample_dir, epoch, idx))
             print("[Sample] d_loss: %.8f, g_loss: %.8f" % (d_loss, g_loss)) 
           else:
             try:
-              samples, d_loss, g_loss = self.sess.run(
+              feed_dict = {
+                  self.z: sample_z,
+                  self.inputs: sample_inputs,
+              }
+              feed_dict.update(self.alpha_feed())
+              samples, d_loss, g_loss = profiler.run(self.sess, 'sample_eval',
                 [self.sampler, self.d_loss, self.g_loss],
-                feed_dict={
-                    self.z: sample_z,
-                    self.inputs: sample_inputs,
-                },
+                feed_dict=feed_dict,
               )
-              save_images(samples, image_manifold_size(samples.shape[0]),
-                    './{}/train_{:02d}_{:04d}.png'.format(config.sample_dir, epoch, idx))
+              with profiler.phase('sample_dump'):
+                self.image_writer.save(samples, image_manifold_size(samples.shape[0]),
+                      './{}/train_{:02d}_{:04d}.png'.format(config.sample_dir, epoch, idx))
               print("[Sample] d_loss: %.8f, g_loss: %.8f" % (d_loss, g_loss)) 
             except:
               print("one pic error!...")
 
-        if np.mod(counter, 500) == 2:
-          self.save(config.checkpoint_dir, counter)
+        if evaluator is not None and np.mod(counter, config.eval_interval) == 0:
+          with profiler.phase('eval'):
+            evaluator.start(counter)
+        if evaluator is not None:
+          losses.update(evaluator.results)
+
+        if self.is_chief and checkpointer.should_save(counter):
+          with profiler.phase('checkpoint'):
+            checkpointer.save(counter, metric=losses.get(config.checkpoint_metric))
+            if not config.async_checkpoint:
+              checkpointer.wait()
+
+        profiler.end_step()
+        if config.profile_interval > 0 and \
+            np.mod(counter, config.profile_interval) == 0:
+          print(profiler.format())
+          self.writer.add_summary(profiler.summary(), counter)
+
+      if feeder is not None:
+        if stopped_early:
+          # the last epoch: cancel the batches still to be enqueued
+          feeder.close()
+        else:
+          # every batch was dequeued; the queue must stay open for the
+          # next epoch, as a closed TF queue cannot be reopened
+          feeder.join()
+
+    # the next progressive stage starts from the last step of this one
+    if stage_end is not None and self.is_chief and \
+        checkpointer.last_step != counter:
+      checkpointer.save(counter, metric=losses.get(config.checkpoint_metric))
+
+    self.image_writer.close()
+    checkpointer.close()
+    if evaluator is not None:
+      evaluator.close()
+    if self.decode_pool is not None:
+      self.decode_pool.terminate()
+      self.decode_pool.join()
+      self.decode_pool = None
+
+  def build_evaluator(self, config):
+    """Returns an `evaluation.Evaluator` of the sampler against the first
+    `eval_samples` training images, reporting to TensorBoard under eval/."""
+    extractor = FeatureExtractor(
+      config.eval_graph or None, input_tensor=config.eval_input_tensor,
+      feature_tensor=config.eval_feature_tensor,
+      logits_tensor=config.eval_logits_tensor or None,
+      input_size=config.eval_input_size, batch_size=config.eval_batch_size,
+      num_threads=config.eval_threads)
+
+    if config.dataset == 'mnist':
+      num_batches = min(config.eval_samples, len(self.data_order)) // config.batch_size
+      header = {'dataset': 'mnist'}
+      def real_batches():
+        for idx in xrange(num_batches):
+          yield self.mnist_batch(
+            self.data_order[idx*config.batch_size:(idx+1)*config.batch_size])[0]
+    else:
+      num_batches = min(config.eval_samples, len(self.data)) // config.batch_size
+      header = cache_header(self.data, **self.image_kwargs)
+      def real_batches():
+        return self.image_batches(config, num_batches)
+    header = dict(header, network=extractor.name,
+                  num_images=num_batches * config.batch_size)
+
+    # The evaluation samples from a copy of the generator weights taken
+    # when it starts, as training goes on updating them meanwhile.
+    sources = {}
+    shadows = set()
+    if self.g_ema is not None:
+      shadows = set(self.g_ema.average(var).op.name for var in self.g_ema_vars)
+    for var in tf.global_variables():
+      name = var.op.name
+      if not name.startswith('generator/') or name in shadows:
+        continue
+      average = self.g_ema.average(var) if self.sample_ema else None
+      sources[name] = var if average is None else average
+    with tf.name_scope('eval_snapshot'):
+      snapshots = dict(
+        (name, tf.Variable(tf.zeros(var.get_shape(), var.dtype.base_dtype),
+                           trainable=False, collections=[],
+                           name=name.replace('/', '_')))
+        for name, var in sources.items())
+      snapshot_op = tf.group(*[tf.assign(snapshots[name], var)
+                               for name, var in sources.items()])
+    self.sess.run(tf.variables_initializer(list(snapshots.values())))
+
+    def snapshot_getter(getter, *args, **kwargs):
+      var = getter(*args, **kwargs)
+      return snapshots.get(var.op.name, var)
+    with tf.variable_scope(tf.get_variable_scope(), custom_getter=snapshot_getter):
+      eval_sampler = self.generator(
+        self.z, self.y if self.y_dim else None, train=False, reuse=True)
+
+    alpha_feed = {}
+    def snapshot():
+      self.sess.run(snapshot_op)
+      alpha_feed.clear()
+      alpha_feed.update(self.alpha_feed())
+
+    def generate(z, y=None):
+      feed_dict = {self.z: z}
+      if self.y_dim:
+        feed_dict[self.y] = y
+      feed_dict.update(alpha_feed)
+      return self.sess.run(eval_sampler, feed_dict=feed_dict)
+
+    def report(step, results):
+      print(" [*] Step %d: %s" % (step, ", ".join(
+        "%s %.4f" % item for item in sorted(results.items()))))
+      self.writer.add_summary(tf.Summary(value=[
+        tf.Summary.Value(tag='eval/%s' % name, simple_value=value)
+        for name, value in results.items()]), step)
+
+    # the sampler outputs tanh images, or sigmoid ones for mnist, like the
+    # real batches
+    if self.y_dim:
+      to_pixels = lambda images: images * 255.
+    else:
+      to_pixels = lambda images: (images + 1.) * 127.5
+    return Evaluator(
+      extractor, generate, real_batches,
+      reference_path("./data", self.dataset_name, header), header,
+      num_samples=config.eval_samples, z_dim=self.z_dim, y_dim=self.y_dim,
+      batch_size=config.eval_batch_size, to_pixels=to_pixels, callback=report,
+      snapshot=snapshot)
+
+  def stage_steps(self):
+    """Returns the first and the end step of the current progressive stage.
+
+    Every stage but the last trains for `progressive_steps` steps. The
+    last one is built twice: with `fade_in` for the first half of those
+    steps, then without it (end None) for the remaining epochs.
+    """
+    if not self.progressive:
+      return 1, None
+    start = 1 + (self.stage - self.first_stage) * self.FLAGS.progressive_steps
+    if self.stage == self.num_stages:
+      if self.fade_in:
+        return start, start + max(self.FLAGS.progressive_steps // 2, 1)
+      return start, None
+    return start, start + self.FLAGS.progressive_steps
+
+  def alpha_feed(self):
+    """Feeds the fade-in weight of the newest stage, if it has one."""
+    if self.alpha is None:
+      return {}
+    return {self.alpha: self.alpha_value}
+
+  @property
+  def image_kwargs(self):
+    return dict(input_height=self.input_height,
+                input_width=self.input_width,
+                resize_height=self.stage_height,
+                resize_width=self.stage_width,
+                crop=self.crop,
+                grayscale=self.grayscale)
+
+  def image_batches(self, config, batch_idxs, buffers=None):
+    """Yields `batch_idxs` decoded batches of `self.data` in order.
+
+    Batches of the dataset cache are written into the arrays of the
+    `FeedBuffers` `buffers`, if given; decoded files are new arrays anyway.
+    """
+    if self.data_cache is not None:
+      for idx in xrange(0, batch_idxs):
+        yield normalize_batch(
+          self.data_cache[idx*config.batch_size:(idx+1)*config.batch_size],
+          out=buffers.next() if buffers is not None else None)
+    elif config.num_workers > 0:
+      if self.decode_pool is None:
+        # started once and shared by every epoch and the evaluation, as
+        # its workers are not forked and take a while to start
+        self.decode_pool = process_pool(config.num_workers)
+      prefetcher = BatchPrefetcher(self.data, config.batch_size, batch_idxs,
+                                   prefetch=config.prefetch_batches,
+                                   pool=self.decode_pool,
+                                   **self.image_kwargs)
+      try:
+        for batch_images in prefetcher:
+          yield batch_images
+      finally:
+        prefetcher.close()
+    else:
+      for idx in xrange(0, batch_idxs):
+        batch_files = self.data[idx*config.batch_size:(idx+1)*config.batch_size]
+        yield load_batch(batch_files, **self.image_kwargs)
+
+  def g_channels(self, idx):
+    """Channels after stage `idx` of the unconditional generator."""
+    return self.gf_dim * min(8, 2 ** (self.num_stages - 1 - idx))
+
+  def d_channels(self, idx):
+    """Channels after stage `idx` of the unconditional discriminator."""
+    return self.df_dim * min(8, 2 ** idx)
 
   def discriminator(self, image, y=None, reuse=False):
+    """Builds D in `compute_dtype`; the outputs are float32."""
     with tf.variable_scope("discriminator") as scope:
       if reuse:
         scope.reuse_variables()
 
+      image = tf.cast(image, self.compute_dtype)
+      if y is not None:
+        y = tf.cast(y, self.compute_dtype)
+
       if not self.y_dim:
-        h0 = lrelu(conv2d(image, self.df_dim, name='d_h0_conv'))
-        if self.FLAGS.W_GAN is False:
-            h1 = lrelu(self.d_bn1(conv2d(h0, self.df_dim*2, name='d_h1_conv')))
-            h2 = lrelu(self.d_bn2(conv2d(h1, self.df_dim*4, name='d_h2_conv')))
-            h3 = lrelu(self.d_bn3(conv2d(h2, self.df_dim*8, name='d_h3_conv')))
-        else:
-            h1 = lrelu(conv2d(h0, self.df_dim*2, name='d_h1_conv'))
-            h2 = lrelu(conv2d(h1, self.df_dim*4, name='d_h2_conv'))
-            h3 = lrelu(conv2d(h2, self.df_dim*8, name='d_h3_conv'))
-        h4 = linear(tf.reshape(h3, [self.batch_size, -1]), 1, 'd_h4_lin')
+        # A progressive stage uses the last `stage` conv stages, behind a
+        # 1x1 conv from the image (d_in<stage>)
+        first = self.num_stages - self.stage
+        h = image
+        if first > 0:
+          h = lrelu(conv2d(image, self.d_channels(first - 1), 1, 1, 1, 1,
+                           name='d_in%d' % self.stage))
+        for idx in xrange(first, self.num_stages):
+          h = conv2d(h, self.d_channels(idx), name='d_h%d_conv' % idx)
+          if idx > 0 and self.FLAGS.W_GAN is False:
+            h = getattr(self, 'd_bn%d' % idx)(h)
+          h = lrelu(h)
+          if idx == first and self.fade_in:
+            # blend in the previous stage's input on the downsampled image
+            previous = tf.nn.avg_pool(image, [1, 2, 2, 1], [1, 2, 2, 1], 'SAME')
+            previous = lrelu(conv2d(previous, self.d_channels(first), 1, 1, 1, 1,
+                                    name='d_in%d' % (self.stage - 1)))
+            alpha = tf.cast(self.alpha, self.compute_dtype)
+            h = alpha * h + (1. - alpha) * previous
+        h_out = tf.cast(linear(flatten(h), 1, 'd_h%d_lin' % self.num_stages),
+                        tf.float32)
         if self.FLAGS.W_GAN is False:
-            return tf.nn.sigmoid(h4), h4
+            return tf.nn.sigmoid(h_out), h_out
         else:
-            return None,tf.reshape(h4, [-1])
+            return None,tf.reshape(h_out, [-1])
       else:
-        yb = tf.reshape(y, [self.batch_size, 1, 1, self.y_dim])
+        yb = tf.reshape(y, [-1, 1, 1, self.y_dim])
         x = conv_cond_concat(image, yb)
 
         h0 = lrelu(conv2d(x, self.c_dim + self.y_dim, name='d_h0_conv'))
@@ -429,7 +1170,7 @@ class DCGAN(object):
             h1 = lrelu(self.d_bn1(conv2d(h0, self.df_dim + self.y_dim, name='d_h1_conv')))
         else:
             h1 = lrelu(conv2d(h0, self.df_dim + self.y_dim, name='d_h1_conv'))
-        h1 = tf.reshape(h1, [self.batch_size, -1])      
+        h1 = flatten(h1)
         h1 = concat([h1, y], 1)
         if self.FLAGS.W_GAN is False:        
             h2 = lrelu(self.d_bn2(linear(h1, self.dfc_dim, 'd_h2_lin')))
@@ -437,164 +1178,176 @@ class DCGAN(object):
             h2 = lrelu(linear(h1, self.dfc_dim, 'd_h2_lin'))
         h2 = concat([h2, y], 1)
 
-        h3 = linear(h2, 1, 'd_h3_lin')
+        h3 = tf.cast(linear(h2, 1, 'd_h3_lin'), tf.float32)
         if self.FLAGS.W_GAN is False:
             return tf.nn.sigmoid(h3), h3
         else:
             return None,tf.reshape(h3, [-1])
-  def generator(self, z, y=None):
+
+  def generator(self, z, y=None, train=True, reuse=False):
+    """Builds the generator; the batch dimension is taken from `z`.
+
+    It computes in `compute_dtype` and returns float32 images.
+    """
     with tf.variable_scope("generator") as scope:
+      if reuse:
+        scope.reuse_variables()
+
+      z = tf.cast(z, self.compute_dtype)
+      if y is not None:
+        y = tf.cast(y, self.compute_dtype)
+
       if not self.y_dim:
-        s_h, s_w = self.output_height, self.output_width
-        s_h2, s_w2 = conv_out_size_same(s_h, 2), conv_out_size_same(s_w, 2)
-        s_h4, s_w4 = conv_out_size_same(s_h2, 2), conv_out_size_same(s_w2, 2)
-        s_h8, s_w8 = conv_out_size_same(s_h4, 2), conv_out_size_same(s_w4, 2)
-        s_h16, s_w16 = conv_out_size_same(s_h8, 2), conv_out_size_same(s_w8, 2)
+        s_h, s_w = self.stage_heights, self.stage_widths
+        num_stages = self.num_stages
 
         # project `z` and reshape
         self.z_, self.h0_w, self.h0_b = linear(
-            z, self.gf_dim*8*s_h16*s_w16, 'g_h0_lin', with_w=True)
+            z, self.g_channels(0)*s_h[0]*s_w[0], 'g_h0_lin', with_w=True)
 
         self.h0 = tf.reshape(
-            self.z_, [-1, s_h16, s_w16, self.gf_dim * 8])
-        h0 = tf.nn.relu(self.g_bn0(self.h0))
-
-        self.h1, self.h1_w, self.h1_b = deconv2d(
-            h0, [self.batch_size, s_h8, s_w8, self.gf_dim*4], name='g_h1', with_w=True)
-        h1 = tf.nn.relu(self.g_bn1(self.h1))
-
-        h2, self.h2_w, self.h2_b = deconv2d(
-            h1, [self.batch_size, s_h4, s_w4, self.gf_dim*2], name='g_h2', with_w=True)
-        h2 = tf.nn.relu(self.g_bn2(h2))
-
-        h3, self.h3_w, self.h3_b = deconv2d(
-            h2, [self.batch_size, s_h2, s_w2, self.gf_dim*1], name='g_h3', with_w=True)
-        h3 = tf.nn.relu(self.g_bn3(h3))
-
-        h4, self.h4_w, self.h4_b = deconv2d(
-            h3, [self.batch_size, s_h, s_w, self.c_dim], name='g_h4', with_w=True)
-
-        return tf.nn.tanh(h4)
+            self.z_, [-1, s_h[0], s_w[0], self.g_channels(0)])
+        h = tf.nn.relu(self.g_bn0(self.h0, train=train))
+
+        # stride-2 stages g_h1 ... g_h<stage>; the last one of the full
+        # generator outputs the image
+        previous = None
+        for idx in xrange(1, self.stage + 1):
+          previous = h
+          channels = self.c_dim if idx == num_stages else self.g_channels(idx)
+          h, w, b = deconv2d(
+              h, [None, s_h[idx], s_w[idx], channels], name='g_h%d' % idx,
+              with_w=True)
+          setattr(self, 'h%d_w' % idx, w)
+          setattr(self, 'h%d_b' % idx, b)
+          if idx == 1:
+            self.h1 = h
+          if idx < num_stages:
+            h = tf.nn.relu(getattr(self, 'g_bn%d' % idx)(h, train=train))
+
+        # an intermediate progressive stage outputs through a 1x1 conv
+        # (g_out<stage>), blended with the upsampled previous stage output
+        # while fading in
+        def to_rgb(h, stage):
+          return conv2d(h, self.c_dim, 1, 1, 1, 1, name='g_out%d' % stage)
+        if self.stage < num_stages:
+          h = to_rgb(h, self.stage)
+        if self.fade_in:
+          previous = tf.image.resize_nearest_neighbor(
+              to_rgb(previous, self.stage - 1),
+              [s_h[self.stage], s_w[self.stage]])
+          alpha = tf.cast(self.alpha, self.compute_dtype)
+          h = alpha * h + (1. - alpha) * previous
+
+        return tf.cast(tf.nn.tanh(h), tf.float32)
       else:
         s_h, s_w = self.output_height, self.output_width
         s_h2, s_h4 = int(s_h/2), int(s_h/4)
         s_w2, s_w4 = int(s_w/2), int(s_w/4)
 
-        # yb = tf.expand_dims(tf.expand_dims(y, 1),2)
-        yb = tf.reshape(y, [self.batch_size, 1, 1, self.y_dim])
+        yb = tf.reshape(y, [-1, 1, 1, self.y_dim])
         z = concat([z, y], 1)
 
         h0 = tf.nn.relu(
-            self.g_bn0(linear(z, self.gfc_dim, 'g_h0_lin')))
+            self.g_bn0(linear(z, self.gfc_dim, 'g_h0_lin'), train=train))
         h0 = concat([h0, y], 1)
 
         h1 = tf.nn.relu(self.g_bn1(
-            linear(h0, self.gf_dim*2*s_h4*s_w4, 'g_h1_lin')))
-        h1 = tf.reshape(h1, [self.batch_size, s_h4, s_w4, self.gf_dim * 2])
+            linear(h0, self.gf_dim*2*s_h4*s_w4, 'g_h1_lin'), train=train))
+        h1 = tf.reshape(h1, [-1, s_h4, s_w4, self.gf_dim * 2])
 
         h1 = conv_cond_concat(h1, yb)
 
         h2 = tf.nn.relu(self.g_bn2(deconv2d(h1,
-            [self.batch_size, s_h2, s_w2, self.gf_dim * 2], name='g_h2')))
+            [None, s_h2, s_w2, self.gf_dim * 2], name='g_h2'), train=train))
         h2 = conv_cond_concat(h2, yb)
 
-        return tf.nn.sigmoid(
-            deconv2d(h2, [self.batch_size, s_h, s_w, self.c_dim], name='g_h3'))
+        return tf.cast(tf.nn.sigmoid(
+            deconv2d(h2, [None, s_h, s_w, self.c_dim], name='g_h3')), tf.float32)
 
   def sampler(self, z, y=None):
-    with tf.variable_scope("generator") as scope:
-      scope.reuse_variables()
-
-      if not self.y_dim:
-        s_h, s_w = self.output_height, self.output_width
-        s_h2, s_w2 = conv_out_size_same(s_h, 2), conv_out_size_same(s_w, 2)
-        s_h4, s_w4 = conv_out_size_same(s_h2, 2), conv_out_size_same(s_w2, 2)
-        s_h8, s_w8 = conv_out_size_same(s_h4, 2), conv_out_size_same(s_w4, 2)
-        s_h16, s_w16 = conv_out_size_same(s_h8, 2), conv_out_size_same(s_w8, 2)
-
-        # project `z` and reshape
-        h0 = tf.reshape(
-            linear(z, self.gf_dim*8*s_h16*s_w16, 'g_h0_lin'),
-            [-1, s_h16, s_w16, self.gf_dim * 8])
-        h0 = tf.nn.relu(self.g_bn0(h0, train=False))
-
-        h1 = deconv2d(h0, [self.batch_size, s_h8, s_w8, self.gf_dim*4], name='g_h1')
-        h1 = tf.nn.relu(self.g_bn1(h1, train=False))
-
-        h2 = deconv2d(h1, [self.batch_size, s_h4, s_w4, self.gf_dim*2], name='g_h2')
-        h2 = tf.nn.relu(self.g_bn2(h2, train=False))
-
-        h3 = deconv2d(h2, [self.batch_size, s_h2, s_w2, self.gf_dim*1], name='g_h3')
-        h3 = tf.nn.relu(self.g_bn3(h3, train=False))
+    """Inference-mode generator sharing the training weights.
 
-        h4 = deconv2d(h3, [self.batch_size, s_h, s_w, self.c_dim], name='g_h4')
-
-        return tf.nn.tanh(h4)
-      else:
-        s_h, s_w = self.output_height, self.output_width
-        s_h2, s_h4 = int(s_h/2), int(s_h/4)
-        s_w2, s_w4 = int(s_w/2), int(s_w/4)
-
-        # yb = tf.reshape(y, [-1, 1, 1, self.y_dim])
-        yb = tf.reshape(y, [self.batch_size, 1, 1, self.y_dim])
-        z = concat([z, y], 1)
-
-        h0 = tf.nn.relu(self.g_bn0(linear(z, self.gfc_dim, 'g_h0_lin'), train=False))
-        h0 = concat([h0, y], 1)
-
-        h1 = tf.nn.relu(self.g_bn1(
-            linear(h0, self.gf_dim*2*s_h4*s_w4, 'g_h1_lin'), train=False))
-        h1 = tf.reshape(h1, [self.batch_size, s_h4, s_w4, self.gf_dim * 2])
-        h1 = conv_cond_concat(h1, yb)
-
-        h2 = tf.nn.relu(self.g_bn2(
-            deconv2d(h1, [self.batch_size, s_h2, s_w2, self.gf_dim * 2], name='g_h2'), train=False))
-        h2 = conv_cond_concat(h2, yb)
+    Batch norm uses the moving statistics, and any number of `z` rows can be
+    fed to the same graph. With `sample_ema`, the weights are replaced by
+    their moving averages.
+    """
+    if self.g_ema is None or not self.sample_ema:
+      return self.generator(z, y, train=False, reuse=True)
 
-        return tf.nn.sigmoid(deconv2d(h2, [self.batch_size, s_h, s_w, self.c_dim], name='g_h3'))
+    def ema_getter(getter, *args, **kwargs):
+      var = getter(*args, **kwargs)
+      average = self.g_ema.average(var)
+      return var if average is None else average
+    with tf.variable_scope(tf.get_variable_scope(), custom_getter=ema_getter):
+      return self.generator(z, y, train=False, reuse=True)
 
   def load_mnist(self):
-    data_dir = os.path.join("./data", self.dataset_name)
-    
-    fd = open(os.path.join(data_dir,'train-images-idx3-ubyte'))
-    loaded = np.fromfile(file=fd,dtype=np.uint8)
-    trX = loaded[16:].reshape((60000,28,28,1)).astype(np.float)
+    """Returns the 70k MNIST images as uint8 and their labels as int8.
 
-    fd = open(os.path.join(data_dir,'train-labels-idx1-ubyte'))
-    loaded = np.fromfile(file=fd,dtype=np.uint8)
-    trY = loaded[8:].reshape((60000)).astype(np.float)
+    The idx files are memory-mapped and concatenated once; use
+    `mnist_batch` to normalize and one-hot encode a batch of them.
+    """
+    data_dir = os.path.join("./data", self.dataset_name)
 
-    fd = open(os.path.join(data_dir,'t10k-images-idx3-ubyte'))
-    loaded = np.fromfile(file=fd,dtype=np.uint8)
-    teX = loaded[16:].reshape((10000,28,28,1)).astype(np.float)
+    def idx_file(name, offset, shape):
+      return np.memmap(os.path.join(data_dir, name), dtype=np.uint8,
+                       mode='r', offset=offset, shape=shape)
 
-    fd = open(os.path.join(data_dir,'t10k-labels-idx1-ubyte'))
-    loaded = np.fromfile(file=fd,dtype=np.uint8)
-    teY = loaded[8:].reshape((10000)).astype(np.float)
+    trX = idx_file('train-images-idx3-ubyte', 16, (60000,28,28,1))
+    trY = idx_file('train-labels-idx1-ubyte', 8, (60000,))
+    teX = idx_file('t10k-images-idx3-ubyte', 16, (10000,28,28,1))
+    teY = idx_file('t10k-labels-idx1-ubyte', 8, (10000,))
 
-    trY = np.asarray(trY)
-    teY = np.asarray(teY)
-    
     X = np.concatenate((trX, teX), axis=0)
-    y = np.concatenate((trY, teY), axis=0).astype(np.int)
-    
-    seed = 547
-    np.random.seed(seed)
-    np.random.shuffle(X)
-    np.random.seed(seed)
-    np.random.shuffle(y)
-    
-    y_vec = np.zeros((len(y), self.y_dim), dtype=np.float)
-    for i, label in enumerate(y):
-      y_vec[i,y[i]] = 1.0
-    
-    return X/255.,y_vec
+    y = np.concatenate((trY, teY), axis=0).astype(np.int8)
+    return X, y
+
+  def mnist_batch(self, indices, out=None):
+    """Returns the images and one-hot labels of `indices`, written into
+    the (images, labels) arrays `out` if given."""
+    if out is None:
+      batch_images = self.data_X[indices].astype(np.float32) / np.float32(255.)
+      batch_labels = one_hot(self.data_y[indices], self.y_dim)
+      return batch_images, batch_labels
+
+    batch_images, batch_labels = out
+    np.multiply(self.data_X[indices], np.float32(1. / 255.),
+                out=batch_images, dtype=np.float32)
+    batch_labels.fill(0.)
+    batch_labels[np.arange(len(indices)), self.data_y[indices]] = 1.
+    return batch_images, batch_labels
+
+  def queue_batches(self, config, batch_idxs, image_buffers, label_buffers=None):
+    """Yields the (images[, labels]) batches of an epoch for the input
+    queue, in preallocated host buffers where the source allows."""
+    if config.dataset == 'mnist':
+      for idx in xrange(0, batch_idxs):
+        yield self.mnist_batch(
+          self.data_order[idx*config.batch_size:(idx+1)*config.batch_size],
+          out=(image_buffers.next(), label_buffers.next()))
+    else:
+      for batch_images in self.image_batches(config, batch_idxs, image_buffers):
+        yield (batch_images,)
 
   @property
   def model_dir(self):
-    return "{}_{}_{}_{}".format(
+    return self.stage_model_dir(self.stage)
+
+  def stage_model_dir(self, stage):
+    """Checkpoints of the intermediate progressive stages get their own
+    directory; the last stage shares the one of non-progressive training
+    at the same depth. A depth other than the original four stages has
+    its own directories."""
+    model_dir = "{}_{}_{}_{}".format(
         self.dataset_name, self.batch_size,
         self.output_height, self.output_width)
+    if self.num_stages != 4:
+      model_dir += "_depth{}".format(self.num_stages)
+    if stage < self.num_stages:
+      model_dir += "_stage_{}_{}".format(
+        self.stage_heights[stage], self.stage_widths[stage])
+    return model_dir
       
   def save(self, checkpoint_dir, step):
     model_name = "DCGAN.model"
@@ -607,7 +1360,9 @@ class DCGAN(object):
             os.path.join(checkpoint_dir, model_name),
             global_step=step)
 
-  def load(self, checkpoint_dir):
+  def load(self, checkpoint_dir, restore=True):
+    """Restores the latest checkpoint; with `restore` unset, only reads
+    its counter."""
     import re
     print(" [*] Reading checkpoints...")
     checkpoint_dir = os.path.join(checkpoint_dir, self.model_dir)
@@ -615,10 +1370,65 @@ class DCGAN(object):
     ckpt = tf.train.get_checkpoint_state(checkpoint_dir)
     if ckpt and ckpt.model_checkpoint_path:
       ckpt_name = os.path.basename(ckpt.model_checkpoint_path)
-      self.saver.restore(self.sess, os.path.join(checkpoint_dir, ckpt_name))
+      if restore:
+        self.restore(os.path.join(checkpoint_dir, ckpt_name))
       counter = int(next(re.finditer("(\d+)(?!.*\d)",ckpt_name)).group(0))
       print(" [*] Success to read {}".format(ckpt_name))
       return True, counter
     else:
       print(" [*] Failed to find a checkpoint")
       return False, 0
+
+  def restore(self, ckpt_path):
+    """Restores `ckpt_path` with `self.saver`.
+
+    A checkpoint written without generator_ema lacks the generator
+    averages of a training graph; they then start from the restored weights.
+    One of the final size written without the fade-in layers (by the
+    no-blend phase of the final progressive stage, or a non-progressive
+    run) lacks those, which keep their initialization.
+    """
+    if self.g_ema is None and not self.fade_in:
+      self.saver.restore(self.sess, ckpt_path)
+      return
+
+    saved_shapes = tf.train.NewCheckpointReader(ckpt_path).get_variable_to_shape_map()
+    var_list = [var for var in self.model_vars
+                if saved_shapes.get(var.op.name) == var.get_shape().as_list()]
+    if len(var_list) == len(self.model_vars):
+      self.saver.restore(self.sess, ckpt_path)
+      return
+    tf.train.Saver(var_list).restore(self.sess, ckpt_path)
+    restored = set(var.op.name for var in var_list)
+    missing = []
+    if self.g_ema is not None:
+      missing = [var for var in self.g_ema_vars if var.op.name in restored and
+                 self.g_ema.average(var).op.name not in restored]
+      self.sess.run([tf.assign(self.g_ema.average(var), var) for var in missing])
+    print(" [*] Restored %d/%d variables from %s" % (
+      len(var_list), len(self.model_vars), ckpt_path))
+    if missing:
+      print(" [*] Started %d generator averages from the restored weights" % len(missing))
+
+  def load_previous_stage(self, checkpoint_dir):
+    """Restores the variables shared with the previous progressive stage
+    from its latest checkpoint; the layers of the new stage keep their
+    initialization."""
+    import re
+    checkpoint_dir = os.path.join(
+      checkpoint_dir, self.stage_model_dir(self.stage - 1))
+    ckpt = tf.train.get_checkpoint_state(checkpoint_dir)
+    if not (ckpt and ckpt.model_checkpoint_path):
+      print(" [*] Failed to find a checkpoint of the previous stage")
+      return False, 0
+
+    ckpt_path = os.path.join(
+      checkpoint_dir, os.path.basename(ckpt.model_checkpoint_path))
+    saved_shapes = tf.train.NewCheckpointReader(ckpt_path).get_variable_to_shape_map()
+    var_list = [var for var in self.model_vars
+                if saved_shapes.get(var.op.name) == var.get_shape().as_list()]
+    tf.train.Saver(var_list).restore(self.sess, ckpt_path)
+    counter = int(next(re.finditer("(\d+)(?!.*\d)", ckpt_path)).group(0))
+    print(" [*] Restored %d/%d variables from %s" % (
+      len(var_list), len(self.model_vars), ckpt_path))
+    return True, counter
@@ -0,0 +1,117 @@
+"""
+Run an exported DCGAN generator with NumPy only (no TensorFlow import)
+
+    $ python export.py --dataset celebA --export_format=npz --export_path=generator.npz
+    $ python numpy_generator.py generator.npz --batch_size=64 --dtype=float32
+"""
+from __future__ import division
+import json
+import time
+import argparse
+import numpy as np
+
+def conv2d_transpose(x, w, output_shape, stride=2):
+  """Transposed convolution matching tf.nn.conv2d_transpose with SAME padding.
+
+  x: [batch, in_h, in_w, in_c], w: [k_h, k_w, out_c, in_c] and
+  output_shape: [out_h, out_w, out_c]. Every input pixel is multiplied with
+  the whole filter in one tensordot, then the k_h * k_w filter taps are
+  scattered into the output with strided adds.
+  """
+  batch, in_h, in_w, _ = x.shape
+  k_h, k_w, out_c, _ = w.shape
+  out_h, out_w = output_shape[0], output_shape[1]
+
+  pad_h = max((in_h - 1) * stride + k_h - out_h, 0) // 2
+  pad_w = max((in_w - 1) * stride + k_w - out_w, 0) // 2
+  full_h = max((in_h - 1) * stride + k_h, pad_h + out_h)
+  full_w = max((in_w - 1) * stride + k_w, pad_w + out_w)
+
+  # [batch, in_h, in_w, k_h, k_w, out_c]
+  taps = np.tensordot(x, w, axes=([3], [3]))
+  full = np.zeros((batch, full_h, full_w, out_c), dtype=x.dtype)
+  for i in range(k_h):
+    for j in range(k_w):
+      full[:, i:i + (in_h - 1) * stride + 1:stride,
+              j:j + (in_w - 1) * stride + 1:stride, :] += taps[:, :, :, i, j, :]
+  return full[:, pad_h:pad_h + out_h, pad_w:pad_w + out_w, :]
+
+def relu(x):
+  return np.maximum(x, 0, out=x)
+
+def tanh(x):
+  return np.tanh(x, out=x)
+
+def sigmoid(x):
+  return 1. / (1. + np.exp(-x))
+
+activations = {'relu': relu, 'tanh': tanh, 'sigmoid': sigmoid}
+
+class NumpyGenerator(object):
+  """Generator forward pass from an archive written by `export.export_npz`.
+
+  Batch norm is already folded into the weights of the archive, so each
+  layer is a linear or transposed convolution, a bias and an activation.
+  """
+  def __init__(self, path, dtype=np.float32):
+    self.dtype = np.dtype(dtype)
+    archive = np.load(path)
+    manifest = json.loads(str(archive['manifest']))
+    self.z_dim = manifest['z_dim']
+    self.y_dim = manifest['y_dim']
+    self.layers = manifest['layers']
+    for idx, layer in enumerate(self.layers):
+      layer['w'] = archive['%d/w' % idx].astype(self.dtype)
+      layer['b'] = archive['%d/b' % idx].astype(self.dtype)
+
+  def generate(self, z, y=None):
+    h = np.asarray(z, dtype=self.dtype)
+    if self.y_dim:
+      if y is None:
+        raise ValueError("y is required by a conditional generator")
+      y = np.asarray(y, dtype=self.dtype)
+
+    for layer in self.layers:
+      if layer['concat_y']:
+        if h.ndim == 2:
+          h = np.concatenate([h, y], 1)
+        else:
+          yb = np.broadcast_to(y[:, None, None, :], h.shape[:3] + (self.y_dim,))
+          h = np.concatenate([h, yb], 3)
+
+      if layer['type'] == 'linear':
+        h = np.dot(h, layer['w'])
+      else:
+        h = conv2d_transpose(h, layer['w'], layer['output_shape'])
+      h += layer['b']
+      if 'reshape' in layer:
+        h = h.reshape([-1] + layer['reshape'])
+      h = activations[layer['activation']](h)
+    return h
+
+def benchmark(generator, batch_size=64, num_batches=10, seed=0):
+  """Returns images/sec of `generator.generate` on uniform random z."""
+  rng = np.random.RandomState(seed)
+  z = rng.uniform(-1, 1, [batch_size, generator.z_dim])
+  y = None
+  if generator.y_dim:
+    y = np.eye(generator.y_dim)[rng.randint(generator.y_dim, size=batch_size)]
+
+  generator.generate(z, y)
+  start_time = time.time()
+  for _ in range(num_batches):
+    generator.generate(z, y)
+  return batch_size * num_batches / (time.time() - start_time)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+  parser.add_argument('path', help='weight archive written by export.py')
+  parser.add_argument('--batch_size', type=int, default=64)
+  parser.add_argument('--num_batches', type=int, default=10)
+  parser.add_argument('--dtype', default='float32', choices=['float32', 'float16'])
+  args = parser.parse_args()
+
+  generator = NumpyGenerator(args.path, dtype=args.dtype)
+  print(" [*] %s, batch %d: %.1f images/sec" % (
+    args.dtype, args.batch_size,
+    benchmark(generator, args.batch_size, args.num_batches)))
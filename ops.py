@@ -1,4 +1,5 @@
 import math
+import contextlib
 import numpy as np 
 import tensorflow as tf
 
@@ -26,6 +27,21 @@ else:
   def concat(tensors, axis, *args, **kwargs):
     return tf.concat(tensors, axis, *args, **kwargs)
 
+_batch_norm_updates = [True]
+
+@contextlib.contextmanager
+def batch_norm_updates(enabled):
+  """Whether batch norms built inside update their moving statistics.
+
+  When disabled, the updates go to an unused collection and never run; the
+  towers after the first one of a multi-tower model are built this way.
+  """
+  _batch_norm_updates.append(enabled)
+  try:
+    yield
+  finally:
+    _batch_norm_updates.pop()
+
 class batch_norm(object):
   def __init__(self, epsilon=1e-5, momentum = 0.9, name="batch_norm"):
     with tf.variable_scope(name):
@@ -34,53 +50,74 @@ class batch_norm(object):
       self.name = name
 
   def __call__(self, x, train=True):
-    return tf.contrib.layers.batch_norm(x,
+    updates_collections = None
+    if not _batch_norm_updates[-1]:
+      updates_collections = "unused_batch_norm_updates"
+    # float16 activations are normalized in float32
+    normalized = tf.contrib.layers.batch_norm(tf.cast(x, tf.float32),
                       decay=self.momentum, 
-                      updates_collections=None,
+                      updates_collections=updates_collections,
                       epsilon=self.epsilon,
                       scale=True,
                       is_training=train,
                       scope=self.name)
+    return tf.cast(normalized, x.dtype)
 
 def conv_cond_concat(x, y):
   """Concatenate conditioning vector on feature map axis."""
   x_shapes = x.get_shape()
   y_shapes = y.get_shape()
   return concat([
-    x, y*tf.ones([x_shapes[0], x_shapes[1], x_shapes[2], y_shapes[3]])], 3)
+    x, y*tf.ones(tf.stack([tf.shape(x)[0], int(x_shapes[1]), int(x_shapes[2]), int(y_shapes[3])]),
+                 dtype=x.dtype)], 3)
+
+def flatten(x):
+  """Reshape to [batch, features], keeping the feature size static."""
+  dim = int(np.prod(x.get_shape().as_list()[1:]))
+  return tf.reshape(x, [-1, dim])
 
 def conv2d(input_, output_dim, 
        k_h=5, k_w=5, d_h=2, d_w=2, stddev=0.02,
        name="conv2d"):
+  """2-D convolution; float32 weights are cast to the dtype of `input_`."""
   with tf.variable_scope(name):
     w = tf.get_variable('w', [k_h, k_w, input_.get_shape()[-1], output_dim],
               initializer=tf.truncated_normal_initializer(stddev=stddev))
-    conv = tf.nn.conv2d(input_, w, strides=[1, d_h, d_w, 1], padding='SAME')
+    conv = tf.nn.conv2d(input_, tf.cast(w, input_.dtype),
+                        strides=[1, d_h, d_w, 1], padding='SAME')
 
     biases = tf.get_variable('biases', [output_dim], initializer=tf.constant_initializer(0.0))
-    conv = tf.reshape(tf.nn.bias_add(conv, biases), conv.get_shape())
+    conv = tf.nn.bias_add(conv, tf.cast(biases, input_.dtype))
 
     return conv
 
 def deconv2d(input_, output_shape,
        k_h=5, k_w=5, d_h=2, d_w=2, stddev=0.02,
        name="deconv2d", with_w=False):
+  """Transposed convolution; a None batch in `output_shape` follows `input_`.
+
+  Like `conv2d`, the float32 weights are cast to the dtype of `input_`.
+  """
+  static_shape = list(output_shape)
+  if output_shape[0] is None:
+    output_shape = tf.stack([tf.shape(input_)[0]] + static_shape[1:])
   with tf.variable_scope(name):
     # filter : [height, width, output_channels, in_channels]
-    w = tf.get_variable('w', [k_h, k_w, output_shape[-1], input_.get_shape()[-1]],
+    w = tf.get_variable('w', [k_h, k_w, static_shape[-1], input_.get_shape()[-1]],
               initializer=tf.random_normal_initializer(stddev=stddev))
     
     try:
-      deconv = tf.nn.conv2d_transpose(input_, w, output_shape=output_shape,
-                strides=[1, d_h, d_w, 1])
+      deconv = tf.nn.conv2d_transpose(input_, tf.cast(w, input_.dtype),
+                output_shape=output_shape, strides=[1, d_h, d_w, 1])
 
     # Support for verisons of TensorFlow before 0.7.0
     except AttributeError:
-      deconv = tf.nn.deconv2d(input_, w, output_shape=output_shape,
-                strides=[1, d_h, d_w, 1])
+      deconv = tf.nn.deconv2d(input_, tf.cast(w, input_.dtype),
+                output_shape=output_shape, strides=[1, d_h, d_w, 1])
 
-    biases = tf.get_variable('biases', [output_shape[-1]], initializer=tf.constant_initializer(0.0))
-    deconv = tf.reshape(tf.nn.bias_add(deconv, biases), deconv.get_shape())
+    biases = tf.get_variable('biases', [static_shape[-1]], initializer=tf.constant_initializer(0.0))
+    deconv = tf.nn.bias_add(deconv, tf.cast(biases, input_.dtype))
+    deconv.set_shape(static_shape)
 
     if with_w:
       return deconv, w, biases
@@ -98,7 +135,9 @@ def linear(input_, output_size, scope=None, stddev=0.02, bias_start=0.0, with_w=
                  tf.random_normal_initializer(stddev=stddev))
     bias = tf.get_variable("bias", [output_size],
       initializer=tf.constant_initializer(bias_start))
+    output = tf.matmul(input_, tf.cast(matrix, input_.dtype)) \
+        + tf.cast(bias, input_.dtype)
     if with_w:
-      return tf.matmul(input_, matrix) + bias, matrix, bias
+      return output, matrix, bias
     else:
-      return tf.matmul(input_, matrix) + bias
+      return output
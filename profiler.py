@@ -0,0 +1,130 @@
+"""
+Per-phase timing of training steps and Chrome-trace capture
+"""
+from __future__ import division
+import os
+import time
+import signal
+import contextlib
+from collections import deque, OrderedDict
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+class StepProfiler(object):
+  """Records how long each phase of a training step takes.
+
+  The seconds of every phase are summed per step and the last `window`
+  steps are kept in a ring buffer per phase, from which `percentiles`
+  are computed. Phases that did not run in a step (sample dumps,
+  checkpoints) are not recorded for it.
+
+  `request_trace(num_steps)` makes the next `num_steps` steps run with
+  full tracing; each traced session run is written to `trace_dir` as a
+  Chrome trace (open it in chrome://tracing).
+  """
+  def __init__(self, window=1000, trace_dir='./logs/timeline'):
+    self.window = window
+    self.trace_dir = trace_dir
+    self.history = OrderedDict()
+    self.current = OrderedDict()
+    self.step = None
+    self.step_start_time = None
+    self.trace_remaining = 0
+    self.num_traces = 0
+
+  @contextlib.contextmanager
+  def phase(self, name):
+    start_time = time.time()
+    try:
+      yield
+    finally:
+      self.add(name, time.time() - start_time)
+
+  def add(self, name, seconds):
+    self.current[name] = self.current.get(name, 0.) + seconds
+
+  def start_step(self, step):
+    self.step = step
+    self.step_start_time = time.time()
+    self.current = OrderedDict()
+
+  def end_step(self):
+    self.current['step'] = time.time() - self.step_start_time
+    for name, seconds in self.current.items():
+      if name not in self.history:
+        self.history[name] = deque(maxlen=self.window)
+      self.history[name].append(seconds)
+    if self.trace_remaining > 0:
+      self.trace_remaining -= 1
+
+  def totals(self):
+    """Returns the summed seconds of every phase over the ring buffer."""
+    return OrderedDict((name, float(np.sum(seconds)))
+                       for name, seconds in self.history.items())
+
+  def percentiles(self, q=(50, 95, 99)):
+    """Returns {phase: {'p50': seconds, ...}} over the ring buffer."""
+    results = OrderedDict()
+    for name, seconds in self.history.items():
+      values = np.percentile(np.array(seconds), q)
+      results[name] = OrderedDict(('p%d' % p, float(v)) for p, v in zip(q, values))
+    return results
+
+  def summary(self):
+    """Returns the percentiles as a tf.Summary of profile/<phase>/<pXX>."""
+    values = []
+    for name, percentiles in self.percentiles().items():
+      for p, seconds in percentiles.items():
+        values.append(tf.Summary.Value(
+          tag='profile/%s/%s' % (name, p), simple_value=seconds))
+    return tf.Summary(value=values)
+
+  def format(self):
+    lines = ["[Profile] last %d steps, ms p50/p95/p99:" % len(
+      self.history.get('step', []))]
+    for name, percentiles in self.percentiles().items():
+      lines.append("  %-12s %s" % (name, "/".join(
+        "%.1f" % (1000 * seconds) for seconds in percentiles.values())))
+    return "\n".join(lines)
+
+  def request_trace(self, num_steps):
+    self.trace_remaining = max(self.trace_remaining, num_steps)
+
+  def install_signal_handler(self, num_steps, signum=None):
+    """Traces `num_steps` steps whenever the process receives SIGUSR1."""
+    signum = signum or getattr(signal, 'SIGUSR1', None)
+    if signum is None:
+      return
+    def handler(signum, frame):
+      print(" [*] Tracing the next %d steps" % num_steps)
+      self.request_trace(num_steps)
+    signal.signal(signum, handler)
+
+  @property
+  def tracing(self):
+    return self.trace_remaining > 0
+
+  def run(self, sess, name, fetches, feed_dict=None):
+    """`sess.run` timed as phase `name`, traced while a trace is requested."""
+    if not self.tracing:
+      with self.phase(name):
+        return sess.run(fetches, feed_dict=feed_dict)
+
+    options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+    run_metadata = tf.RunMetadata()
+    with self.phase(name):
+      results = sess.run(fetches, feed_dict=feed_dict,
+                         options=options, run_metadata=run_metadata)
+    self.write_trace(name, run_metadata)
+    return results
+
+  def write_trace(self, name, run_metadata):
+    if not os.path.exists(self.trace_dir):
+      os.makedirs(self.trace_dir)
+    path = os.path.join(self.trace_dir, 'step_%d_%s_%d.json' % (
+      self.step, name, self.num_traces))
+    self.num_traces += 1
+    trace = timeline.Timeline(run_metadata.step_stats)
+    with open(path, 'w') as f:
+      f.write(trace.generate_chrome_trace_format())
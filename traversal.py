@@ -0,0 +1,145 @@
+"""
+Streaming latent-space traversals for visualize options 1-4
+"""
+from __future__ import division
+import random
+import multiprocessing
+import numpy as np
+from six.moves import xrange
+
+from utils import merge, save_images, one_hot
+from input_pipeline import process_pool
+
+def traversal_z(dims, values, z_dim, base=None):
+  """Returns z of shape [len(dims), len(values), z_dim].
+
+  Row i sweeps coordinate dims[i] over `values`; the other coordinates come
+  from base[i] (zeros when `base` is None).
+  """
+  dims = np.asarray(dims)
+  if base is None:
+    z = np.zeros([len(dims), len(values), z_dim], dtype=np.float32)
+  else:
+    z = np.repeat(np.asarray(base, dtype=np.float32)[:, None, :], len(values), axis=1)
+  z[np.arange(len(dims))[:, None], np.arange(len(values))[None, :], dims[:, None]] = values
+  return z
+
+def run_sampler(sess, dcgan, z, y_dim=None, batch_size=1024):
+  """Feeds [..., z_dim] latents through the sampler in large batches.
+
+  Yields the images of consecutive chunks of the leading axis of `z`, with
+  at most `batch_size` images per run.
+  """
+  per_row = int(np.prod(z.shape[1:-1]))
+  rows_per_run = max(1, batch_size // per_row)
+  for start in xrange(0, len(z), rows_per_run):
+    chunk = z[start:start+rows_per_run]
+    flat = chunk.reshape(-1, z.shape[-1])
+    feed_dict = {dcgan.z: flat}
+    if y_dim:
+      feed_dict[dcgan.y] = one_hot(np.random.choice(y_dim, len(flat)), y_dim)
+    samples = sess.run(dcgan.sampler, feed_dict=feed_dict)
+    yield samples.reshape(chunk.shape[:-1] + samples.shape[1:])
+
+def to_frames(images):
+  """Maps [-1, 1] images to uint8 frames, as `make_gif` does."""
+  frames = ((images + 1) / 2 * 255).clip(0, 255).astype(np.uint8)
+  if frames.shape[-1] == 1:
+    frames = frames[..., 0]
+  return frames
+
+def open_writer(path, fps):
+  """Opens an incremental GIF or MP4 encoder (by extension) for `path`."""
+  import imageio
+  if path.endswith('.gif'):
+    return imageio.get_writer(path, mode='I', duration=1. / fps)
+  return imageio.get_writer(path, fps=fps)
+
+def write_animation(frames, path, fps):
+  writer = open_writer(path, fps)
+  try:
+    for frame in frames:
+      writer.append_data(frame)
+  finally:
+    writer.close()
+
+def write_animation_or_grid(frames, images, size, path, fallback_path, fps):
+  try:
+    write_animation(frames, path, fps)
+  except Exception:
+    save_images(images, size, fallback_path)
+
+class EncoderPool(object):
+  """Runs encoding jobs in worker processes, with at most `max_pending` queued.
+
+  `submit` blocks on the oldest job once the limit is reached, which keeps
+  memory bounded however many files are rendered.
+  """
+  def __init__(self, num_workers=None, max_pending=None):
+    num_workers = num_workers or multiprocessing.cpu_count()
+    # not forked: the TF session of the sampler is running
+    self.pool = process_pool(num_workers)
+    self.max_pending = max_pending or 2 * num_workers
+    self.pending = []
+
+  def submit(self, func, *args):
+    while len(self.pending) >= self.max_pending:
+      self.pending.pop(0).get()
+    self.pending.append(self.pool.apply_async(func, args))
+
+  def close(self):
+    for result in self.pending:
+      result.get()
+    self.pool.close()
+    self.pool.join()
+
+def render_traversals(sess, dcgan, config, option, sample_dir='./samples'):
+  num_values = config.batch_size
+  values = np.arange(0, 1, 1./num_values)[:num_values]
+  image_frame_dim = int(np.ceil(num_values**.5))
+  size = [image_frame_dim, image_frame_dim]
+  y_dim = dcgan.y_dim if config.dataset == 'mnist' else None
+  ext = config.visualize_format
+  fps = num_values / 2.
+  num_dims = min(100, dcgan.z_dim)
+
+  if option == 2:
+    dims = [random.randint(0, num_dims - 1) for _ in xrange(100)]
+    base = np.random.uniform(-0.2, 0.2, size=(len(dims), dcgan.z_dim))
+  else:
+    dims = list(xrange(num_dims))
+    base = None
+  z = traversal_z(dims, values, dcgan.z_dim, base)
+
+  encoders = EncoderPool()
+  try:
+    idx = 0
+    for samples in run_sampler(sess, dcgan, z, y_dim, config.visualize_batch_size):
+      for images in samples:
+        print(" [*] %d" % dims[idx])
+        if option == 1:
+          encoders.submit(save_images, images, size,
+                          '%s/test_arange_%s.png' % (sample_dir, dims[idx]))
+        elif option == 2:
+          encoders.submit(write_animation_or_grid, to_frames(images), images, size,
+                          '%s/test_gif_%s.%s' % (sample_dir, dims[idx], ext),
+                          '%s/test_%s_%s.png' % (sample_dir, idx, dims[idx]), fps)
+        else:
+          encoders.submit(write_animation, to_frames(images),
+                          '%s/test_gif_%s.%s' % (sample_dir, dims[idx], ext), fps)
+        idx += 1
+  finally:
+    encoders.close()
+
+  if option == 4:
+    # Frame t shows every traversal at step t on a 10x10 grid. Frames are
+    # regenerated on the way back instead of being kept in memory.
+    steps = list(xrange(num_values)) + list(xrange(num_values - 1, -1, -1))
+    writer = open_writer('%s/test_gif_merged.%s' % (sample_dir, ext), len(steps) / 8.)
+    try:
+      frame_z = np.transpose(z[:, steps], (1, 0, 2))
+      for frames in run_sampler(sess, dcgan, frame_z, y_dim, config.visualize_batch_size):
+        for images in frames:
+          writer.append_data(to_frames(merge(images, [10, 10])))
+    finally:
+      writer.close()
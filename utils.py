@@ -2,14 +2,17 @@
 Some codes from https://github.com/Newmu/dcgan_code
 """
 from __future__ import division
+import os
+import re
 import math
 import json
 import random
 import pprint
+import threading
 import scipy.misc
 import numpy as np
 from time import gmtime, strftime
-from six.moves import xrange
+from six.moves import xrange, queue
 
 import tensorflow as tf
 import tensorflow.contrib.slim as slim
@@ -29,6 +32,13 @@ def get_image(image_path, input_height, input_width,
   return transform(image, input_height, input_width,
                    resize_height, resize_width, crop)
 
+def get_image_uint8(image_path, input_height, input_width,
+                    resize_height=64, resize_width=64,
+                    crop=True, grayscale=False):
+  image = imread(image_path, grayscale)
+  return resize_image(image, input_height, input_width,
+                      resize_height, resize_width, crop)
+
 def save_images(images, size, image_path):
   return imsave(inverse_transform(images), size, image_path)
 
@@ -42,30 +52,73 @@ def merge_images(images, size):
   return inverse_transform(images)
 
 def merge(images, size):
+  """Tiles images into a size[0] x size[1] grid, keeping their dtype.
+
+  Missing cells are left black. The grid is built by a single reshape and
+  transpose, and single-channel images give a 2-D grid.
+  """
   h, w = images.shape[1], images.shape[2]
-  if (images.shape[3] in (3,4)):
-    c = images.shape[3]
-    img = np.zeros((h * size[0], w * size[1], c))
-    for idx, image in enumerate(images):
-      i = idx % size[1]
-      j = idx // size[1]
-      img[j * h:j * h + h, i * w:i * w + w, :] = image
-    return img
-  elif images.shape[3]==1:
-    img = np.zeros((h * size[0], w * size[1]))
-    for idx, image in enumerate(images):
-      i = idx % size[1]
-      j = idx // size[1]
-      img[j * h:j * h + h, i * w:i * w + w] = image[:,:,0]
-    return img
-  else:
+  c = images.shape[3]
+  if c not in (1, 3, 4):
     raise ValueError('in merge(images,size) images parameter '
                      'must have dimensions: HxW or HxWx3 or HxWx4')
+  rows, cols = size
+  images = images[:rows * cols]
+  if len(images) < rows * cols:
+    padding = np.zeros((rows * cols - len(images), h, w, c), dtype=images.dtype)
+    images = np.concatenate([images, padding])
+  img = images.reshape(rows, cols, h, w, c).transpose(0, 2, 1, 3, 4) \
+              .reshape(rows * h, cols * w, c)
+  if c == 1:
+    return img[:, :, 0]
+  return img
 
 def imsave(images, size, path):
   image = np.squeeze(merge(images, size))
   return scipy.misc.imsave(path, image)
 
+class ImageWriter(object):
+  """Saves image grids from a background thread.
+
+  `save` only queues the images; merging, PNG encoding and the disk write
+  happen on the writer thread. When `max_pending` grids are already
+  waiting, the oldest one is dropped to make room for the newest.
+  """
+  def __init__(self, max_pending=4):
+    self.pending = queue.Queue(maxsize=max_pending)
+    self.dropped = 0
+    self.thread = threading.Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _run(self):
+    while True:
+      item = self.pending.get()
+      if item is None:
+        break
+      images, size, image_path = item
+      try:
+        save_images(images, size, image_path)
+      except Exception as e:
+        print(" [!] Failed to save %s: %s" % (image_path, e))
+
+  def save(self, images, size, image_path):
+    while True:
+      try:
+        self.pending.put_nowait((images, size, image_path))
+        return
+      except queue.Full:
+        try:
+          self.pending.get_nowait()
+          self.dropped += 1
+        except queue.Empty:
+          pass
+
+  def close(self):
+    """Writes out the grids still waiting, then stops the thread."""
+    self.pending.put(None)
+    self.thread.join()
+
 def center_crop(x, crop_h, crop_w,
                 resize_h=64, resize_w=64):
   if crop_w is None:
@@ -76,15 +129,20 @@ def center_crop(x, crop_h, crop_w,
   return scipy.misc.imresize(
       x[j:j+crop_h, i:i+crop_w], [resize_h, resize_w])
 
-def transform(image, input_height, input_width, 
-              resize_height=64, resize_width=64, crop=True):
+def resize_image(image, input_height, input_width,
+                 resize_height=64, resize_width=64, crop=True):
   if crop:
     cropped_image = center_crop(
       image, input_height, input_width, 
       resize_height, resize_width)
   else:
     cropped_image = scipy.misc.imresize(image, [resize_height, resize_width])
-  return np.array(cropped_image)/127.5 - 1.
+  return np.array(cropped_image)
+
+def transform(image, input_height, input_width, 
+              resize_height=64, resize_width=64, crop=True):
+  return resize_image(image, input_height, input_width,
+                      resize_height, resize_width, crop)/127.5 - 1.
 
 def inverse_transform(images):
   return (images+1.)/2.
@@ -152,6 +210,82 @@ def to_json(output_path, *layers):
                W.shape[0], W.shape[3], biases, gamma, beta, fs)
     layer_f.write(" ".join(lines.replace("'","").split()))
 
+def batch_norm_variable(bn, name):
+  suffix = "/%s/%s" % (bn.name, name)
+  return [var for var in tf.global_variables() if var.op.name.endswith(suffix)][0]
+
+def to_binary(output_path, *layers, **kwargs):
+  """Binary counterpart of `to_json` for web/js/app.js.
+
+  Takes the same (w, b, bn) layers. The weights are streamed layer by layer
+  into `output_path` (e.g. ./web/js/layers.bin), and the layer shapes and
+  types go to a JSON manifest next to it (./web/js/layers.json). Pass
+  dtype='float16' to halve the size, or dtype='int8' to quantize the
+  filters with one float32 scale per output filter.
+  """
+  dtype = kwargs.get('dtype', 'float32')
+  if dtype not in ('float32', 'float16', 'int8'):
+    raise ValueError("dtype must be float32, float16 or int8, got %s" % dtype)
+  manifest_path = os.path.splitext(output_path)[0] + '.json'
+
+  manifest = {"dtype": dtype, "layers": []}
+  with open(output_path, "wb") as bin_f:
+    def write(array, quantize=False):
+      array = np.ascontiguousarray(array, dtype=np.float32)
+      entry = {"offset": bin_f.tell(), "length": int(array.size)}
+      if quantize and dtype == 'int8':
+        rows = array.reshape(array.shape[0], -1)
+        scales = np.abs(rows).max(axis=1) / 127.
+        scales[scales == 0] = 1.
+        entry["dtype"] = "int8"
+        entry["scales_offset"] = entry["offset"]
+        bin_f.write(scales.astype(np.float32).tobytes())
+        entry["offset"] = bin_f.tell()
+        bin_f.write(np.round(rows / scales[:, None]).astype(np.int8).tobytes())
+      elif dtype == 'float16':
+        entry["dtype"] = "float16"
+        bin_f.write(array.astype(np.float16).tobytes())
+      else:
+        entry["dtype"] = "float32"
+        bin_f.write(array.tobytes())
+      # keep every array 4-byte aligned for Float32Array views
+      bin_f.write(b'\0' * (-bin_f.tell() % 4))
+      return entry
+
+    for w, b, bn in layers:
+      layer_idx = re.search(r'h(\d+)', w.name).group(1)
+
+      if "lin/" in w.name:
+        W = w.eval()
+        depth = W.shape[1]
+        # one filter per output unit, as in to_json
+        filters = W.T
+        layer = {"layer_type": "fc", "sy": 1, "sx": 1,
+                 "out_sx": 1, "out_sy": 1, "stride": 1, "pad": 0,
+                 "out_depth": W.shape[1], "in_depth": W.shape[0],
+                 "filter": {"sy": 1, "sx": 1, "depth": W.shape[0]}}
+      else:
+        W = np.rollaxis(w.eval(), 2, 0)
+        depth = W.shape[0]
+        filters = W
+        layer = {"layer_type": "deconv", "sy": 5, "sx": 5,
+                 "out_sx": 2**(int(layer_idx)+2), "out_sy": 2**(int(layer_idx)+2),
+                 "stride": 2, "pad": 1,
+                 "out_depth": W.shape[0], "in_depth": W.shape[3],
+                 "filter": {"sy": 5, "sx": 5, "depth": W.shape[3]}}
+
+      layer["name"] = "layer_%s" % layer_idx
+      layer["depth"] = depth
+      layer["filters"] = write(filters, quantize=True)
+      layer["biases"] = write(b.eval())
+      if bn != None:
+        layer["gamma"] = write(batch_norm_variable(bn, "gamma").eval())
+        layer["beta"] = write(batch_norm_variable(bn, "beta").eval())
+      manifest["layers"].append(layer)
+
+  with open(manifest_path, "w") as manifest_f:
+    json.dump(manifest, manifest_f, default=int)
+
 def make_gif(images, fname, duration=2, true_image=False):
   import moviepy.editor as mpy
 
@@ -175,73 +309,12 @@ def visualize(sess, dcgan, config, option):
     z_sample = np.random.uniform(-1.0, 1.0, size=(config.batch_size, dcgan.z_dim))
     samples = sess.run(dcgan.sampler, feed_dict={dcgan.z: z_sample})
     save_images(samples, [image_frame_dim, image_frame_dim], './samples/test_%s.png' % strftime("%Y%m%d%H%M%S", gmtime()))
-  elif option == 1:
-    values = np.arange(0, 1, 1./config.batch_size)
-    for idx in xrange(100):
-      print(" [*] %d" % idx)
-      z_sample = np.zeros([config.batch_size, dcgan.z_dim])
-      for kdx, z in enumerate(z_sample):
-        z[idx] = values[kdx]
-      
-      if config.dataset == "mnist":
-        y = np.random.choice(10, config.batch_size)
-        y_one_hot = np.zeros((config.batch_size, 10))
-        y_one_hot[np.arange(config.batch_size), y] = 1
-
-        samples = sess.run(dcgan.sampler, feed_dict={dcgan.z: z_sample, dcgan.y: y_one_hot})
-      else:
-        samples = sess.run(dcgan.sampler, feed_dict={dcgan.z: z_sample})
-
-      save_images(samples, [image_frame_dim, image_frame_dim], './samples/test_arange_%s.png' % (idx))
-  elif option == 2:
-    values = np.arange(0, 1, 1./config.batch_size)
-    for idx in [random.randint(0, 99) for _ in xrange(100)]:
-      print(" [*] %d" % idx)
-      z = np.random.uniform(-0.2, 0.2, size=(dcgan.z_dim))
-      z_sample = np.tile(z, (config.batch_size, 1))
-      #z_sample = np.zeros([config.batch_size, dcgan.z_dim])
-      for kdx, z in enumerate(z_sample):
-        z[idx] = values[kdx]
-
-      if config.dataset == "mnist":
-        y = np.random.choice(10, config.batch_size)
-        y_one_hot = np.zeros((config.batch_size, 10))
-        y_one_hot[np.arange(config.batch_size), y] = 1
-
-        samples = sess.run(dcgan.sampler, feed_dict={dcgan.z: z_sample, dcgan.y: y_one_hot})
-      else:
-        samples = sess.run(dcgan.sampler, feed_dict={dcgan.z: z_sample})
-
-      try:
-        make_gif(samples, './samples/test_gif_%s.gif' % (idx))
-      except:
-        save_images(samples, [image_frame_dim, image_frame_dim], './samples/test_%s.png' % strftime("%Y%m%d%H%M%S", gmtime()))
-  elif option == 3:
-    values = np.arange(0, 1, 1./config.batch_size)
-    for idx in xrange(100):
-      print(" [*] %d" % idx)
-      z_sample = np.zeros([config.batch_size, dcgan.z_dim])
-      for kdx, z in enumerate(z_sample):
-        z[idx] = values[kdx]
-
-      samples = sess.run(dcgan.sampler, feed_dict={dcgan.z: z_sample})
-      make_gif(samples, './samples/test_gif_%s.gif' % (idx))
-  elif option == 4:
-    image_set = []
-    values = np.arange(0, 1, 1./config.batch_size)
-
-    for idx in xrange(100):
-      print(" [*] %d" % idx)
-      z_sample = np.zeros([config.batch_size, dcgan.z_dim])
-      for kdx, z in enumerate(z_sample): z[idx] = values[kdx]
-
-      image_set.append(sess.run(dcgan.sampler, feed_dict={dcgan.z: z_sample}))
-      make_gif(image_set[-1], './samples/test_gif_%s.gif' % (idx))
-
-    new_image_set = [merge(np.array([images[idx] for images in image_set]), [10, 10]) \
-        for idx in range(64) + range(63, -1, -1)]
-    make_gif(new_image_set, './samples/test_gif_merged.gif', duration=8)
+  elif option in (1, 2, 3, 4):
+    from traversal import render_traversals
+    render_traversals(sess, dcgan, config, option)
 
+def one_hot(labels, depth):
+  return np.eye(depth, dtype=np.float32)[labels]
 
 def image_manifold_size(num_images):
   manifold_h = int(np.floor(np.sqrt(num_images)))
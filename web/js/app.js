@@ -143,12 +143,7 @@ $( document ).ready(function() {
 
     var net = new convnetjs.Net();
     net.makeLayers(layer_defs);
-
-    net.layers[1].fromJSON(layer_0);
-    net.layers[3].fromJSON(layer_1);
-    net.layers[5].fromJSON(layer_2);
-    net.layers[7].fromJSON(layer_3);
-    net.layers[9].fromJSON(layer_4);
+    var loaded = false;
 
     var input = new convnetjs.Vol(1, 1, 100, 0.0);
 
@@ -156,6 +151,7 @@ $( document ).ready(function() {
     var pixels = [];
 
     var draw = function() {
+        if (!loaded) return;
         cur_pixel = get_pixels();
         input.w = cur_pixel;
 
@@ -213,16 +209,109 @@ $( document ).ready(function() {
         draw();
     });
 
-    $("#loading").hide();
-    $("#draw-btn").show();
+    load_layers("js/layers", function(layers) {
+        for (var i = 0; i < layers.length; i++) {
+            net.layers[2*i + 1].fromJSON(layers[i]);
+        }
+        loaded = true;
 
-    if (!mobilecheck()) {
-        draw();
-    }
+        $("#loading").hide();
+        $("#draw-btn").show();
+
+        if (!mobilecheck()) {
+            draw();
+        }
 
-    $("#fakeLoader").fadeOut(3000);
+        $("#fakeLoader").fadeOut(3000);
+    }, function(path) {
+        $("#loading").html("<p>Could not load " + path +
+                           ". Export the generator with <code>python main.py --export_web=float16</code>.</p>");
+        $("#fakeLoader").fadeOut(1000);
+    });
 });
 
+// decode an IEEE 754 half precision number
+function half_to_float(h) {
+    var s = (h & 0x8000) ? -1 : 1;
+    var e = (h & 0x7c00) >> 10;
+    var f = h & 0x03ff;
+    if (e === 0) return s * Math.pow(2, -14) * (f / 1024);
+    if (e === 31) return f ? NaN : s * Infinity;
+    return s * Math.pow(2, e - 15) * (1 + f / 1024);
+}
+
+// read one array described by the manifest written by utils.to_binary
+function read_array(buffer, entry, rows) {
+    var out = new Float32Array(entry.length);
+    var i;
+    if (entry.dtype === "float16") {
+        var half = new Uint16Array(buffer, entry.offset, entry.length);
+        for (i = 0; i < entry.length; i++) out[i] = half_to_float(half[i]);
+    } else if (entry.dtype === "int8") {
+        var q = new Int8Array(buffer, entry.offset, entry.length);
+        var scales = new Float32Array(buffer, entry.scales_offset, rows);
+        var row_length = entry.length / rows;
+        for (i = 0; i < entry.length; i++) out[i] = q[i] * scales[Math.floor(i / row_length)];
+    } else {
+        out.set(new Float32Array(buffer, entry.offset, entry.length));
+    }
+    return out;
+}
+
+function to_vol_json(w, depth) {
+    return {"sy": 1, "sx": 1, "depth": depth, "w": w};
+}
+
+// fetch <prefix>.json and <prefix>.bin and rebuild the layer objects
+// that layers.js used to define, then call back with them in order;
+// `error` gets the path of a file that could not be fetched
+function load_layers(prefix, callback, error) {
+    if (typeof layer_0 !== "undefined") {
+        callback([layer_0, layer_1, layer_2, layer_3, layer_4]);
+        return;
+    }
+    $.getJSON(prefix + ".json", function(manifest) {
+        var xhr = new XMLHttpRequest();
+        xhr.open("GET", prefix + ".bin", true);
+        xhr.responseType = "arraybuffer";
+        xhr.onerror = function() {
+            error(prefix + ".bin");
+        };
+        xhr.onload = function() {
+            if (xhr.status !== 200) {
+                error(prefix + ".bin");
+                return;
+            }
+            var buffer = xhr.response;
+            var layers = manifest.layers.map(function(m) {
+                var count = m.out_depth;
+                var filters_w = read_array(buffer, m.filters, count);
+                var size = filters_w.length / count;
+                var filters = [];
+                for (var i = 0; i < count; i++) {
+                    filters.push({"sy": m.filter.sy, "sx": m.filter.sx, "depth": m.filter.depth,
+                                  "w": filters_w.subarray(i*size, (i+1)*size)});
+                }
+                return {
+                    "layer_type": m.layer_type,
+                    "sy": m.sy, "sx": m.sx,
+                    "out_sx": m.out_sx, "out_sy": m.out_sy,
+                    "stride": m.stride, "pad": m.pad,
+                    "out_depth": m.out_depth, "in_depth": m.in_depth,
+                    "biases": to_vol_json(read_array(buffer, m.biases), m.depth),
+                    "gamma": m.gamma ? to_vol_json(read_array(buffer, m.gamma), m.depth) : to_vol_json([], 0),
+                    "beta": m.beta ? to_vol_json(read_array(buffer, m.beta), m.depth) : to_vol_json([], 0),
+                    "filters": filters
+                };
+            });
+            callback(layers);
+        };
+        xhr.send();
+    }).fail(function() {
+        error(prefix + ".json");
+    });
+}
+
 
 // deactivate element
 function deactivate($el) {